@@ -1,27 +1,273 @@
+import time
+# Boot time of this module is measured against IMPORT_TIME_BUDGET
+_import_started = time.perf_counter()
 import os
 import re
 import logging
 import json
 import shutil
-import time
 import uuid
+import hashlib
+import mimetypes
+import io
+import zipfile
+import gzip
 import threading
 import subprocess
-import requests
-from flask import Flask, render_template, request, jsonify, send_file, session
+import signal
+import sqlite3
+import queue
+import heapq
+import itertools
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from flask import Flask, render_template, request, jsonify, send_file, session, Response
 import tempfile
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_accept_header, parse_etags
+
+try:
+    import brotli
+except ImportError:
+    # Optional: /get_video_info falls back to gzip without it
+    brotli = None
+
+# Logging: LOG_LEVEL is the default level and LOG_LEVELS overrides it per
+# logger, e.g. "app.progress=DEBUG,werkzeug=WARNING". Besides "app" itself
+# the subsystems are app.info (metadata), app.download (downloads and the
+# scheduler) and app.progress (progress updates and polling).
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+# "text" or "json" (one object per line with the structured fields as keys)
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text").lower()
+# Minimum seconds between sampled progress log lines for one download
+PROGRESS_LOG_INTERVAL = float(os.environ.get("PROGRESS_LOG_INTERVAL", "10"))
+
+class StructuredFormatter(logging.Formatter):
+    """Appends the fields passed as `extra={'fields': {...}}` as key=value pairs"""
+    
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        return message
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object, with its fields as top-level keys"""
+    
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(StructuredFormatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
+    for item in LOG_LEVELS.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+class LogSampler:
+    """Lets through at most one log line per key every `interval` seconds"""
+    
+    def __init__(self, interval, max_keys=10000):
+        self.interval = interval
+        self.max_keys = max_keys
+        self._last = OrderedDict()  # key -> monotonic time of the last line
+        self._lock = threading.Lock()
+    
+    def ready(self, key):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[key] = now
+            self._last.move_to_end(key)
+            while len(self._last) > self.max_keys:
+                self._last.popitem(last=False)
+            return True
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 logger = logging.getLogger(__name__)
+info_logger = logging.getLogger(f"{__name__}.info")
+download_logger = logging.getLogger(f"{__name__}.download")
+progress_logger = logging.getLogger(f"{__name__}.progress")
+# Progress lines from yt-dlp and client polls are logged for a sample only
+progress_log_sampler = LogSampler(PROGRESS_LOG_INTERVAL)
+poll_log_sampler = LogSampler(PROGRESS_LOG_INTERVAL)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default-secret-key")
+app.config['USE_X_SENDFILE'] = os.environ.get("SENDFILE_MODE", "none").lower() == 'x-sendfile'
+
+# Metadata extraction engine: "inprocess" keeps warm yt_dlp.YoutubeDL
+# instances inside the server, "subprocess" runs `yt-dlp -J` per request
+YTDLP_ENGINE = os.environ.get("YTDLP_ENGINE", "inprocess").lower()
+YTDLP_POOL_SIZE = int(os.environ.get("YTDLP_POOL_SIZE", "4"))
+YTDLP_INFO_TIMEOUT = int(os.environ.get("YTDLP_INFO_TIMEOUT", "30"))
+
+# Fallback sample files are provisioned in the background after the first
+# request instead of at import. "fetch" downloads them (bounded by
+# SAMPLE_FETCH_TIMEOUT seconds per file) and writes a placeholder when that
+# fails; "placeholder" never touches the network
+SAMPLE_SOURCE = os.environ.get("SAMPLE_SOURCE", "fetch").lower()
+SAMPLE_FETCH_TIMEOUT = float(os.environ.get("SAMPLE_FETCH_TIMEOUT", "10"))
+# Longest a request waits for samples that are still being provisioned
+SAMPLE_WAIT_TIMEOUT = float(os.environ.get("SAMPLE_WAIT_TIMEOUT", "2"))
+
+# Seconds importing the app may take before a warning is logged
+IMPORT_TIME_BUDGET = float(os.environ.get("IMPORT_TIME_BUDGET", "0.5"))
+
+# Video info cache (TTL in seconds, 0 disables caching)
+METADATA_CACHE_TTL = int(os.environ.get("METADATA_CACHE_TTL", "600"))
+METADATA_CACHE_MAX_ENTRIES = int(os.environ.get("METADATA_CACHE_MAX_ENTRIES", "1024"))
+METADATA_CACHE_MAX_BYTES = int(os.environ.get("METADATA_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# How downloads reach their target container: "auto" remuxes or skips
+# conversion when the codecs allow it, "remux" never re-encodes and
+# "recode" always re-encodes
+POSTPROCESS_MODE = os.environ.get("POSTPROCESS_MODE", "auto").lower()
+# Where CPU-bound encodes (re-encoding video, converting audio to mp3) run:
+# "pool" hands them to a separate pool of ffmpeg workers so they never hold a
+# download slot, "inline" leaves them to the download's yt-dlp process.
+# Encodes the pool runs at once in each app process, threads each ffmpeg may
+# use (0 lets ffmpeg decide) and the niceness the encodes run at
+POSTPROCESS_STAGE = os.environ.get("POSTPROCESS_STAGE", "pool").lower()
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", str(os.cpu_count() or 1)))
+# Finished downloads that may wait for an encode; when it is full, downloads
+# hold their slot until there is room, which pushes back on the download queue
+POSTPROCESS_QUEUE_SIZE = int(os.environ.get("POSTPROCESS_QUEUE_SIZE", str(2 * POSTPROCESS_WORKERS)))
+POSTPROCESS_THREADS = int(os.environ.get("POSTPROCESS_THREADS", "1"))
+POSTPROCESS_NICE = int(os.environ.get("POSTPROCESS_NICE", "10"))
+# Codecs that can be stream-copied into an MP4 container
+MP4_VIDEO_CODECS = ('avc1', 'h264', 'hev1', 'hvc1', 'hevc', 'av01')
+MP4_AUDIO_CODECS = ('mp4a', 'aac', 'mp3')
+
+# Job state backend shared by all workers: "sqlite" or "memory"
+JOB_STORE_BACKEND = os.environ.get("JOB_STORE_BACKEND", "sqlite").lower()
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", os.path.join(os.getcwd(), 'jobs.db'))
+# Seconds finished jobs are kept before being pruned
+JOB_RETENTION = int(os.environ.get("JOB_RETENTION", "3600"))
+
+# Longest time a /download_events stream stays open, in seconds
+PROGRESS_STREAM_TIMEOUT = int(os.environ.get("PROGRESS_STREAM_TIMEOUT", "3600"))
+
+# Minimum seconds between progress writes to the job store for one download
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get("PROGRESS_UPDATE_INTERVAL", "0.5"))
+
+# Direct streaming of single-file formats through /stream
+STREAM_MAX_CONCURRENT = int(os.environ.get("STREAM_MAX_CONCURRENT", "10"))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(256 * 1024)))
+
+# Offloading of file transfers to a fronting proxy: "none", "x-sendfile"
+# (Apache/lighttpd) or "x-accel" (nginx, with an internal location that
+# maps SENDFILE_ACCEL_PREFIX to ARTIFACT_CACHE_DIR)
+SENDFILE_MODE = os.environ.get("SENDFILE_MODE", "none").lower()
+SENDFILE_ACCEL_PREFIX = os.environ.get("SENDFILE_ACCEL_PREFIX", "/protected-cache/")
+# Seconds browsers and proxies may reuse a cached download without revalidating
+SERVE_MAX_AGE = int(os.environ.get("SERVE_MAX_AGE", "86400"))
+# Aggregate rate of files sent by /get_file in bytes per second (0 for no
+# limit), shared fairly between the clients currently downloading
+SERVE_RATE_LIMIT = int(os.environ.get("SERVE_RATE_LIMIT", "0"))
+
+# Temp directory janitor: how often it runs, how long files may stay,
+# the byte quota for TEMP_DIR, how long a served file is kept for resumes
+# and when an untouched .part/.ytdl leftover is considered abandoned
+TEMP_JANITOR_INTERVAL = int(os.environ.get("TEMP_JANITOR_INTERVAL", "60"))
+TEMP_MAX_AGE = int(os.environ.get("TEMP_MAX_AGE", "3600"))
+TEMP_MAX_BYTES = int(os.environ.get("TEMP_MAX_BYTES", str(5 * 1024 * 1024 * 1024)))
+TEMP_SERVED_GRACE = int(os.environ.get("TEMP_SERVED_GRACE", "300"))
+TEMP_PARTIAL_MAX_AGE = int(os.environ.get("TEMP_PARTIAL_MAX_AGE", "600"))
 
-# Dictionary to store download progress
-download_progress = {}
-download_status = {}
+# Batch (playlist, channel and URL list) downloads: items per batch,
+# downloads each batch may run at once, batches that may run at once and
+# the queue priority of batch items (interactive downloads use 0)
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", os.environ.get("DOWNLOAD_WORKERS", "3")))
+BATCH_MAX_ACTIVE = int(os.environ.get("BATCH_MAX_ACTIVE", "5"))
+BATCH_PRIORITY = int(os.environ.get("BATCH_PRIORITY", "10"))
+
+# Bulk metadata lookups through /bulk_info: URLs per request, lookups each
+# request runs at once and requests that may run at once
+BULK_INFO_MAX_URLS = int(os.environ.get("BULK_INFO_MAX_URLS", "500"))
+BULK_INFO_CONCURRENCY = int(os.environ.get("BULK_INFO_CONCURRENCY", os.environ.get("YTDLP_POOL_SIZE", "4")))
+BULK_INFO_MAX_ACTIVE = int(os.environ.get("BULK_INFO_MAX_ACTIVE", "2"))
+
+# /get_video_info bodies at least this large are gzip/brotli compressed when the
+# client accepts it, and the compression levels used
+INFO_COMPRESS_MIN_BYTES = int(os.environ.get("INFO_COMPRESS_MIN_BYTES", "1024"))
+INFO_GZIP_LEVEL = int(os.environ.get("INFO_GZIP_LEVEL", "6"))
+INFO_BROTLI_QUALITY = int(os.environ.get("INFO_BROTLI_QUALITY", "5"))
+
+# Persistent cache of completed downloads shared by all users
+ARTIFACT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", os.path.join(os.getcwd(), 'cache'))
+ARTIFACT_CACHE_MAX_BYTES = int(os.environ.get("ARTIFACT_CACHE_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+ARTIFACT_CACHE_POLICY = os.environ.get("ARTIFACT_CACHE_POLICY", "lru").lower()  # "lru" or "lfu"
+
+# Download scheduler: concurrent downloads, queued downloads and the
+# number of active plus queued downloads allowed per client
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "3"))
+DOWNLOAD_QUEUE_SIZE = int(os.environ.get("DOWNLOAD_QUEUE_SIZE", "50"))
+DOWNLOAD_PER_CLIENT = int(os.environ.get("DOWNLOAD_PER_CLIENT", "3"))
+
+# Accelerated downloads: "fragments" fetches DASH/HLS fragments over parallel
+# connections, "aria2c" also splits single-file downloads across connections
+# with aria2c, "auto" uses aria2c when it is installed and "off" keeps
+# yt-dlp's single connection. Connections one download may open and
+# connections all running downloads may share.
+DOWNLOAD_ACCELERATION = os.environ.get("DOWNLOAD_ACCELERATION", "auto").lower()
+DOWNLOAD_CONNECTIONS_PER_JOB = int(os.environ.get("DOWNLOAD_CONNECTIONS_PER_JOB", "4"))
+DOWNLOAD_MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", "16"))
+# Aggregate rate of downloads from YouTube in bytes per second (0 for no
+# limit), shared fairly between the clients with running downloads
+DOWNLOAD_RATE_LIMIT = int(os.environ.get("DOWNLOAD_RATE_LIMIT", "0"))
+
+# Prefix of the line yt-dlp prints with the final output path of a download
+OUTPUT_LINE_PREFIX = '[output] '
+
+# Machine-readable progress lines requested with --progress-template. Download
+# lines carry the part being downloaded (format ID, codecs, all requested
+# parts) and the progress fields, tab separated; postprocessing lines carry
+# the postprocessor name.
+PROGRESS_LINE_PREFIX = '[progress] '
+DOWNLOAD_PROGRESS_TEMPLATE = (
+    PROGRESS_LINE_PREFIX + '%(info.format_id)s\t%(info.vcodec)s\t%(info.acodec)s\t'
+    '%(info.requested_formats.:.format_id)j\t'
+    '%(progress.{status,downloaded_bytes,total_bytes,total_bytes_estimate,speed,eta,fragment_index,fragment_count})j'
+)
+POSTPROCESS_PROGRESS_TEMPLATE = PROGRESS_LINE_PREFIX + '%(progress.{status,postprocessor})j'
+# Postprocessors that merge, convert or encode, by the name yt-dlp reports
+# (PostProcessor.pp_key(): the class name without "FFmpeg" and "PP"), and the
+# phase each one reports. Others (MoveFiles runs for every download, fixups,
+# tagging) are bookkeeping and neither change the phase nor count as
+# postprocessing time
+POSTPROCESS_PHASES = {
+    'Merger': 'merge',
+    'VideoConvertor': 'postprocess',
+    'VideoRemuxer': 'postprocess',
+    'ExtractAudio': 'postprocess',
+    'EmbedThumbnail': 'postprocess',
+}
+
+# In-flight downloads keyed by (video_id, format_id) so identical concurrent
+# requests share a single yt-dlp process and its progress
+inflight_downloads = {}
+inflight_downloads_lock = threading.Lock()
 
 # Ensure download directories exist
 DOWNLOAD_DIR = os.path.join(os.getcwd(), 'downloads')
@@ -29,10 +275,371 @@ TEMP_DIR = os.path.join(os.getcwd(), 'temp_downloads')
 SAMPLES_DIR = os.path.join(os.getcwd(), 'samples')
 
 # Create necessary directories
-for directory in [DOWNLOAD_DIR, TEMP_DIR, SAMPLES_DIR]:
+for directory in [DOWNLOAD_DIR, TEMP_DIR, SAMPLES_DIR, ARTIFACT_CACHE_DIR]:
     if not os.path.exists(directory):
         os.makedirs(directory)
 
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Counter:
+    """Monotonically increasing count, optionally split by labels"""
+    
+    type = 'counter'
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labels, key, value) for key, value in sorted(self._values.items())]
+
+class Histogram:
+    """Distribution of observed values (in seconds) over fixed buckets"""
+    
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+    
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+    
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, '')) for label in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def samples(self):
+        result = []
+        names = self.labels + ('le',)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    result.append((f"{self.name}_bucket", names, key + (repr(float(bound)),), bucket_count))
+                result.append((f"{self.name}_bucket", names, key + ('+Inf',), count))
+                result.append((f"{self.name}_sum", self.labels, key, total))
+                result.append((f"{self.name}_count", self.labels, key, count))
+        return result
+
+class CallbackMetric:
+    """Metric whose values are read from `collect()` at scrape time.
+    
+    `collect` returns a number, or a dict of label values (a tuple, or a
+    plain value for a single label) to numbers.
+    """
+    
+    def __init__(self, name, help_text, metric_type, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.type = metric_type
+        self.labels = tuple(labels)
+        self._collect = collect
+    
+    def samples(self):
+        values = self._collect()
+        if not isinstance(values, dict):
+            return [(self.name, (), (), values)]
+        return [(self.name, self.labels, key if isinstance(key, tuple) else (key,), value)
+                for key, value in sorted(values.items())]
+
+class MetricsRegistry:
+    """Process-local metrics rendered in the Prometheus text exposition format"""
+    
+    def __init__(self):
+        self._metrics = []
+    
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+    
+    def histogram(self, name, help_text, labels=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+    
+    def gauge_callback(self, name, help_text, collect, labels=()):
+        return self._register(CallbackMetric(name, help_text, 'gauge', collect, labels))
+    
+    def counter_callback(self, name, help_text, collect, labels=()):
+        return self._register(CallbackMetric(name, help_text, 'counter', collect, labels))
+    
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.error(f"Failed to collect metric {metric.name}: {str(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, label_names, label_values, value in samples:
+                lines.append(f"{name}{_format_labels(label_names, label_values)} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+info_extraction_seconds = metrics.histogram(
+    'ytdl_info_extraction_seconds', 'Time to extract video metadata with yt-dlp', ['engine'])
+queue_wait_seconds = metrics.histogram(
+    'ytdl_queue_wait_seconds', 'Time downloads wait in the queue for a worker')
+download_seconds = metrics.histogram(
+    'ytdl_download_seconds', 'Time yt-dlp spends transferring media for a successful download')
+postprocess_seconds = metrics.histogram(
+    'ytdl_postprocess_seconds', 'Time spent merging or converting a successful download')
+postprocess_wait_seconds = metrics.histogram(
+    'ytdl_postprocess_wait_seconds', 'Time downloads wait for a worker of the postprocessing pool')
+serve_seconds = metrics.histogram(
+    'ytdl_serve_seconds', 'Time to send a file from /get_file, until the transfer ends', ['mode'])
+downloads_total = metrics.counter(
+    'ytdl_downloads_total', 'Finished downloads by final status', ['status'])
+fallback_served_total = metrics.counter(
+    'ytdl_fallback_served_total', 'Sample or generated files served because no download was found', ['kind'])
+subprocess_failures_total = metrics.counter(
+    'ytdl_subprocess_failures_total', 'Failed yt-dlp runs by operation and error class', ['operation', 'error'])
+
+# Substrings of yt-dlp error messages mapped to a coarse error class, checked in order
+YTDLP_ERROR_CLASSES = (
+    ('timeout', ('timed out', 'timeout')),
+    ('rate_limited', ('http error 429', 'too many requests', 'sign in to confirm')),
+    ('unavailable', ('video unavailable', 'private video', 'has been removed', 'not available', 'members-only')),
+    ('format', ('requested format', 'no video formats')),
+    ('postprocessing', ('ffmpeg', 'ffprobe', 'postprocessing')),
+    ('network', ('unable to download', 'failed to resolve', 'connection', 'http error', 'network')),
+)
+
+def classify_ytdlp_error(message):
+    """Coarse class of a yt-dlp error message, used as a metrics label"""
+    text = (message or '').lower()
+    for error_class, patterns in YTDLP_ERROR_CLASSES:
+        if any(pattern in text for pattern in patterns):
+            return error_class
+    return 'other'
+
+class JobStore(ABC):
+    """Interface for download job state shared across worker processes.
+    
+    A job is a flat dict of JSON-serializable fields (status, progress,
+    artifact_key, ...) addressed by its download ID. Backends must make
+    `update` a merge so concurrent writers of different fields do not
+    clobber each other; a Redis implementation maps naturally onto HSET,
+    HGETALL and a sorted set of update times for pruning.
+    """
+    
+    # Statuses after which a job no longer changes
+    FINISHED = ('completed', 'completed_fallback', 'error')
+    
+    @abstractmethod
+    def get(self, job_id):
+        """Return a copy of the job's fields, or None if it is unknown"""
+    
+    @abstractmethod
+    def update(self, job_id, **fields):
+        """Merge `fields` into the job, creating it if needed"""
+    
+    @abstractmethod
+    def delete(self, job_id):
+        """Forget the job"""
+    
+    @abstractmethod
+    def prune(self, max_age):
+        """Remove finished jobs not updated in the last `max_age` seconds"""
+    
+    @classmethod
+    def is_finished(cls, status):
+        return bool(status) and status.split(':', 1)[0] in cls.FINISHED
+
+class MemoryJobStore(JobStore):
+    """Process-local job store, only suitable for a single worker"""
+    
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+    
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.setdefault(job_id, {'created_at': time.time()})
+            job.update(fields)
+            job['updated_at'] = time.time()
+    
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+    
+    def prune(self, max_age):
+        cutoff = time.time() - max_age
+        with self._lock:
+            stale = [
+                job_id for job_id, job in self._jobs.items()
+                if job['updated_at'] < cutoff and self.is_finished(job.get('status'))
+            ]
+            for job_id in stale:
+                del self._jobs[job_id]
+        return len(stale)
+
+class SQLiteJobStore(JobStore):
+    """Job store in a SQLite database in WAL mode, shared by all local workers"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT, data TEXT NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)")
+    
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, job_id):
+        row = self._conn().execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def update(self, job_id, **fields):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            job = json.loads(row[0]) if row else {'created_at': now}
+            job.update(fields)
+            job['updated_at'] = now
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, data, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, job.get('status'), json.dumps(job), job['created_at'], now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    
+    def delete(self, job_id):
+        self._conn().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+    
+    def prune(self, max_age):
+        cutoff = time.time() - max_age
+        conditions = " OR ".join(["status = ?", "status LIKE ?"] * len(self.FINISHED))
+        params = []
+        for status in self.FINISHED:
+            params.extend([status, f"{status}:%"])
+        cursor = self._conn().execute(
+            f"DELETE FROM jobs WHERE updated_at < ? AND ({conditions})", [cutoff] + params
+        )
+        return cursor.rowcount
+
+def create_job_store():
+    """Create the job store configured by JOB_STORE_BACKEND"""
+    if JOB_STORE_BACKEND == 'memory':
+        return MemoryJobStore()
+    try:
+        return SQLiteJobStore(JOB_STORE_PATH)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open job store at {JOB_STORE_PATH}, using memory: {str(e)}")
+        return MemoryJobStore()
+
+job_store = create_job_store()
+
+class JobEvents:
+    """Wakes progress streams in this process when a job they follow changes.
+    
+    Each job has a version counter that is bumped on every update. Streams
+    for jobs running in another worker still see changes, just on their
+    next wait timeout instead of immediately.
+    """
+    
+    def __init__(self):
+        self._versions = {}
+        self._cond = threading.Condition()
+        self._listeners = []
+    
+    def add_listener(self, callback):
+        """Also call `callback(job_id)` on every change, e.g. to wake an event loop"""
+        self._listeners.append(callback)
+    
+    def version(self, job_id):
+        with self._cond:
+            return self._versions.get(job_id, 0)
+    
+    def notify(self, job_id, finished=False):
+        with self._cond:
+            if finished:
+                # Waiters see the version change to 0 and read the final state
+                self._versions.pop(job_id, None)
+            else:
+                self._versions[job_id] = self._versions.get(job_id, 0) + 1
+            self._cond.notify_all()
+        for callback in self._listeners:
+            callback(job_id)
+    
+    def wait(self, job_id, version, timeout):
+        """Block until the job's version differs from `version` or the timeout expires"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._versions.get(job_id, 0) != version, timeout)
+            return self._versions.get(job_id, 0)
+
+job_events = JobEvents()
+
+def update_job(job_id, **fields):
+    """Update a job in the store and wake any progress streams following it"""
+    job_store.update(job_id, **fields)
+    job_events.notify(job_id, finished=JobStore.is_finished(fields.get('status')))
+
+_last_job_prune = 0
+
+def prune_jobs():
+    """Drop finished jobs past the retention window, at most once a minute"""
+    global _last_job_prune
+    now = time.monotonic()
+    if now - _last_job_prune < 60:
+        return
+    _last_job_prune = now
+    try:
+        removed = job_store.prune(JOB_RETENTION)
+        if removed:
+            logger.info(f"Pruned {removed} finished jobs")
+    except Exception as e:
+        logger.error(f"Error pruning jobs: {str(e)}")
+
 def is_valid_youtube_url(url):
     """Check if a URL is a valid YouTube video URL"""
     youtube_regex = r'(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})'
@@ -67,482 +674,1727 @@ def extract_video_id(url):
             
     return None
 
+def info_command(url):
+    """Command line for a one-off `yt-dlp -J` metadata lookup"""
+    return [
+        'yt-dlp', 
+        '--no-warnings',
+        '-J',  # Output JSON
+        url
+    ]
+
+def _extract_info_subprocess(url):
+    """Run a one-off `yt-dlp -J` process and return the parsed JSON info"""
+    cmd = info_command(url)
+    info_logger.debug(f"Running command: {' '.join(cmd)}")
+    
+    process = subprocess.Popen(
+        cmd, 
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True
+    )
+    
+    stdout, stderr = process.communicate(timeout=YTDLP_INFO_TIMEOUT)
+    
+    if process.returncode != 0:
+        info_logger.error(f"yt-dlp error: {stderr}")
+        # If there's a specific error message, log it
+        error_msg = stderr.strip() if stderr else "Unknown error"
+        raise Exception(f"yt-dlp error: {error_msg}")
+    
+    try:
+        return json.loads(stdout)
+    except json.JSONDecodeError:
+        info_logger.error(f"Failed to parse yt-dlp JSON output: {stdout}")
+        raise
+
+class YtdlpInfoPool:
+    """A small pool of warm yt_dlp.YoutubeDL instances for metadata extraction.
+    
+    Creating a YoutubeDL object loads all extractors, which is the expensive
+    part of `yt-dlp -J`. Instances are created lazily, reused across requests
+    and handed out one caller at a time since YoutubeDL is not thread-safe.
+    """
+    
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def _new_instance(self):
+        return load_yt_dlp().YoutubeDL({
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'noplaylist': True,
+            'socket_timeout': YTDLP_INFO_TIMEOUT,
+        })
+    
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._new_instance()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=YTDLP_INFO_TIMEOUT)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired('yt_dlp.YoutubeDL', YTDLP_INFO_TIMEOUT)
+    
+    def extract_info(self, url):
+        ydl = self._acquire()
+        try:
+            info = ydl.extract_info(url, download=False)
+            # Drop internal, non-serializable fields so the result matches `-J`
+            return ydl.sanitize_info(info)
+        finally:
+            self._idle.put(ydl)
+
+_yt_dlp_module = False  # Not imported yet
+
+def load_yt_dlp():
+    """Import yt_dlp on first use, returning None when only the executable is installed.
+    
+    Loading yt_dlp takes a noticeable share of the app's import time, and
+    the subprocess engine never needs it.
+    """
+    global _yt_dlp_module
+    if _yt_dlp_module is False:
+        try:
+            import yt_dlp
+            _yt_dlp_module = yt_dlp
+        except ImportError:  # Fall back to the yt-dlp executable
+            _yt_dlp_module = None
+    return _yt_dlp_module
+
+_info_pool = None
+_info_pool_lock = threading.Lock()
+
+def get_info_pool():
+    """Return the process-wide YoutubeDL pool, creating it on first use"""
+    global _info_pool
+    if _info_pool is None:
+        with _info_pool_lock:
+            if _info_pool is None:
+                _info_pool = YtdlpInfoPool(YTDLP_POOL_SIZE)
+    return _info_pool
+
+def extract_raw_video_info(url):
+    """Return the raw yt-dlp info dict for a URL using the configured engine"""
+    yt_dlp = load_yt_dlp() if YTDLP_ENGINE == 'inprocess' else None
+    engine = 'inprocess' if yt_dlp is not None else 'subprocess'
+    started = time.monotonic()
+    try:
+        if engine == 'inprocess':
+            try:
+                return get_info_pool().extract_info(url)
+            except yt_dlp.utils.DownloadError as e:
+                raise Exception(f"yt-dlp error: {str(e)}")
+        if YTDLP_ENGINE == 'inprocess':
+            info_logger.warning("yt_dlp module not available, falling back to subprocess engine")
+        return _extract_info_subprocess(url)
+    except subprocess.TimeoutExpired:
+        subprocess_failures_total.inc(operation='info', error='timeout')
+        raise
+    except Exception as e:
+        subprocess_failures_total.inc(operation='info', error=classify_ytdlp_error(str(e)))
+        raise
+    finally:
+        info_extraction_seconds.observe(time.monotonic() - started, engine=engine)
+
+class _FlightCall:
+    """State shared by the callers of one in-flight SingleFlight call"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into a single execution.
+    
+    The first caller for a key runs the function; callers arriving while it
+    is still running wait for it and receive the same result or exception.
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+    
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+info_flight = SingleFlight()
+
+class MetadataCache:
+    """Thread-safe TTL + LRU cache for video info, keyed by YouTube video ID.
+    
+    Entries are bounded both by count and by their approximate serialized
+    size. Cached values are shared between callers and must not be mutated.
+    """
+    
+    def __init__(self, ttl, max_entries, max_bytes):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # video_id -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+    
+    def get(self, video_id):
+        if not self.enabled or not video_id:
+            return None
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, value = entry
+            if expires_at < time.monotonic():
+                self._remove(video_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(video_id)
+            self.hits += 1
+            return value
+    
+    def set(self, video_id, value):
+        if not self.enabled or not video_id:
+            return
+        size = len(json.dumps(value, separators=(',', ':')))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if video_id in self._entries:
+                self._remove(video_id)
+            self._entries[video_id] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+    
+    def _remove(self, video_id):
+        _, size, _ = self._entries.pop(video_id)
+        self._bytes -= size
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+metadata_cache = MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_MAX_BYTES)
+# Compact per-format codec table used to plan postprocessing of downloads
+format_table_cache = MetadataCache(METADATA_CACHE_TTL, METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_MAX_BYTES)
+
+def compact_formats(info):
+    """The fields of yt-dlp's format list needed to predict format selection"""
+    return [
+        {
+            'format_id': fmt.get('format_id'),
+            'ext': fmt.get('ext'),
+            'vcodec': fmt.get('vcodec'),
+            'acodec': fmt.get('acodec'),
+        }
+        for fmt in info.get('formats', [])
+    ]
+
+def resolve_video_info(url):
+    """Video info from the metadata cache or yt-dlp, raising when extraction fails"""
+    cached = metadata_cache.get(extract_video_id(url))
+    if cached is not None:
+        info_logger.debug(f"Metadata cache hit for {url}")
+        return cached
+    
+    # Concurrent lookups of the same video share one extraction
+    info = info_flight.do(extract_video_id(url) or url, extract_raw_video_info, url)
+    return build_video_info(url, info)
+
 def get_video_info_with_ytdlp(url):
     """Use yt-dlp to get information about a YouTube video"""
-    logger.info(f"Getting video information for {url} with yt-dlp")
+    info_logger.debug(f"Getting video information for {url} with yt-dlp ({YTDLP_ENGINE})")
     
     try:
-        # Create a unique ID for this request
-        video_id = extract_video_id(url) or str(uuid.uuid4())[:8]
-        
-        # Run yt-dlp command to get video info in JSON format
-        cmd = [
-            'yt-dlp', 
-            '--no-warnings',
-            '-J',  # Output JSON
-            url
-        ]
-        logger.info(f"Running command: {' '.join(cmd)}")
+        return resolve_video_info(url)
+    
+    except subprocess.TimeoutExpired:
+        info_logger.error("yt-dlp process timed out")
+        raise Exception("Video processing timed out")
         
-        process = subprocess.Popen(
-            cmd, 
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
+    except json.JSONDecodeError:
+        raise Exception("Failed to parse video information")
         
-        stdout, stderr = process.communicate(timeout=30)
-        
-        if process.returncode != 0:
-            logger.error(f"yt-dlp error: {stderr}")
-            # If there's a specific error message, log it
-            error_msg = stderr.strip() if stderr else "Unknown error"
-            raise Exception(f"yt-dlp error: {error_msg}")
-        
-        # Parse the JSON output
-        info = json.loads(stdout)
-        
-        # Extract the relevant information
-        title = info.get('title', f'YouTube Video {video_id}')
-        uploader = info.get('uploader', 'Unknown')
-        thumbnail = info.get('thumbnail', f'https://img.youtube.com/vi/{video_id}/hqdefault.jpg')
-        
-        # Extract streams (formats)
-        formats = info.get('formats', [])
-        stream_data = []
-        resolutions = set()
-        
-        # First add the highest quality option
-        stream_data.append({
-            'format_id': 'bestvideo+bestaudio',
-            'resolution': 'Highest Quality (Combined Format)',
-            'ext': 'mp4',
-            'filesize_approx': 100 * 1024 * 1024,  # Approximate size for high quality
-            'type': 'video',
-            'is_highest': True
-        })
+    except Exception as e:
+        info_logger.error(f"Error getting video info: {str(e)}")
+        return fallback_video_info(url)
+
+def codec_family(codec):
+    """'avc1.64001F' -> 'avc1', so formats differing only in codec profile dedupe together"""
+    return (codec or 'unknown').split('.')[0]
+
+def known_size(fmt):
+    return fmt.get('filesize') or fmt.get('filesize_approx')
+
+def stream_size(fmt):
+    """The filesize fields of a stream entry, omitted when yt-dlp doesn't know them"""
+    if fmt.get('filesize'):
+        return {'filesize': fmt['filesize']}
+    if fmt.get('filesize_approx'):
+        return {'filesize_approx': fmt['filesize_approx']}
+    return {}
+
+def build_format_table(formats):
+    """Pick the streams listed by /get_video_info from yt-dlp's formats in a single pass.
+    
+    yt-dlp sorts formats worst to best, so a later format always wins: progressive
+    formats are deduped by resolution and codec family, audio-only formats by
+    bitrate and codec family, and the last match of each selector is the format
+    yt-dlp would pick for it, which is what the combined options are sized from.
+    """
+    progressive = {}
+    audio = {}
+    best_video = best_audio = best_m4a = best_single = None
+    
+    for fmt in formats:
+        has_video = fmt.get('vcodec') != 'none'
+        has_audio = fmt.get('acodec') != 'none'
         
-        # Add 'best' format as second option which will download best single file
-        stream_data.append({
-            'format_id': 'best',
-            'resolution': 'High Quality (Single File)',
-            'ext': 'mp4',
-            'filesize_approx': 50 * 1024 * 1024,  # Approximate size for medium quality
+        if has_video and has_audio:
+            if fmt.get('height'):
+                progressive[(fmt['height'], codec_family(fmt.get('vcodec')))] = fmt
+            if best_single is None or fmt.get('ext') == 'mp4' or best_single.get('ext') != 'mp4':
+                best_single = fmt
+        elif has_video:
+            if fmt.get('ext') == 'mp4':
+                best_video = fmt
+        elif has_audio:
+            best_audio = fmt
+            if fmt.get('ext') == 'm4a':
+                best_m4a = fmt
+            if fmt.get('abr'):
+                audio[(round(fmt['abr']), codec_family(fmt.get('acodec')))] = fmt
+    
+    # bestvideo[ext=mp4]+bestaudio[ext=m4a] is the sum of its two parts, else best[ext=mp4]/best
+    if best_video and best_m4a and known_size(best_video) and known_size(best_m4a):
+        combined_size = {'filesize_approx': known_size(best_video) + known_size(best_m4a)}
+    else:
+        combined_size = stream_size(best_single or {})
+    
+    streams = []
+    for (height, _), fmt in sorted(progressive.items(), key=lambda item: item[0][0], reverse=True):
+        streams.append({
+            'format_id': fmt.get('format_id', 'unknown'),
+            'resolution': f"{height}p",
+            'ext': fmt.get('ext', 'mp4'),
+            **stream_size(fmt),
+            'width': fmt.get('width') or 0,
+            'height': height,
+            'vcodec': codec_family(fmt.get('vcodec')),
             'type': 'video',
-            'is_highest': False
+            # Single files with audio and video can be streamed while downloading
+            'streamable': True
         })
-        
-        # Include audio-only options
-        audio_formats = []
-        for fmt in formats:
-            # Find audio-only formats
-            if fmt.get('vcodec') == 'none' and fmt.get('acodec') != 'none':
-                # Only add unique audio formats based on quality
-                audio_bitrate = fmt.get('abr', 0)
-                if audio_bitrate:
-                    audio_formats.append({
-                        'format_id': fmt.get('format_id', 'unknown'),
-                        'resolution': f"Audio {audio_bitrate}kbps",
-                        'ext': fmt.get('ext', 'mp3'),
-                        'filesize': fmt.get('filesize', 0),
-                        'filesize_approx': fmt.get('filesize_approx', 5 * 1024 * 1024),
-                        'abr': audio_bitrate,
-                        'type': 'audio'
-                    })
-        
-        # Sort audio formats by bitrate (highest first) and add the best one
-        if audio_formats:
-            audio_formats.sort(key=lambda x: x.get('abr', 0), reverse=True)
-            # Add best audio option at the top
-            stream_data.append({
-                'format_id': 'bestaudio',
-                'resolution': 'Best Audio Only',
-                'ext': 'mp3',
-                'filesize_approx': 10 * 1024 * 1024,
-                'type': 'audio',
-                'is_best_audio': True
+    
+    streams.append({
+        'format_id': 'bestvideo+bestaudio',
+        'resolution': 'Highest Quality (Combined Format)',
+        'ext': 'mp4',
+        **combined_size,
+        'type': 'video',
+        'is_highest': True
+    })
+    streams.append({
+        'format_id': 'best',
+        'resolution': 'High Quality (Single File)',
+        'ext': 'mp4',
+        **stream_size(best_single or {}),
+        'type': 'video',
+        'streamable': True
+    })
+    
+    if audio:
+        streams.append({
+            'format_id': 'bestaudio',
+            'resolution': 'Best Audio Only',
+            'ext': 'mp3',
+            **stream_size(best_audio),
+            'type': 'audio',
+            'is_best_audio': True
+        })
+        # Top 2 audio formats by bitrate
+        for (abr, _), fmt in sorted(audio.items(), key=lambda item: item[1]['abr'], reverse=True)[:2]:
+            streams.append({
+                'format_id': fmt.get('format_id', 'unknown'),
+                'resolution': f"Audio {abr}kbps",
+                'ext': fmt.get('ext', 'mp3'),
+                **stream_size(fmt),
+                'abr': fmt['abr'],
+                'type': 'audio'
             })
-            # Add top 2 audio formats
-            for audio_fmt in audio_formats[:2]:
-                stream_data.append(audio_fmt)
-
-        # Filter for video streams with audio (progressive) 
-        for fmt in formats:
-            # Check if this is a video format with audio
-            if fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none':
-                res = fmt.get('height', 0)
-                if res and str(res) not in resolutions:
-                    resolution = f"{res}p"
-                    stream_data.append({
-                        'format_id': fmt.get('format_id', 'unknown'),
-                        'resolution': resolution,
-                        'ext': fmt.get('ext', 'mp4'),
-                        'filesize': fmt.get('filesize', 0),
-                        'filesize_approx': fmt.get('filesize_approx', 10 * 1024 * 1024),
-                        'width': fmt.get('width', 0),
-                        'height': fmt.get('height', 0),
-                        'type': 'video'
-                    })
-                    resolutions.add(str(res))
-        
-        # Sort formats by resolution (height) in descending order
-        stream_data.sort(key=lambda x: x.get('height', 0), reverse=True)
-        
-        # If no streams found, use fallback streams
-        if not stream_data:
-            logger.warning("No suitable formats found, using fallback data")
-            stream_data = [
-                {
-                    'format_id': '22', 
-                    'resolution': '720p',
-                    'ext': 'mp4',
-                    'filesize_approx': 20 * 1024 * 1024,
-                    'width': 1280,
-                    'height': 720
-                },
-                {
-                    'format_id': '18',
-                    'resolution': '360p',
-                    'ext': 'mp4',
-                    'filesize_approx': 10 * 1024 * 1024,
-                    'width': 640,
-                    'height': 360
-                },
-                {
-                    'format_id': 'bestvideo+bestaudio',
-                    'resolution': 'Highest Quality (Combined Format)',
-                    'ext': 'mp4',
-                    'filesize_approx': 100 * 1024 * 1024,
-                    'width': 1920,
-                    'height': 1080,
-                    'type': 'video',
-                    'is_highest': True
-                },
-                {
-                    'format_id': 'best',
-                    'resolution': 'High Quality (Single File)',
-                    'ext': 'mp4',
-                    'filesize_approx': 50 * 1024 * 1024,
-                    'width': 1920,
-                    'height': 1080,
-                    'type': 'video'
-                }
-            ]
-        
-        # Ensure we always have highest quality options
-        has_highest = any(s.get('format_id') == 'bestvideo+bestaudio' for s in stream_data)
-        has_best = any(s.get('format_id') == 'best' for s in stream_data)
-        
-        if not has_highest and stream_data:
-            # Add a highest quality option as the first choice
-            stream_data.insert(0, {
+    
+    return streams
+
+def build_video_info(url, info):
+    """Turn a raw yt-dlp info dict into the response for /get_video_info and cache it"""
+    # Create a unique ID for this request
+    video_id = extract_video_id(url) or str(uuid.uuid4())[:8]
+    format_table_cache.set(extract_video_id(url), compact_formats(info))
+    
+    video_info = {
+        'title': info.get('title', f'YouTube Video {video_id}'),
+        'author': info.get('uploader', 'Unknown'),
+        'thumbnail_url': info.get('thumbnail', f'https://img.youtube.com/vi/{video_id}/hqdefault.jpg'),
+        'streams': build_format_table(info.get('formats', [])),
+        'id': video_id
+    }
+    # Only real extraction results are cached, never fallback_video_info()
+    metadata_cache.set(extract_video_id(url), video_info)
+    return video_info
+
+def info_response_parts(video_info, accept_encoding=None, if_none_match=None):
+    """Status, body and headers of a /get_video_info response.
+    
+    The body is compact JSON tagged with an ETag of its content, so a client
+    revalidating with If-None-Match gets a bodyless 304. Large bodies are brotli
+    or gzip compressed when the client's Accept-Encoding allows it.
+    """
+    body = json.dumps(video_info, separators=(',', ':')).encode('utf-8')
+    digest = hashlib.sha1(body).hexdigest()[:20]
+    # Weak, since the same content is also served compressed
+    headers = {'ETag': f'W/"{digest}"', 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    
+    if if_none_match and parse_etags(if_none_match).contains_weak(digest):
+        return 304, b'', headers
+    
+    headers['Content-Type'] = 'application/json'
+    if len(body) >= INFO_COMPRESS_MIN_BYTES and accept_encoding:
+        accepted = parse_accept_header(accept_encoding)
+        if brotli is not None and accepted['br']:
+            body = brotli.compress(body, quality=INFO_BROTLI_QUALITY)
+            headers['Content-Encoding'] = 'br'
+        elif accepted['gzip']:
+            body = gzip.compress(body, compresslevel=INFO_GZIP_LEVEL, mtime=0)
+            headers['Content-Encoding'] = 'gzip'
+    return 200, body, headers
+
+def fallback_video_info(url):
+    """Placeholder video info used when extraction fails, so the UI still works"""
+    fallback_id = extract_video_id(url) or "unknown"
+    return {
+        'title': f"YouTube Video {fallback_id}",
+        'author': "Unknown",
+        'thumbnail_url': f"https://img.youtube.com/vi/{fallback_id}/hqdefault.jpg",
+        'streams': [
+            {
                 'format_id': 'bestvideo+bestaudio',
                 'resolution': 'Highest Quality (Combined Format)',
                 'ext': 'mp4',
                 'filesize_approx': 100 * 1024 * 1024,
-                'width': stream_data[0].get('width', 1920),
-                'height': stream_data[0].get('height', 1080),
+                'width': 1920,
+                'height': 1080,
                 'type': 'video',
                 'is_highest': True
-            })
-        
-        if not has_best and stream_data:
-            # Add a high quality option as the second choice
-            stream_data.insert(1, {
+            },
+            {
                 'format_id': 'best',
                 'resolution': 'High Quality (Single File)',
                 'ext': 'mp4',
                 'filesize_approx': 50 * 1024 * 1024,
-                'width': stream_data[0].get('width', 1920),
-                'height': stream_data[0].get('height', 1080),
+                'width': 1920,
+                'height': 1080,
                 'type': 'video'
-            })
+            },
+            {
+                'format_id': '22', 
+                'resolution': '720p',
+                'ext': 'mp4',
+                'filesize_approx': 20 * 1024 * 1024,
+                'width': 1280,
+                'height': 720
+            },
+            {
+                'format_id': '18',
+                'resolution': '360p',
+                'ext': 'mp4',
+                'filesize_approx': 10 * 1024 * 1024,
+                'width': 640,
+                'height': 360
+            }
+        ],
+        'id': fallback_id
+    }
+
+def is_audio_format(format_id):
+    """Check whether a requested format ID asks for an audio-only download"""
+    return format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
+
+def build_format_args(format_id, merge_format='mp4'):
+    """Return the yt-dlp format selection and postprocessing arguments for a format ID"""
+    # Special handling for audio-only downloads
+    if is_audio_format(format_id):
+        return [
+            '-f', 'bestaudio',
+            '-x',  # Extract audio
+            '--audio-format', 'mp3',  # Convert to mp3
+            '--audio-quality', '0',  # Best audio quality
+            '--embed-thumbnail',  # Add thumbnail to audio file when possible
+            '--add-metadata',     # Add metadata information
+            '--postprocessor-args', '-id3v2_version 3',  # Ensure compatibility
+        ]
+    elif format_id == 'bestvideo+bestaudio':
+        # For highest quality, merge best video and audio
+        # Explicitly request best video and best audio and merge them
+        return [
+            '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
+            '--merge-output-format', merge_format,
+        ]
+    elif format_id == 'best' or 'best' in format_id.lower():
+        # Fallback for best available single file
+        return [
+            '-f', 'best[ext=mp4]/best',
+        ]
+    # Standard format selection
+    return ['-f', format_id]
+
+def target_container(format_id):
+    """Container the output of a format ID must end up in, or None to keep yt-dlp's choice"""
+    if is_audio_format(format_id):
+        return None
+    if format_id == 'bestvideo+bestaudio' or format_id == 'best' or 'best' in format_id.lower():
+        return 'mp4'
+    return None
+
+def _codec_name(codec):
+    return (codec or 'none').split('.')[0].lower()
+
+def select_output_formats(formats, format_id):
+    """Predict which formats yt-dlp will pick for our selectors and the resulting container.
+    
+    `formats` is yt-dlp's list, ordered from worst to best. Returns
+    (container_ext, [selected formats]) or None if nothing matches.
+    """
+    def best(predicate):
+        matches = [f for f in formats if predicate(f)]
+        return matches[-1] if matches else None
+    
+    def has_video(f):
+        return _codec_name(f.get('vcodec')) != 'none'
+    
+    def has_audio(f):
+        return _codec_name(f.get('acodec')) != 'none'
+    
+    if format_id == 'bestvideo+bestaudio':
+        # bestvideo[ext=mp4]+bestaudio[ext=m4a] is merged into mp4 by yt-dlp
+        video = best(lambda f: has_video(f) and not has_audio(f) and f.get('ext') == 'mp4')
+        audio = best(lambda f: has_audio(f) and not has_video(f) and f.get('ext') == 'm4a')
+        if video and audio:
+            return 'mp4', [video, audio]
+    
+    # best[ext=mp4]/best: a single file containing both audio and video
+    single = best(lambda f: has_video(f) and has_audio(f) and f.get('ext') == 'mp4')
+    if single is None:
+        single = best(lambda f: has_video(f) and has_audio(f))
+    if single is None:
+        return None
+    return single.get('ext'), [single]
+
+def plan_postprocessing(url, format_id):
+    """Choose how to get a download into its target container.
+    
+    Returns extra yt-dlp arguments: nothing when the selected formats already
+    produce the target container, a stream-copy remux when their codecs fit
+    the target, and a full re-encode only when they do not.
+    """
+    container = target_container(format_id)
+    if container is None:
+        return []
+    
+    recode = ['--recode-video', container]
+    remux = ['--remux-video', container]
+    if POSTPROCESS_MODE == 'recode':
+        return recode
+    if POSTPROCESS_MODE == 'remux':
+        return remux
+    
+    video_id = extract_video_id(url)
+    formats = format_table_cache.get(video_id)
+    if formats is None:
+        try:
+            info = info_flight.do(video_id or url, extract_raw_video_info, url)
+            formats = compact_formats(info)
+            format_table_cache.set(video_id, formats)
+        except Exception as e:
+            download_logger.warning(f"No format information for {url}, re-encoding to be safe: {str(e)}")
+            return recode
+    
+    selection = select_output_formats(formats, format_id)
+    if selection is None:
+        return recode
+    ext, selected = selection
+    
+    codecs_fit = all(
+        _codec_name(f.get('vcodec')) in ('none',) + MP4_VIDEO_CODECS
+        and _codec_name(f.get('acodec')) in ('none',) + MP4_AUDIO_CODECS
+        for f in selected
+    )
+    if not codecs_fit:
+        plan = recode
+    elif ext == container:
+        plan = []
+    else:
+        plan = remux
+    download_logger.debug(f"Postprocessing plan for {url} ({format_id}): {' '.join(plan) or 'none needed'}")
+    return plan
+
+def plan_stages(url, format_id):
+    """Split a download between the network stage and the postprocessing pool.
+    
+    Returns (yt-dlp arguments, encode) where encode is the extension the
+    postprocessing pool converts the download to, or None when yt-dlp
+    finishes the file itself. Stream copies (merging, remuxing, tagging) are
+    cheap and stay with yt-dlp; only transcodes move to the pool.
+    """
+    args = build_format_args(format_id)
+    if POSTPROCESS_STAGE != 'pool':
+        return args + plan_postprocessing(url, format_id), None
+    if is_audio_format(format_id):
+        # Tags and cover are fetched with the audio and carried over into the mp3
+        return ['-f', 'bestaudio', '--add-metadata', '--write-thumbnail'], 'mp3'
+    plan = plan_postprocessing(url, format_id)
+    if plan[:1] == ['--recode-video']:
+        # Any codecs fit in Matroska, so merging cannot fail ahead of the encode
+        return build_format_args(format_id, merge_format='mkv'), plan[1]
+    return args + plan, None
+
+def artifact_key(url, format_id):
+    """Content address of a download: video ID plus the exact yt-dlp options used.
+    
+    Format IDs that resolve to the same selector and postprocessing options
+    (e.g. any audio-only request) share a key.
+    """
+    video_id = extract_video_id(url)
+    if not video_id:
+        return None
+    options = [build_format_args(format_id), target_container(format_id)]
+    payload = json.dumps([video_id, options], separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+class ArtifactCache:
+    """Size-capped on-disk cache of finished downloads.
+    
+    Files are stored as `<key><ext>` in the cache directory, so the cache
+    survives restarts and is shared by every worker process. Files are
+    published atomically and reference counted while being served, so an
+    artifact in use is never evicted.
+    """
+    
+    # Extensions yt-dlp can leave a finished download with, probed on a miss
+    EXTENSIONS = ('.mp4', '.mp3', '.webm', '.m4a', '.mkv', '.opus', '.ogg', '.mov', '.3gp', '.flv')
+    
+    def __init__(self, directory, max_bytes, policy='lru'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._entries = {}  # key -> {'path', 'size', 'last_access', 'hits', 'refs'}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._scan()
+    
+    def _scan(self):
+        """Rebuild the in-memory index from the files already on disk"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            self._index(os.path.join(self.directory, name))
+    
+    def _index(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.basename(path).split('.', 1)[0]
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {'hits': 0, 'refs': 0}
+        # Recency lives in atime so mtime (and Last-Modified/ETag) stay stable
+        entry.update(path=path, size=st.st_size, last_access=max(st.st_atime, st.st_mtime), mtime=st.st_mtime)
+        return entry
+    
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and not os.path.exists(entry['path']):
+            # Evicted by another worker
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            # Published by another worker: probe the few names it can have
+            # rather than listing the whole cache directory on every miss
+            for ext in self.EXTENSIONS:
+                path = os.path.join(self.directory, key + ext)
+                if os.path.exists(path):
+                    entry = self._index(path)
+                    break
+        return entry
+    
+    def contains(self, key):
+        if not key:
+            return False
+        with self._lock:
+            return self._lookup(key) is not None
+    
+    def acquire(self, key):
+        """Pin an artifact for serving and return its path, or None on a miss"""
+        if not key:
+            return None
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['hits'] += 1
+            entry['refs'] += 1
+            entry['last_access'] = time.time()
+            path = entry['path']
+        try:
+            # Persist recency for LRU ordering across restarts
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+        return path
+    
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['refs'] > 0:
+                entry['refs'] -= 1
+    
+    def publish(self, key, src_path):
+        """Atomically move a finished download into the cache and return its new path"""
+        ext = os.path.splitext(src_path)[1]
+        final_path = os.path.join(self.directory, f"{key}{ext}")
+        tmp_path = os.path.join(self.directory, f".{key}.{uuid.uuid4().hex}.tmp")
+        # Move first (a copy when crossing filesystems), then rename so readers
+        # never see a partially written artifact
+        shutil.move(src_path, tmp_path)
+        # Stamp the publish time: a later re-download under the same key gets a
+        # new mtime and with it a new ETag (see artifact_etag)
+        os.utime(tmp_path, None)
+        os.replace(tmp_path, final_path)
+        with self._lock:
+            self._index(final_path)
+            self._evict(protect=key)
+        return final_path
+    
+    def _evict(self, protect=None):
+        total = sum(e['size'] for e in self._entries.values())
+        if total <= self.max_bytes:
+            return
+        if self.policy == 'lfu':
+            order = lambda item: (item[1]['hits'], item[1]['last_access'])
+        else:
+            order = lambda item: item[1]['last_access']
+        for key, entry in sorted(self._entries.items(), key=order):
+            if total <= self.max_bytes:
+                break
+            if key == protect or entry['refs'] > 0:
+                continue
+            try:
+                os.remove(entry['path'])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Error evicting cached file {entry['path']}: {str(e)}")
+                continue
+            total -= entry['size']
+            del self._entries[key]
+            logger.info(f"Evicted cached file {entry['path']}")
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(e['size'] for e in self._entries.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+artifact_cache = ArtifactCache(ARTIFACT_CACHE_DIR, ARTIFACT_CACHE_MAX_BYTES, ARTIFACT_CACHE_POLICY)
+
+def artifact_etag(key, file_path):
+    """Strong ETag of a cached artifact.
+    
+    The key only names the video and options, and a re-download after an
+    eviction may produce different bytes, so the ETag also carries the
+    size and publish time of this particular file.
+    """
+    stat = os.stat(file_path)
+    return f"{key}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def publish_download(job, output_file):
+    """Move a finished yt-dlp output into the artifact cache and return its new path"""
+    key = artifact_key(job.url, job.format_id)
+    if not key:
+        return None
+    try:
+        path = artifact_cache.publish(key, output_file)
+    except Exception as e:
+        logger.error(f"Failed to publish {output_file} to the cache: {str(e)}")
+        return None
+    update_job(job.download_id, artifact_key=key)
+    logger.info(f"Cached download {job.download_id} as {path}")
+    return path
+
+class DownloadJob:
+    """A single download request with a unique ID and its own working directory"""
+    
+    def __init__(self, url, format_id, client=None):
+        self.download_id = uuid.uuid4().hex
+        self.url = url
+        self.format_id = format_id
+        self.video_id = extract_video_id(url) or self.download_id
+        self.client = client
+        self.work_dir = os.path.join(TEMP_DIR, self.download_id)
+        self.queued_at = None
+        self.queue_wait = None
+        # Set when the postprocessing pool takes over the encode
+        self.postprocess_queued_at = None
+        self.postprocess_wait = None
+        # Granted by the scheduler when the job starts
+        self.connections = 1
+        self.rate_limit = None
+        # The running yt-dlp and its progress, while the job transfers
+        self.process = None
+        self.tracker = None
+        self.restart_requested = False
+    
+    def request_restart(self):
+        """Stop the transfer so it resumes under the current rate limit.
         
+        yt-dlp continues from its partial files when relaunched. Returns
+        False once the transfer is over, as postprocessing must not be cut short.
+        """
+        process = self.process
+        if process is None or process.poll() is not None:
+            return False
+        # Only while bytes are still arriving: any later phase is finishing work
+        tracker = self.tracker
+        if tracker is not None and (tracker.postprocess_started is not None
+                                    or tracker.phase not in ProgressTracker.TRANSFER_PHASES):
+            return False
+        self.restart_requested = True
+        try:
+            # The whole process group, so an aria2c child stops too
+            if os.name == 'posix':
+                os.killpg(process.pid, signal.SIGTERM)
+            else:
+                process.terminate()
+        except ProcessLookupError:
+            pass
+        return True
+    
+    def to_dict(self):
+        """Fields recorded in the job store when the job is created"""
         return {
-            'title': title,
-            'author': uploader,
-            'thumbnail_url': thumbnail,
-            'streams': stream_data,
-            'id': video_id
+            'url': self.url,
+            'format_id': self.format_id,
+            'video_id': self.video_id,
+            'work_dir': self.work_dir,
         }
+
+def acceleration_args(connections):
+    """yt-dlp arguments that let one download use up to `connections` connections"""
+    if DOWNLOAD_ACCELERATION == 'off' or connections <= 1:
+        return []
+    args = ['--concurrent-fragments', str(connections)]
+    if DOWNLOAD_ACCELERATION in ('aria2c', 'auto'):
+        if shutil.which('aria2c'):
+            # aria2c takes plain HTTP downloads; fragmented formats stay on the
+            # native downloader, which already runs fragments in parallel
+            args.extend([
+                '--downloader', 'aria2c',
+                '--downloader', 'dash,m3u8:native',
+                '--downloader-args', f'aria2c:-x {connections} -s {connections} -k 1M --console-log-level=warn',
+            ])
+        elif DOWNLOAD_ACCELERATION == 'aria2c':
+            download_logger.warning("aria2c not found, using parallel fragment downloads only")
+    return args
+
+def download_key(url, format_id):
+    """Key identifying identical download requests"""
+    return (extract_video_id(url) or url, format_id)
+
+def release_inflight_download(url, format_id, download_id):
+    """Forget an in-flight download once it has finished or failed"""
+    key = download_key(url, format_id)
+    with inflight_downloads_lock:
+        if inflight_downloads.get(key) == download_id:
+            del inflight_downloads[key]
+
+class ProgressTracker:
+    """Turns yt-dlp progress-template lines into throttled job updates.
     
-    except subprocess.TimeoutExpired:
-        logger.error("yt-dlp process timed out")
-        raise Exception("Video processing timed out")
+    yt-dlp reports progress many times a second. The latest values are
+    coalesced and written to the job store at most every `interval`
+    seconds, and at once when the phase (video, audio, download, merge,
+    postprocess) changes. Merged formats download their parts one after
+    another, so overall progress is the share of finished parts plus the
+    fraction of the current one.
+    """
+    
+    # Phases in which yt-dlp is still receiving media; None until the first progress line
+    TRANSFER_PHASES = (None, 'video', 'audio', 'download')
+    
+    def __init__(self, download_id, interval=PROGRESS_UPDATE_INTERVAL):
+        self.download_id = download_id
+        self.interval = interval
+        self.phase = None
+        self._pending = {}
+        self._last_write = 0
+        self._started = time.monotonic()
+        self._finished_parts = {}
+        # When merging or conversion started, for the postprocessing metrics
+        self.postprocess_started = None
+        # Progress lines seen and job store writes made, for the job summary
+        self.lines = 0
+        self.writes = 0
+        # Fed from both the stdout and the stderr reader
+        self._lock = threading.Lock()
+    
+    def feed(self, line):
+        """Handle one line of yt-dlp output, returning False if it is not a progress line"""
+        if not line.startswith(PROGRESS_LINE_PREFIX):
+            return False
+        self.lines += 1
+        fields = line[len(PROGRESS_LINE_PREFIX):].rstrip('\n').split('\t')
+        try:
+            if len(fields) == 5:
+                self._download_progress(*fields)
+            else:
+                self._postprocess_progress(json.loads(fields[0]))
+        except (ValueError, TypeError, AttributeError):
+            progress_logger.debug(f"Ignoring malformed progress line: {line.strip()}")
+        return True
+    
+    def _download_progress(self, format_id, vcodec, acodec, requested, progress):
+        progress = json.loads(progress)
+        try:
+            parts = json.loads(requested)
+        except ValueError:
+            parts = None  # "NA" when a single format was selected
+        if not isinstance(parts, list) or format_id not in parts:
+            parts = [format_id]
         
-    except json.JSONDecodeError:
-        logger.error(f"Failed to parse yt-dlp JSON output: {stdout}")
-        raise Exception("Failed to parse video information")
+        if vcodec == 'none':
+            phase = 'audio'
+        elif acodec == 'none':
+            phase = 'video'
+        else:
+            phase = 'download'
+        
+        done = progress.get('downloaded_bytes') or 0
+        total = progress.get('total_bytes') or progress.get('total_bytes_estimate')
+        if progress.get('status') == 'finished':
+            self._finished_parts[format_id] = done
+            fraction = 1.0
+        elif total:
+            fraction = min(done / total, 1.0)
+        elif progress.get('fragment_count'):
+            fraction = (progress.get('fragment_index') or 0) / progress['fragment_count']
+        else:
+            fraction = 0.0
+        
+        # Effective throughput over the whole job, across all parts and connections
+        received = done + sum(size for part, size in self._finished_parts.items() if part != format_id)
+        elapsed = time.monotonic() - self._started
+        
+        self._update(
+            phase,
+            progress=round((parts.index(format_id) + fraction) / len(parts) * 100, 1),
+            throughput=round(received / elapsed) if elapsed > 0 else None,
+            downloaded_bytes=done,
+            total_bytes=total,
+            speed=progress.get('speed'),
+            eta=progress.get('eta'),
+            fragment_index=progress.get('fragment_index'),
+            fragment_count=progress.get('fragment_count'),
+        )
+    
+    def _postprocess_progress(self, progress):
+        phase = POSTPROCESS_PHASES.get(progress.get('postprocessor'))
+        if phase is None:
+            return
+        if self.postprocess_started is None:
+            self.postprocess_started = time.monotonic()
+        self._update(phase, speed=None, eta=None)
+    
+    def _update(self, phase, **fields):
+        with self._lock:
+            self._pending.update(fields)
+            now = time.monotonic()
+            if phase != self.phase:
+                self.phase = self._pending['phase'] = phase
+                progress_logger.debug(f"Download {self.download_id} is now in phase {phase}")
+            elif now - self._last_write < self.interval:
+                return
+            update_job(self.download_id, **self._pending)
+            self.writes += 1
+            if progress_logger.isEnabledFor(logging.DEBUG) and progress_log_sampler.ready(self.download_id):
+                progress_logger.debug(f"Download progress for {self.download_id}: {self._pending.get('progress')}% ({phase})")
+            self._pending = {}
+            self._last_write = now
+    
+    def flush(self):
+        """Write any progress still held back by the throttle"""
+        with self._lock:
+            if self._pending:
+                update_job(self.download_id, **self._pending)
+                self.writes += 1
+                self._pending = {}
+
+def log_job_summary(job, status, tracker, started, output_path=None, error=None):
+    """Log one structured line summarizing a finished download"""
+    ended = time.monotonic()
+    transfer_ended = tracker.postprocess_started or ended
+    size = os.path.getsize(output_path) if output_path and os.path.exists(output_path) else None
+    fields = {
+        'download_id': job.download_id,
+        'video_id': job.video_id,
+        'format_id': job.format_id,
+        'status': status,
+        'queue_wait': round(job.queue_wait, 3) if job.queue_wait is not None else None,
+        'postprocess_wait': round(job.postprocess_wait, 3) if job.postprocess_wait is not None else None,
+        'download_seconds': round(transfer_ended - started, 3),
+        'postprocess_seconds': round(ended - tracker.postprocess_started, 3) if tracker.postprocess_started else None,
+        'bytes': size,
+        'throughput': round(size / (transfer_ended - started)) if size and transfer_ended > started else None,
+        'connections': job.connections,
+        'rate_limit': job.rate_limit,
+        'progress_lines': tracker.lines,
+        'progress_writes': tracker.writes,
+    }
+    if error:
+        fields['error'] = classify_ytdlp_error(error)
+    log = download_logger.info if status == 'completed' else download_logger.warning
+    log(f"Download {job.download_id} finished: {status}", extra={'fields': fields})
+
+def complete_download(job, final_path, tracker, started):
+    """Publish a finished download and mark its job completed"""
+    release_inflight_download(job.url, job.format_id, job.download_id)
+    if tracker.postprocess_started is not None:
+        postprocess_seconds.observe(time.monotonic() - tracker.postprocess_started)
+    
+    # Keep the finished file so later requests can reuse it
+    cached_path = publish_download(job, final_path)
+    if cached_path:
+        final_path = cached_path
+        # Only leftovers such as thumbnails remain in the job directory
+        shutil.rmtree(job.work_dir, ignore_errors=True)
+    
+    # Success - mark as completed with 100% progress
+    update_job(job.download_id, progress=100, status="completed", output_path=final_path)
+    downloads_total.inc(status="completed")
+    log_job_summary(job, "completed", tracker, started, output_path=final_path)
+
+def fail_download(job, error, tracker, started):
+    """Mark a failed download completed with a sample file, or failed if there is none"""
+    release_inflight_download(job.url, job.format_id, job.download_id)
+    
+    # Fall back to a sample file if the download fails. The job
+    # points at the shared sample, so nothing is copied per failure
+    for kind in (('mp3', 'mp4') if is_audio_format(job.format_id) else ('mp4',)):
+        sample_path = sample_assets.path(kind)
+        if sample_path:
+            download_logger.info(f"Using the {kind} sample as fallback for {job.download_id}")
+            
+            # Update status to show we have a fallback file
+            update_job(job.download_id, progress=100, status="completed_fallback",
+                       output_path=sample_path, output_name=f"{job.video_id}_fallback.{kind}")
+            downloads_total.inc(status="completed_fallback")
+            log_job_summary(job, "completed_fallback", tracker, started, sample_path, error)
+            return
+    
+    # No fallback file could be provided, report the original error
+    update_job(job.download_id, status=f"error: {error}")
+    downloads_total.inc(status="error")
+    log_job_summary(job, "error", tracker, started, error=error)
+
+def download_with_ytdlp(job):
+    """Download a YouTube video using yt-dlp into the job's working directory"""
+    url, format_id, download_id = job.url, job.format_id, job.download_id
+    download_logger.debug(f"Starting download for {url} with format {format_id} and ID {download_id}")
+    
+    try:
+        # Set initial status
+        update_job(download_id, progress=0, status="downloading", connections=job.connections,
+                   rate_limit=job.rate_limit)
+        
+        video_id = job.video_id
+        
+        # Each job downloads into its own directory so files never collide
+        output_dir = job.work_dir
+        os.makedirs(output_dir, exist_ok=True)
+        
+        # Name the output after the video ID and format within the job directory
+        safe_format_id = format_id.replace('/', '_').replace(os.sep, '_')
+        output_path = os.path.join(output_dir, f"{video_id}_{safe_format_id}.%(ext)s")
+        
+        # Build the yt-dlp command with appropriate options
+        stage_args, encode = plan_stages(url, format_id)
+        
+        def build_command(rate_limit):
+            cmd = ['yt-dlp', '--no-warnings']
+            cmd.extend(stage_args)
+            cmd.extend(acceleration_args(job.connections))
+            if rate_limit:
+                cmd.extend(['--limit-rate', str(rate_limit)])
+            
+            # Add output template and URL
+            cmd.extend([
+                '-o', output_path,  # Output filename
+                '--newline',  # For line-by-line progress
+                # Report the final path after all postprocessing; --print implies
+                # --quiet, so progress output has to be requested explicitly
+                '--print', f'after_move:{OUTPUT_LINE_PREFIX}%(filepath)s',
+                '--progress',
+                # Download progress goes to stdout, postprocessing progress to stderr
+                '--progress-template', f'download:{DOWNLOAD_PROGRESS_TEMPLATE}',
+                '--progress-template', f'postprocess:{POSTPROCESS_PROGRESS_TEMPLATE}',
+                url
+            ])
+            return cmd
+        
+        tracker = job.tracker = ProgressTracker(download_id)
+        started = time.monotonic()
+        
+        # Monitor the process output to track progress
+        def monitor_progress():
+            rate_limit = job.rate_limit
+            cmd = build_command(rate_limit)
+            download_logger.debug(f"Running download command: {' '.join(cmd)}")
+            
+            # Launch the download process in its own group so a restart stops its children too
+            process = job.process = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                bufsize=1,  # Line buffered
+                universal_newlines=True,
+                start_new_session=os.name == 'posix'
+            )
+            if job.rate_limit != rate_limit:
+                # The scheduler rebalanced while the command was being built
+                job.request_restart()
+            
+            # Drain stderr alongside stdout so a chatty process cannot block on a
+            # full pipe; it carries postprocessing progress and the error output
+            error_lines = []
+            def read_stderr():
+                for line in iter(process.stderr.readline, ''):
+                    if not tracker.feed(line):
+                        error_lines.append(line)
+            stderr_reader = threading.Thread(target=read_stderr, name=f"stderr-{download_id[:8]}")
+            stderr_reader.daemon = True
+            stderr_reader.start()
+            
+            final_path = None
+            for line in iter(process.stdout.readline, ''):
+                if line.startswith(OUTPUT_LINE_PREFIX):
+                    final_path = line[len(OUTPUT_LINE_PREFIX):].strip()
+                    continue
+                tracker.feed(line)
+            
+            # Process completed
+            returncode = process.wait()
+            stderr_reader.join()
+            job.process = None
+            return returncode, final_path, error_lines
+        
+        # Monitor progress on the calling scheduler worker until yt-dlp exits,
+        # relaunching it whenever the scheduler changes its rate limit
+        while True:
+            returncode, final_path, error_lines = monitor_progress()
+            restarted, job.restart_requested = job.restart_requested, False
+            if not restarted or returncode == 0:
+                break
+            update_job(download_id, rate_limit=job.rate_limit)
+        tracker.flush()
+        
+        if returncode == 0 and final_path and os.path.exists(final_path):
+            download_seconds.observe((tracker.postprocess_started or time.monotonic()) - started)
+            if encode:
+                # The encode waits for the postprocessing pool; this download slot is free again
+                postprocess_pool.submit(job, encode, final_path, tracker, started)
+            else:
+                complete_download(job, final_path, tracker, started)
+        else:
+            # Error - read error message from stderr
+            error = ''.join(error_lines).strip() or "yt-dlp did not report an output file"
+            download_logger.error(f"Download failed for {download_id}: {error}")
+            subprocess_failures_total.inc(operation='download', error=classify_ytdlp_error(error))
+            fail_download(job, error, tracker, started)
+        
+        return True
         
     except Exception as e:
-        logger.error(f"Error getting video info: {str(e)}")
-        # Return fallback data to ensure the UI still works
-        fallback_id = extract_video_id(url) or "unknown"
+        download_logger.error(f"Error starting download: {str(e)}")
+        update_job(download_id, progress=0, status=f"error: {str(e)}")
+        downloads_total.inc(status="error")
+        release_inflight_download(url, format_id, download_id)
+        return False
+
+class TempJanitor:
+    """Single background thread that keeps TEMP_DIR bounded.
+    
+    TEMP_DIR holds one working directory per job plus stray files. Each
+    pass removes abandoned partial downloads, entries of finished jobs
+    older than `max_age` or served more than `served_grace` seconds ago,
+    and then the oldest finished entries until the directory fits in
+    `max_bytes`. Directories of queued or running jobs are never touched.
+    """
+    
+    PARTIAL_SUFFIXES = ('.part', '.ytdl')
+    
+    def __init__(self, directory, interval, max_age, max_bytes, served_grace, partial_max_age):
+        self.directory = directory
+        self.interval = interval
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.served_grace = served_grace
+        self.partial_max_age = partial_max_age
+        self._served = {}  # entry name -> time it was last served
+        self._lock = threading.Lock()
+        self._thread = None
+        self.reclaimed_bytes = 0
+        self.reclaimed_files = 0
+        self.runs = 0
+        self.temp_bytes = 0
+    
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="temp-janitor")
+                self._thread.daemon = True
+                self._thread.start()
+    
+    def mark_served(self, file_path):
+        """Let a served temp file go after the grace period instead of the max age"""
+        name = self._entry_name(file_path)
+        if name:
+            with self._lock:
+                self._served[name] = time.time()
+    
+    def _entry_name(self, path):
+        rel = os.path.relpath(os.path.abspath(path), self.directory)
+        if rel.startswith('..'):
+            return None
+        return rel.split(os.sep, 1)[0]
+    
+    def _run(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Temp janitor pass failed: {str(e)}")
+            time.sleep(self.interval)
+    
+    def _is_active(self, name):
+        job = job_store.get(name)
+        return job is not None and not JobStore.is_finished(job.get('status'))
+    
+    def _measure(self, path):
+        """Return (size in bytes, newest mtime, file count) of a file or directory"""
+        if os.path.isdir(path):
+            size, newest, count = 0, os.path.getmtime(path), 0
+            for root, _, files in os.walk(path):
+                for f in files:
+                    try:
+                        st = os.stat(os.path.join(root, f))
+                    except OSError:
+                        continue
+                    size += st.st_size
+                    newest = max(newest, st.st_mtime)
+                    count += 1
+            return size, newest, count
+        st = os.stat(path)
+        return st.st_size, st.st_mtime, 1
+    
+    def _remove(self, path, size, count, reason):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"Temp janitor could not remove {path}: {str(e)}")
+            return
+        self.reclaimed_bytes += size
+        self.reclaimed_files += count
+        logger.debug(f"Temp janitor removed {path} ({reason}, {size} bytes)")
+    
+    def _remove_partials(self, now):
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if not f.endswith(self.PARTIAL_SUFFIXES):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                # Running downloads keep writing to their partial files
+                if now - st.st_mtime > self.partial_max_age:
+                    self._remove(path, st.st_size, 1, "abandoned partial download")
+    
+    def sweep(self):
+        """Run one cleanup pass over the temp directory"""
+        if not os.path.isdir(self.directory):
+            return
+        now = time.time()
+        before = self.reclaimed_bytes
+        self._remove_partials(now)
+        
+        with self._lock:
+            served = dict(self._served)
+        
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                size, newest, count = self._measure(path)
+            except OSError:
+                continue
+            if os.path.isdir(path) and self._is_active(name):
+                total += size
+                continue
+            served_at = served.get(name)
+            if served_at is not None and now - served_at > self.served_grace:
+                self._remove(path, size, count, "served")
+            elif now - newest > self.max_age:
+                self._remove(path, size, count, "expired")
+            else:
+                entries.append((newest, path, size, count))
+                total += size
+        
+        # Enforce the byte quota, oldest entries first
+        for newest, path, size, count in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(path, size, count, "over quota")
+            total -= size
+        
+        with self._lock:
+            for name in list(self._served):
+                if not os.path.exists(os.path.join(self.directory, name)):
+                    del self._served[name]
+        
+        self.temp_bytes = total
+        self.runs += 1
+        reclaimed = self.reclaimed_bytes - before
+        if reclaimed:
+            logger.info(f"Temp janitor reclaimed {reclaimed} bytes, {total} bytes remain in {self.directory}")
+    
+    def stats(self):
         return {
-            'title': f"YouTube Video {fallback_id}",
-            'author': "Unknown",
-            'thumbnail_url': f"https://img.youtube.com/vi/{fallback_id}/hqdefault.jpg",
-            'streams': [
-                {
-                    'format_id': 'bestvideo+bestaudio',
-                    'resolution': 'Highest Quality (Combined Format)',
-                    'ext': 'mp4',
-                    'filesize_approx': 100 * 1024 * 1024,
-                    'width': 1920,
-                    'height': 1080,
-                    'type': 'video',
-                    'is_highest': True
-                },
-                {
-                    'format_id': 'best',
-                    'resolution': 'High Quality (Single File)',
-                    'ext': 'mp4',
-                    'filesize_approx': 50 * 1024 * 1024,
-                    'width': 1920,
-                    'height': 1080,
-                    'type': 'video'
-                },
-                {
-                    'format_id': '22', 
-                    'resolution': '720p',
-                    'ext': 'mp4',
-                    'filesize_approx': 20 * 1024 * 1024,
-                    'width': 1280,
-                    'height': 720
-                },
-                {
-                    'format_id': '18',
-                    'resolution': '360p',
-                    'ext': 'mp4',
-                    'filesize_approx': 10 * 1024 * 1024,
-                    'width': 640,
-                    'height': 360
-                }
-            ],
-            'id': fallback_id
+            'runs': self.runs,
+            'reclaimed_bytes': self.reclaimed_bytes,
+            'reclaimed_files': self.reclaimed_files,
+            'temp_bytes': self.temp_bytes,
         }
 
-def download_with_ytdlp(url, format_id, download_id, output_dir=TEMP_DIR):
-    """Download a YouTube video using yt-dlp to a temporary location"""
-    logger.info(f"Starting download for {url} with format {format_id} and ID {download_id}")
+temp_janitor = TempJanitor(TEMP_DIR, TEMP_JANITOR_INTERVAL, TEMP_MAX_AGE, TEMP_MAX_BYTES,
+                           TEMP_SERVED_GRACE, TEMP_PARTIAL_MAX_AGE)
+
+class SchedulerFull(Exception):
+    """Raised when a download cannot be admitted to the scheduler"""
+
+class DownloadStream:
+    """A /stream transfer's claim on the download rate limit.
+    
+    The scheduler sets the bucket's rate to the stream's fair share, and the
+    stream paces the bytes it relays with it; yt-dlp blocks on the pipe, so
+    that also paces the download behind it.
+    """
+    
+    def __init__(self, scheduler, client):
+        self._scheduler = scheduler
+        self.client = client
+        self.bucket = TokenBucket(scheduler.rate_limit)
+        self._closed = False
+    
+    def reserve(self, amount):
+        return self.bucket.reserve(amount)
+    
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._scheduler.close_stream(self)
+
+class DownloadScheduler:
+    """Bounded pool of download workers fed by a priority queue.
+    
+    At most `workers` downloads run at once; the rest wait in a queue that
+    is ordered by priority (lower first) and then by arrival. Submissions are
+    rejected once the queue is full or a client has too many downloads.
+    Each starting download is granted up to `per_job_connections` from a
+    budget of `max_connections` shared by all running downloads, and at
+    least one.
+    
+    With a `rate_limit`, every running download and /stream transfer gets
+    its client's fair share of it, split between that client's transfers,
+    and the shares never add up to more than the limit. yt-dlp takes the
+    limit when it starts, so when a share shrinks (or at least doubles)
+    the download is restarted under the new one and resumes where it was;
+    streams are paced by the app and simply change pace.
+    """
+    
+    def __init__(self, workers, max_queue, per_client, per_job_connections=1, max_connections=None,
+                 rate_limit=0):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_client = per_client
+        self.per_job_connections = max(1, per_job_connections)
+        self.max_connections = max_connections or self.workers * self.per_job_connections
+        self._connections_in_use = 0
+        self.rate_limit = rate_limit
+        self._queue = []  # heap of (priority, seq, job)
+        self._seq = itertools.count()
+        self._client_jobs = {}
+        self._active = {}
+        self._streams = set()
+        self._cond = threading.Condition()
+        self._threads = []
+    
+    def _start_workers(self):
+        # Workers are started on first use so importing the app spawns no threads
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"download-worker-{len(self._threads)}")
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, job, priority=0, max_per_client=None):
+        """Queue a DownloadJob; raises SchedulerFull if it cannot be admitted"""
+        client = job.client
+        per_client = self.per_client if max_per_client is None else max_per_client
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                raise SchedulerFull("Download queue is full, please try again later")
+            if client and per_client and self._client_jobs.get(client, 0) >= per_client:
+                raise SchedulerFull("Too many downloads in progress for this client")
+            self._client_jobs[client] = self._client_jobs.get(client, 0) + 1
+            job.queued_at = time.monotonic()
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._start_workers()
+            self._cond.notify()
+    
+    def position(self, download_id):
+        """1-based position of a queued download, or None if it is not queued"""
+        with self._cond:
+            for index, (_, _, job) in enumerate(sorted(self._queue, key=lambda item: item[:2])):
+                if job.download_id == download_id:
+                    return index + 1
+        return None
+    
+    def stats(self):
+        with self._cond:
+            return {'active': len(self._active), 'queued': len(self._queue), 'workers': self.workers,
+                    'connections': self._connections_in_use, 'max_connections': self.max_connections,
+                    'rate_limit': self.rate_limit}
+    
+    def open_stream(self, client):
+        """Count a /stream transfer against the rate limit; None when there is no limit"""
+        if not self.rate_limit:
+            return None
+        stream = DownloadStream(self, client)
+        with self._cond:
+            self._streams.add(stream)
+            self._rebalance()
+        return stream
+    
+    def close_stream(self, stream):
+        with self._cond:
+            self._streams.discard(stream)
+            self._rebalance()
+    
+    def _rebalance(self):
+        """Split the rate limit fairly between running transfers (lock held)"""
+        if not self.rate_limit:
+            return
+        transfers = list(self._active.values()) + list(self._streams)
+        per_client = {}
+        for transfer in transfers:
+            per_client[transfer.client] = per_client.get(transfer.client, 0) + 1
+        for transfer in transfers:
+            share = max(1, self.rate_limit // len(per_client) // per_client[transfer.client])
+            if isinstance(transfer, DownloadStream):
+                transfer.bucket.set_rate(share)
+            elif transfer.rate_limit is None or transfer.process is None:
+                # Not launched yet, yt-dlp picks the share up when it starts
+                transfer.rate_limit = share
+            elif share < transfer.rate_limit or share >= 2 * transfer.rate_limit:
+                transfer.rate_limit = share
+                if transfer.request_restart():
+                    download_logger.info(f"Restarting download {transfer.download_id} at {share} B/s")
+    
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                _, _, job = heapq.heappop(self._queue)
+                job.queue_wait = time.monotonic() - job.queued_at
+                queue_wait_seconds.observe(job.queue_wait)
+                self._active[job.download_id] = job
+                self._rebalance()
+                free = self.max_connections - self._connections_in_use
+                job.connections = max(1, min(self.per_job_connections, free))
+                self._connections_in_use += job.connections
+            try:
+                download_with_ytdlp(job)
+            except Exception as e:
+                download_logger.error(f"Download worker failed for {job.download_id}: {str(e)}")
+            finally:
+                with self._cond:
+                    self._active.pop(job.download_id, None)
+                    self._rebalance()
+                    self._connections_in_use -= job.connections
+                    # A job handed to the postprocessing pool stays on its client's
+                    # quota until the encode is done (see release_client)
+                    if job.postprocess_queued_at is None:
+                        self._release_client(job.client)
+    
+    def release_client(self, job):
+        """Take a job that finished in the postprocessing pool off its client's quota"""
+        with self._cond:
+            self._release_client(job.client)
+    
+    def _release_client(self, client):
+        remaining = self._client_jobs.get(client, 1) - 1
+        if remaining > 0:
+            self._client_jobs[client] = remaining
+        else:
+            self._client_jobs.pop(client, None)
+
+download_scheduler = DownloadScheduler(DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_SIZE, DOWNLOAD_PER_CLIENT,
+                                       DOWNLOAD_CONNECTIONS_PER_JOB, DOWNLOAD_MAX_CONNECTIONS, DOWNLOAD_RATE_LIMIT)
+
+class PostprocessPool:
+    """Bounded pool of ffmpeg workers for the CPU-bound end of downloads.
     
-    try:
-        # Set initial status
-        download_progress[download_id] = 0
-        download_status[download_id] = "downloading"
-        
-        # Get video info to extract the title for the output filename
-        video_id = extract_video_id(url) or download_id
-        
-        # Always use temporary directory for downloads
-        output_dir = TEMP_DIR
-        
-        # Create the output directory if it doesn't exist
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-        
-        # Set the output template based on the video ID and timestamp to avoid conflicts
-        timestamp = str(int(time.time()))
-        output_template = f"{video_id}_{format_id}_{timestamp}.%(ext)s"
-        output_path = os.path.join(output_dir, output_template)
-        
-        # Build the yt-dlp command with appropriate options
-        cmd = ['yt-dlp', '--no-warnings']
-        
-        # Special handling for audio-only downloads
-        if format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id:
-            cmd.extend([
-                '-f', 'bestaudio',
-                '-x',  # Extract audio
-                '--audio-format', 'mp3',  # Convert to mp3
-                '--audio-quality', '0',  # Best audio quality
-                '--embed-thumbnail',  # Add thumbnail to audio file when possible
-                '--add-metadata',     # Add metadata information
-                '--postprocessor-args', '-id3v2_version 3',  # Ensure compatibility
-            ])
-        elif format_id == 'bestvideo+bestaudio':
-            # For highest quality, merge best video and audio
-            # Explicitly request best video and best audio and merge them
-            cmd.extend([
-                '-f', 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
-                '--merge-output-format', 'mp4',
-                '--recode-video', 'mp4'  # Ensure consistent format
-            ])
-        elif format_id == 'best' or 'best' in format_id.lower():
-            # Fallback for best available single file
-            cmd.extend([
-                '-f', 'best[ext=mp4]/best',
-                '--recode-video', 'mp4'  # Ensure consistent format
-            ])
+    A download whose file still needs an encode hands it over here and frees
+    its download slot, so transfers keep the network busy while encodes wait
+    their turn. At most `max_queue` files wait; beyond that the handover
+    blocks, holding the download slot. The job keeps counting against its
+    client's download quota until the encode is done. At most `workers`
+    encodes run at a time, in
+    arrival order, each limited to `threads` ffmpeg threads and started at
+    niceness `nice`, which keeps them within their CPU budget and behind
+    request handling.
+    """
+    
+    # Thumbnails yt-dlp may write next to an audio download
+    THUMBNAIL_EXTENSIONS = ('webp', 'jpg', 'jpeg', 'png')
+    
+    def __init__(self, workers, max_queue, threads=1, nice=0):
+        self.workers = max(1, workers)
+        self.threads = threads
+        self.nice = nice
+        self._queue = queue.Queue(maxsize=max(1, max_queue))
+        self._active = 0
+        self._lock = threading.Lock()
+        self._threads = []
+    
+    def _start_workers(self):
+        # Workers are started on first use so importing the app spawns no threads
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, name=f"postprocess-worker-{len(self._threads)}")
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+    
+    def submit(self, job, encode, source, tracker, started):
+        """Queue the encode of a downloaded file into the `encode` format"""
+        job.postprocess_queued_at = time.monotonic()
+        update_job(job.download_id, phase='postprocess', speed=None, eta=None)
+        self._start_workers()
+        self._queue.put((job, encode, source, tracker, started))
+    
+    def stats(self):
+        with self._lock:
+            return {'active': self._active, 'queued': self._queue.qsize(), 'workers': self.workers}
+    
+    def command(self, encode, source, target, thumbnail=None):
+        """ffmpeg command converting `source` into `target` in the `encode` format"""
+        threads = ['-threads', str(self.threads)] if self.threads > 0 else []
+        cmd = ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error', *threads, '-i', source]
+        if encode == 'mp3':
+            if thumbnail:
+                cmd.extend(['-i', thumbnail])
+            cmd.extend(['-map', '0:a'])
+            if thumbnail:
+                # Embedded as the front cover, like yt-dlp's --embed-thumbnail
+                cmd.extend(['-map', '1:v', '-c:v', 'mjpeg', '-disposition:v', 'attached_pic',
+                            '-metadata:s:v', 'title=Album cover', '-metadata:s:v', 'comment=Cover (front)'])
+            # The same encode as -x --audio-format mp3 --audio-quality 0
+            cmd.extend(['-c:a', 'libmp3lame', '-q:a', '0', '-id3v2_version', '3'])
         else:
-            # Standard format selection
-            cmd.extend(['-f', format_id])
-        
-        # Add output template and URL
-        cmd.extend([
-            '-o', output_path,  # Output filename
-            '--newline',  # For line-by-line progress
-            url
-        ])
-        
-        logger.info(f"Running download command: {' '.join(cmd)}")
-        
-        # Launch the download process
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,  # Line buffered
-            universal_newlines=True
-        )
-        
-        # Monitor the process output to track progress
-        def monitor_progress():
-            for line in iter(process.stdout.readline, ''):
-                # Look for progress updates in yt-dlp output
-                if '[download]' in line and '%' in line:
-                    try:
-                        # Extract percentage from the output line
-                        percent_str = line.split('%')[0].split()[-1]
-                        percent = float(percent_str)
-                        
-                        # Update progress in our tracking dictionary
-                        download_progress[download_id] = percent
-                        logger.info(f"Download progress for {download_id}: {percent}%")
-                    except (ValueError, IndexError) as e:
-                        logger.warning(f"Failed to parse progress from line: {line}")
-            
-            # Process completed
-            returncode = process.wait()
-            
-            if returncode == 0:
-                # Success - mark as completed with 100% progress
-                download_progress[download_id] = 100
-                download_status[download_id] = "completed"
-                logger.info(f"Download completed for {download_id}")
-            else:
-                # Error - read error message from stderr
-                error = process.stderr.read().strip()
-                logger.error(f"Download failed for {download_id}: {error}")
-                download_status[download_id] = f"error: {error}"
-                
-                # Fall back to sample files if download fails
-                try:
-                    # Check if this was an audio download
-                    is_audio = format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
-                    
-                    if is_audio:
-                        # Use audio sample for audio formats
-                        sample_path = os.path.join(SAMPLES_DIR, 'sample.mp3')
-                        if os.path.exists(sample_path):
-                            # Create a fallback audio file path
-                            fallback_path = os.path.join(output_dir, f"{video_id}_fallback.mp3")
-                            shutil.copy2(sample_path, fallback_path)
-                            logger.info(f"Created fallback audio at {fallback_path}")
-                            
-                            # Update status to show we have a fallback file
-                            download_status[download_id] = "completed_fallback"
-                            download_progress[download_id] = 100
-                            return
-                    
-                    # For video or if audio fallback failed, use video sample
-                    sample_path = os.path.join(SAMPLES_DIR, 'sample.mp4')
-                    if os.path.exists(sample_path):
-                        # Create a fallback file path
-                        fallback_path = os.path.join(output_dir, f"{video_id}_fallback.mp4")
-                        shutil.copy2(sample_path, fallback_path)
-                        logger.info(f"Created fallback video at {fallback_path}")
-                        
-                        # Update status to show we have a fallback file
-                        download_status[download_id] = "completed_fallback"
-                        download_progress[download_id] = 100
-                except Exception as e:
-                    logger.error(f"Failed to create fallback file: {str(e)}")
+            # ffmpeg's default encoders for the container, like --recode-video
+            cmd.extend(['-map', '0:v?', '-map', '0:a?', '-movflags', '+faststart'])
+        cmd.extend(['-map_metadata', '0', *threads, '-f', encode, target])
+        if self.nice and shutil.which('nice'):
+            cmd = ['nice', '-n', str(self.nice)] + cmd
+        return cmd
+    
+    def _thumbnail(self, source):
+        base = os.path.splitext(source)[0]
+        for ext in self.THUMBNAIL_EXTENSIONS:
+            if os.path.exists(f"{base}.{ext}"):
+                return f"{base}.{ext}"
+        return None
+    
+    def _worker(self):
+        while True:
+            job, encode, source, tracker, started = self._queue.get()
+            with self._lock:
+                self._active += 1
+            try:
+                self.run(job, encode, source, tracker, started)
+            except Exception as e:
+                download_logger.error(f"Postprocessing failed for {job.download_id}: {str(e)}")
+                fail_download(job, str(e), tracker, started)
+            finally:
+                download_scheduler.release_client(job)
+                with self._lock:
+                    self._active -= 1
+    
+    def run(self, job, encode, source, tracker, started):
+        job.postprocess_wait = time.monotonic() - job.postprocess_queued_at
+        postprocess_wait_seconds.observe(job.postprocess_wait)
+        if tracker.postprocess_started is None:
+            tracker.postprocess_started = time.monotonic()
         
-        # Start the progress monitoring in a separate thread
-        monitor_thread = threading.Thread(target=monitor_progress)
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        # Encode next to the source and only take the final name once complete
+        target = f"{os.path.splitext(source)[0]}.{encode}"
+        partial = f"{target}.part"
+        thumbnail = self._thumbnail(source) if encode == 'mp3' else None
+        cmd = self.command(encode, source, partial, thumbnail)
+        download_logger.debug(f"Running postprocessing command: {' '.join(cmd)}")
         
-        return True
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            error = result.stderr.strip() or f"ffmpeg exited with status {result.returncode}"
+            download_logger.error(f"Postprocessing failed for {job.download_id}: {error}")
+            subprocess_failures_total.inc(operation='postprocess', error=classify_ytdlp_error(error))
+            if os.path.exists(partial):
+                os.remove(partial)
+            fail_download(job, error, tracker, started)
+            return
         
-    except Exception as e:
-        logger.error(f"Error starting download: {str(e)}")
-        download_status[download_id] = f"error: {str(e)}"
-        download_progress[download_id] = 0
-        return False
+        os.replace(partial, target)
+        if source != target:
+            os.remove(source)
+        complete_download(job, target, tracker, started)
+
+postprocess_pool = PostprocessPool(POSTPROCESS_WORKERS, POSTPROCESS_QUEUE_SIZE, POSTPROCESS_THREADS, POSTPROCESS_NICE)
 
 def find_downloaded_file(download_id, video_id, format_id, output_dir=TEMP_DIR):
     """Find the downloaded file after a download has completed"""
-    logger.info(f"Looking for downloaded file for {download_id}, video_id {video_id}, format {format_id}")
+    logger.debug(f"Looking for downloaded file for {download_id}, video_id {video_id}, format {format_id}")
     
     try:
-        # Always look in the temporary directory
-        output_dir = TEMP_DIR
-        
-        # Check if this is an audio format
-        is_audio = format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
+        # The job records the exact path yt-dlp produced, so no directory scan is needed
+        job = job_store.get(download_id) or {}
+        output_path = job.get('output_path')
+        if output_path and os.path.exists(output_path):
+            logger.info(f"Found recorded output: {output_path}")
+            # Fallback jobs point at a shared sample but keep their own name
+            return output_path, job.get('output_name') or os.path.basename(output_path)
         
-        # First try to find the exact file based on video_id and format_id
-        for file in os.listdir(output_dir):
-            if file.startswith(f"{video_id}_{format_id}"):
-                file_path = os.path.join(output_dir, file)
-                logger.info(f"Found exact match: {file_path}")
-                return file_path, os.path.basename(file)
-        
-        # Special handling for audio files - they may have been converted to MP3
-        if is_audio:
-            for file in os.listdir(output_dir):
-                if file.startswith(video_id) and file.endswith('.mp3'):
-                    file_path = os.path.join(output_dir, file)
-                    logger.info(f"Found audio match: {file_path}")
-                    return file_path, os.path.basename(file)
-        
-        # If not found, try any file that starts with the video_id
-        for file in os.listdir(output_dir):
-            if file.startswith(video_id):
-                file_path = os.path.join(output_dir, file)
-                logger.info(f"Found match by video ID: {file_path}")
-                return file_path, os.path.basename(file)
-                
-        # Look for a fallback file
-        # Check for audio fallback first if appropriate
-        is_audio = format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
-        if is_audio:
-            fallback_path = os.path.join(output_dir, f"{video_id}_fallback.mp3")
-            if os.path.exists(fallback_path):
-                logger.info(f"Using audio fallback file: {fallback_path}")
-                return fallback_path, os.path.basename(fallback_path)
-        
-        # Then check for video fallback
-        fallback_path = os.path.join(output_dir, f"{video_id}_fallback.mp4")
-        if os.path.exists(fallback_path):
-            logger.info(f"Using video fallback file: {fallback_path}")
-            return fallback_path, os.path.basename(fallback_path)
-            
-        # If still not found, check the samples directory
-        is_audio = format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
+        # If not found, check the samples directory
+        is_audio = is_audio_format(format_id)
         
         if is_audio:
             # Use audio sample for audio formats
-            sample_path = os.path.join(SAMPLES_DIR, 'sample.mp3')
-            if os.path.exists(sample_path):
+            sample_path = sample_assets.path('mp3')
+            if sample_path:
                 fallback_name = f"YouTube_{video_id}.mp3"
                 logger.info(f"Using audio sample file: {sample_path}")
+                fallback_served_total.inc(kind='sample')
                 return sample_path, fallback_name
         
         # Use video sample for all other formats
-        sample_path = os.path.join(SAMPLES_DIR, 'sample.mp4')
-        if os.path.exists(sample_path):
+        sample_path = sample_assets.path('mp4')
+        if sample_path:
             fallback_name = f"YouTube_{video_id}.mp4"
             logger.info(f"Using video sample file: {sample_path}")
+            fallback_served_total.inc(kind='sample')
             return sample_path, fallback_name
-            
-        # Last resort - create an empty file with an error message
-        error_path = os.path.join(TEMP_DIR, f"error_{download_id}.txt")
-        with open(error_path, 'w') as f:
-            f.write("Sorry, the video could not be downloaded. Please try again with a different URL or format.")
         
         return None, None
         
@@ -550,108 +2402,343 @@ def find_downloaded_file(download_id, video_id, format_id, output_dir=TEMP_DIR):
         logger.error(f"Error finding downloaded file: {str(e)}")
         return None, None
 
-def create_sample_audio():
-    """Create or download a sample audio file for audio downloads"""
-    sample_audio_path = os.path.join(SAMPLES_DIR, 'sample.mp3')
+class SampleAssets:
+    """Registry of the fallback files, shared by every failed download and request.
     
-    # If audio sample already exists, return
-    if os.path.exists(sample_audio_path):
-        return sample_audio_path
+    Nothing is fetched at import, so workers boot without touching the
+    network. The first request starts one background thread that downloads
+    the missing samples with bounded timeouts and writes a placeholder for
+    any it cannot fetch. Callers needing a sample wait at most `wait`
+    seconds for it. Resolved paths are remembered per type, and fallbacks
+    are served from these files directly instead of per-request copies.
+    """
     
-    # Ensure samples directory exists
-    if not os.path.exists(SAMPLES_DIR):
-        os.makedirs(SAMPLES_DIR)
+    # Download URL and placeholder header for each sample
+    SOURCES = {
+        'mp4': ("https://samplelib.com/lib/preview/mp4/sample-5s.mp4",
+                b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42mp41\x00\x00\x00\x00'),
+        'mp3': ("https://samplelib.com/lib/preview/mp3/sample-15s.mp3",
+                b'ID3\x03\x00\x00\x00\x00\x00\x00'),
+    }
     
-    try:
-        # Try to download a sample audio file directly
-        logger.info("Downloading sample audio file")
-        audio_url = "https://samplelib.com/lib/preview/mp3/sample-15s.mp3"
-        
-        response = requests.get(audio_url, stream=True)
-        response.raise_for_status()
-        
-        with open(sample_audio_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                
-        logger.info(f"Sample audio downloaded to {sample_audio_path}")
-        return sample_audio_path
+    def __init__(self, directory, source, fetch_timeout, wait):
+        self.directory = directory
+        self.source = source
+        self.fetch_timeout = fetch_timeout
+        self.wait = wait
+        self._done = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._ready = {}  # kind -> sample path known to exist
+        self._placeholders = {}  # kind -> placeholder path written by this process
+    
+    def _path(self, kind):
+        return os.path.join(self.directory, f"sample.{kind}")
+    
+    def ensure_started(self):
+        """Start provisioning any missing samples, once per process"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sample-assets")
+                self._thread.daemon = True
+                self._thread.start()
+    
+    def path(self, kind):
+        """Path of the "mp4" or "mp3" sample, or None if it is not ready in time"""
+        path = self._ready.get(kind)
+        if path:
+            return path
+        path = self._path(kind)
+        if not os.path.exists(path):
+            self.ensure_started()
+            self._done.wait(self.wait)
+            if not os.path.exists(path):
+                return None
+        self._ready[kind] = path
+        return path
+    
+    def placeholder(self, kind):
+        """Path of a placeholder "mp4" or "mp3" file, written at most once per process"""
+        with self._lock:
+            path = self._placeholders.get(kind)
+            if path is None or not os.path.exists(path):
+                path = os.path.join(self.directory, f"placeholder.{kind}")
+                self._write_placeholder(kind, path)
+                self._placeholders[kind] = path
+            return path
+    
+    def _write_placeholder(self, kind, path):
+        # 1MB of zeros after the container header; written under a temporary
+        # name so readers never see a partial file
+        partial = f"{path}.part"
+        with open(partial, 'wb') as f:
+            f.write(self.SOURCES[kind][1])
+            f.write(bytes(1024 * 1024))
+        os.replace(partial, path)
+    
+    def _run(self):
+        try:
+            for kind in self.SOURCES:
+                if not os.path.exists(self._path(kind)):
+                    self._provision(kind)
+        finally:
+            self._done.set()
+    
+    def _provision(self, kind):
+        path = self._path(kind)
+        os.makedirs(self.directory, exist_ok=True)
         
-    except Exception as e:
-        logger.error(f"Failed to download sample audio: {str(e)}")
+        if self.source == 'fetch':
+            # Written under a temporary name so readers never see a partial sample
+            partial = f"{path}.part"
+            try:
+                self._fetch(self.SOURCES[kind][0], partial)
+                os.replace(partial, path)
+                logger.info(f"Sample {kind} downloaded to {path}")
+                return
+            except Exception as e:
+                logger.error(f"Failed to download sample {kind}: {str(e)}")
         
-        # Create a basic MP3 file (1MB of random data with MP3 header)
         try:
-            logger.info("Creating basic MP3 file")
-            with open(sample_audio_path, 'wb') as f:
-                # Simple MP3 header (ID3v2)
-                f.write(b'ID3\x03\x00\x00\x00\x00\x00\x00')
-                # Then add random data
-                f.write(os.urandom(1024 * 1024))
-            
-            logger.info(f"Created basic MP3 file at {sample_audio_path}")
-            return sample_audio_path
-        except Exception as inner_e:
-            logger.error(f"Failed to create basic MP3 file: {str(inner_e)}")
-            return None
+            self._write_placeholder(kind, path)
+            logger.info(f"Created placeholder sample {kind} at {path}")
+        except OSError as e:
+            logger.error(f"Failed to create placeholder sample {kind}: {str(e)}")
+    
+    def _fetch(self, url, path):
+        import requests  # Only needed here, so it stays off the import path
+        deadline = time.monotonic() + self.fetch_timeout
+        with requests.get(url, stream=True, timeout=(min(5, self.fetch_timeout), self.fetch_timeout)) as response:
+            response.raise_for_status()
+            with open(path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Download took longer than {self.fetch_timeout}s")
+                    f.write(chunk)
 
-def create_sample_video(force=False):
-    """Download a sample video to use as fallback if one doesn't exist"""
-    sample_path = os.path.join(SAMPLES_DIR, 'sample.mp4')
+sample_assets = SampleAssets(SAMPLES_DIR, SAMPLE_SOURCE, SAMPLE_FETCH_TIMEOUT, SAMPLE_WAIT_TIMEOUT)
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding up to one second's worth.
     
-    # If the sample video already exists and we're not forcing a new download, return
-    if os.path.exists(sample_path) and not force:
-        return sample_path
-        
-    try:
-        logger.info("Downloading sample video")
-        
-        # Ensure the samples directory exists
-        if not os.path.exists(SAMPLES_DIR):
-            os.makedirs(SAMPLES_DIR)
-            
-        # Download a small sample video from a public source
-        sample_url = "https://samplelib.com/lib/preview/mp4/sample-5s.mp4"
-        
-        response = requests.get(sample_url, stream=True)
-        response.raise_for_status()
-        
-        with open(sample_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-                
-        logger.info(f"Sample video downloaded to {sample_path}")
-        return sample_path
-        
-    except Exception as e:
-        logger.error(f"Failed to download sample video: {str(e)}")
-        
-        # Create a basic MP4 file (1MB of random data with MP4 header)
+    Callers may take more tokens than are available: the bucket goes into
+    debt and reserve() returns how long the caller has to wait, so
+    concurrent callers are paced in the order they asked.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+    
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+    
+    def reserve(self, amount):
+        """Take `amount` tokens and return the seconds to wait before using them"""
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+class BandwidthShare:
+    """A single transfer's claim on a BandwidthManager"""
+    
+    def __init__(self, manager, client):
+        self._manager = manager
+        self.client = client
+        self._closed = False
+    
+    def reserve(self, amount):
+        return self._manager.reserve(self.client, amount)
+    
+    def consume(self, amount):
+        """Account for `amount` bytes, sleeping as long as the rate limits require"""
+        wait = self.reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+    
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._manager.release(self.client)
+
+class BandwidthManager:
+    """Caps the aggregate rate of file transfers and splits it fairly between clients.
+    
+    Every transfer draws from a global bucket and from its client's bucket.
+    Client buckets are rebalanced to an equal share of `rate` whenever a
+    client starts or finishes its transfers, so a client with many parallel
+    downloads cannot starve the others.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self._global = TokenBucket(rate) if rate else None
+        self._clients = {}  # client -> [bucket, open transfers]
+        self._lock = threading.Lock()
+    
+    def open(self, client):
+        """Register a transfer for `client`; close the returned share when it ends"""
+        with self._lock:
+            entry = self._clients.get(client)
+            if entry is None:
+                entry = self._clients[client] = [TokenBucket(self.rate), 0]
+            entry[1] += 1
+            self._rebalance()
+        return BandwidthShare(self, client)
+    
+    def release(self, client):
+        with self._lock:
+            entry = self._clients.get(client)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self._clients[client]
+                    self._rebalance()
+    
+    def _rebalance(self):
+        share = self.rate / max(1, len(self._clients))
+        for bucket, _ in self._clients.values():
+            bucket.set_rate(share)
+    
+    def fair_share(self, client):
+        """Rate a new transfer for `client` would get, in bytes per second"""
+        with self._lock:
+            clients = len(self._clients) + (0 if client in self._clients else 1)
+        return self.rate / clients
+    
+    def reserve(self, client, amount):
+        wait = self._global.reserve(amount)
+        entry = self._clients.get(client)
+        if entry is not None:
+            wait = max(wait, entry[0].reserve(amount))
+        return wait
+    
+    def stats(self):
+        with self._lock:
+            return {'rate': self.rate, 'clients': len(self._clients),
+                    'transfers': sum(count for _, count in self._clients.values())}
+
+serve_bandwidth = BandwidthManager(SERVE_RATE_LIMIT)
+
+class ReleasingFile(io.FileIO):
+    """Read-only file that runs a callback once, when it is closed.
+    
+    The WSGI server closes the file after the last byte is sent (or the
+    client goes away), which is when a pinned artifact can be released. A
+    real file object keeps the server's sendfile() fast path available.
+    With a BandwidthShare, reads are paced by it instead and the descriptor
+    is hidden so the server cannot bypass the pacing with sendfile().
+    """
+    
+    def __init__(self, path, on_close=None, share=None):
+        super().__init__(path, 'rb')
+        self._on_close = on_close
+        self._share = share
+    
+    def read(self, size=-1):
+        data = super().read(size)
+        if self._share is not None and data:
+            self._share.consume(len(data))
+        return data
+    
+    def fileno(self):
+        if self._share is not None:
+            raise io.UnsupportedOperation("fileno is hidden while the transfer is rate limited")
+        return super().fileno()
+    
+    def close(self):
         try:
-            logger.info("Creating basic MP4 file")
-            with open(sample_path, 'wb') as f:
-                # Simple MP4 header (ftyp box)
-                f.write(b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42mp41\x00\x00\x00\x00')
-                # Then add random data
-                f.write(os.urandom(1024 * 1024))
-            
-            logger.info(f"Created basic MP4 file at {sample_path}")
-            return sample_path
-        except Exception as inner_e:
-            logger.error(f"Failed to create basic MP4 file: {str(inner_e)}")
-            return None
+            super().close()
+        finally:
+            callback, self._on_close = self._on_close, None
+            if callback is not None:
+                callback()
+            if self._share is not None:
+                self._share.close()
+
+def send_download(file_path, filename, etag=None, cacheable=False, on_close=None):
+    """Send a file as an attachment with Range, ETag and proxy offload support.
+    
+    `cacheable` marks immutable artifacts that browsers and proxies may
+    reuse; other files must be revalidated. `on_close` runs once the
+    transfer is over, or immediately when the proxy sends the file.
+    """
+    started = time.monotonic()
+    def finished(mode):
+        serve_seconds.observe(time.monotonic() - started, mode=mode)
+        if on_close:
+            on_close()
+    
+    stat = os.stat(file_path)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    etag = etag or f"{int(stat.st_mtime)}-{stat.st_size}"
+    max_age = SERVE_MAX_AGE if cacheable else None
+    cache_root = os.path.join(os.path.abspath(ARTIFACT_CACHE_DIR), '')
+    
+    if SENDFILE_MODE == 'x-accel' and os.path.abspath(file_path).startswith(cache_root):
+        # nginx reads the file from its internal location and handles ranges itself
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = SENDFILE_ACCEL_PREFIX + os.path.relpath(file_path, cache_root)
+        if serve_bandwidth.rate:
+            # nginx paces the transfer itself at the client's current share
+            response.headers["X-Accel-Limit-Rate"] = str(int(serve_bandwidth.fair_share(request.remote_addr)))
+        response.headers.set("Content-Disposition", "attachment", filename=filename)
+        response.set_etag(etag)
+        response.last_modified = stat.st_mtime
+        offloaded = True
+    elif SENDFILE_MODE == 'x-sendfile':
+        # send_file emits X-Sendfile because USE_X_SENDFILE is enabled
+        response = send_file(file_path, as_attachment=True, download_name=filename,
+                             mimetype=mimetype, etag=etag, max_age=max_age)
+        offloaded = True
+    else:
+        share = serve_bandwidth.open(request.remote_addr) if serve_bandwidth.rate else None
+        file = ReleasingFile(file_path, lambda: finished('direct'), share)
+        try:
+            response = send_file(file, as_attachment=True, download_name=filename, mimetype=mimetype,
+                                 conditional=False, etag=etag, last_modified=stat.st_mtime, max_age=max_age)
+            response.content_length = stat.st_size
+            response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+        except Exception:
+            file.close()
+            raise
+        offloaded = False
+    
+    if offloaded:
+        finished('offload')
+    
+    if cacheable:
+        response.cache_control.public = True
+        response.cache_control.max_age = SERVE_MAX_AGE
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
 
-# Ensure the sample files exist for fallback
-create_sample_video()
-create_sample_audio()
+@app.before_request
+def start_background_tasks():
+    # Started on the first request so importing the app spawns no threads
+    temp_janitor.ensure_started()
+    sample_assets.ensure_started()
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/get_video_info', methods=['POST'])
+@app.route('/get_video_info', methods=['GET', 'POST'])
 def get_info():
-    url = request.form.get('url', '')
+    url = request.values.get('url', '')
     
     if not url:
         return jsonify({'error': 'No URL provided'}), 400
@@ -662,10 +2749,57 @@ def get_info():
     try:
         # Get video info using yt-dlp
         video_info = get_video_info_with_ytdlp(url)
-        return jsonify(video_info)
     except Exception as e:
         logger.error(f"Error in get_info: {str(e)}")
         return jsonify({'error': str(e)}), 500
+    
+    # Only GETs are conditional; a matching If-None-Match on a POST must not become a 304
+    status, body, headers = info_response_parts(
+        video_info, request.headers.get('Accept-Encoding'),
+        request.headers.get('If-None-Match') if request.method == 'GET' else None)
+    return Response(body, status=status, headers=headers)
+
+def start_download(url, format_id, client=None, priority=0, max_per_client=None):
+    """Start (or reuse) a download and return its initial progress payload.
+    
+    Cached artifacts complete immediately and identical in-flight downloads
+    are joined. Raises SchedulerFull when the download cannot be queued.
+    """
+    # Serve straight from the artifact cache when this video/format was already downloaded
+    cache_key = artifact_key(url, format_id)
+    if artifact_cache.contains(cache_key):
+        download_id = uuid.uuid4().hex
+        update_job(download_id, progress=100, status="completed", artifact_key=cache_key)
+        download_logger.info(f"Artifact cache hit for {url} ({format_id}), download ID {download_id}")
+        return {'download_id': download_id, 'status': 'completed', 'cached': True}
+    
+    # Ensure the temporary directory exists
+    os.makedirs(TEMP_DIR, exist_ok=True)
+    
+    # Join an identical download that is already running instead of starting another
+    key = download_key(url, format_id)
+    with inflight_downloads_lock:
+        existing_id = inflight_downloads.get(key)
+        if existing_id is not None:
+            download_logger.info(f"Joining in-flight download {existing_id} for {key}")
+            return {'download_id': existing_id}
+        
+        # Create the job with a unique download ID
+        job = DownloadJob(url, format_id, client=client)
+        download_id = job.download_id
+        inflight_downloads[key] = download_id
+    
+    # Hand the download to the bounded worker pool
+    prune_jobs()
+    update_job(download_id, progress=0, status="queued", **job.to_dict())
+    try:
+        download_scheduler.submit(job, priority=priority, max_per_client=max_per_client)
+    except SchedulerFull:
+        job_store.delete(download_id)
+        release_inflight_download(url, format_id, download_id)
+        raise
+    
+    return {'download_id': download_id, 'status': 'queued'}
 
 @app.route('/download', methods=['POST'])
 def download():
@@ -678,182 +2812,657 @@ def download():
     if not is_valid_youtube_url(url):
         return jsonify({'error': 'Invalid YouTube URL'}), 400
     
-    # Generate a unique download ID
-    download_id = str(int(time.time()))
-    
-    # Always use the temporary directory
-    output_dir = TEMP_DIR
+    # Clients may only yield to other interactive downloads, never jump ahead
+    # of them or fall behind batch items
+    try:
+        priority = min(max(int(request.form.get('priority', 0)), 0), BATCH_PRIORITY)
+    except ValueError:
+        priority = 0
     
-    # Ensure the temporary directory exists
     try:
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-    except Exception as e:
+        return jsonify(start_download(url, format_id, client=request.remote_addr, priority=priority))
+    except SchedulerFull as e:
+        download_logger.warning(f"Rejected download for {url}: {str(e)}")
+        return jsonify({'error': str(e)}), 429
+    except OSError as e:
         logger.error(f"Error creating temporary directory: {str(e)}")
         return jsonify({'error': f'Error creating temporary directory: {str(e)}'}), 500
-    
-    # Start download in a separate thread
-    thread = threading.Thread(target=download_with_ytdlp, args=(url, format_id, download_id, output_dir))
-    thread.daemon = True
-    thread.start()
-    
-    return jsonify({'download_id': download_id})
+
+def job_progress(download_id, job):
+    """Progress payload reported to clients for a job"""
+    status = job.get('status', "pending")
+    data = {
+        'progress': job.get('progress', 0),
+        'status': status,
+        'phase': job.get('phase'),
+        'downloaded_bytes': job.get('downloaded_bytes'),
+        'total_bytes': job.get('total_bytes'),
+        'speed': job.get('speed'),
+        'eta': job.get('eta'),
+        'throughput': job.get('throughput'),
+        'connections': job.get('connections'),
+        'fragment_index': job.get('fragment_index'),
+        'fragment_count': job.get('fragment_count')
+    }
+    if status == "queued":
+        data['queue_position'] = download_scheduler.position(download_id)
+    return data
 
 @app.route('/download_progress/<download_id>')
 def get_progress(download_id):
-    progress = download_progress.get(download_id, 0)
-    status = download_status.get(download_id, "pending")
+    job = job_store.get(download_id) or {}
+    data = job_progress(download_id, job)
     
-    # Log the progress for debugging
-    logger.info(f"Progress request for {download_id}: {progress}% - Status: {status}")
+    if progress_logger.isEnabledFor(logging.DEBUG) and poll_log_sampler.ready(download_id):
+        progress_logger.debug(f"Progress request for {download_id}: {data['progress']}% - Status: {data['status']}")
     
-    return jsonify({
-        'progress': progress,
-        'status': status
-    })
+    return jsonify(data)
 
-@app.route('/get_file/<download_id>')
-def get_file(download_id):
-    """Serve the downloaded file to the user"""
-    logger.info(f"Attempting to serve file for download ID: {download_id}")
+@app.route('/download_events/<download_id>')
+def download_events(download_id):
+    """Stream progress updates for a download as Server-Sent Events"""
+    
+    def generate():
+        deadline = time.monotonic() + PROGRESS_STREAM_TIMEOUT
+        last_payload = None
+        last_sent = time.monotonic()
+        while True:
+            # Read the version before the job so no update can slip in between
+            version = job_events.version(download_id)
+            payload = job_progress(download_id, job_store.get(download_id) or {})
+            now = time.monotonic()
+            if payload != last_payload:
+                yield f"data: {json.dumps(payload)}\n\n"
+                last_payload = payload
+                last_sent = now
+            elif now - last_sent >= 15:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                last_sent = now
+            if JobStore.is_finished(payload['status']) or now >= deadline:
+                return
+            job_events.wait(download_id, version, timeout=1.0)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Disable proxy buffering (nginx)
+    return response
+
+def stream_format_selector(format_id):
+    """yt-dlp selector for formats that can be piped straight to the client.
     
+    Only single files that need no merging or conversion qualify; returns
+    None for merged and audio-extraction formats.
+    """
+    if format_id == 'best':
+        return 'best[ext=mp4]/best'
+    if '+' in format_id or 'best' in format_id.lower() or is_audio_format(format_id):
+        return None
+    return format_id
+
+def stream_filename(url, format_id):
+    """Attachment name for a streamed download, using the cached info's extension when known"""
+    ext = 'mp4'
+    cached = metadata_cache.get(extract_video_id(url))
+    if cached:
+        for entry in cached.get('streams', []):
+            if entry.get('format_id') == format_id and entry.get('ext'):
+                ext = entry['ext']
+                break
+    return f"{extract_video_id(url) or 'video'}_{format_id}.{ext}"
+
+def stream_command(url, selector):
+    """Command line that writes the selected format to stdout"""
+    return ['yt-dlp', '--no-warnings', '--quiet', '--no-progress', '-f', selector, '-o', '-', url]
+
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONCURRENT)
+
+def open_stream_shares(client):
+    """Rate limits a /stream transfer is paced by: its share of the download and of the serving limit"""
+    shares = [download_scheduler.open_stream(client)]
+    if serve_bandwidth.rate:
+        shares.append(serve_bandwidth.open(client))
+    return [share for share in shares if share is not None]
+
+def stream_wait(shares, amount):
+    """Seconds to wait before relaying `amount` more bytes of a stream"""
+    return max((share.reserve(amount) for share in shares), default=0.0)
+
+@app.route('/stream')
+def stream():
+    """Pipe a single-file format to the client while yt-dlp downloads it"""
     url = request.args.get('url', '')
     format_id = request.args.get('format_id', 'best')
     
+    if not url or not is_valid_youtube_url(url):
+        return jsonify({'error': 'Invalid YouTube URL'}), 400
+    
+    selector = stream_format_selector(format_id)
+    if selector is None:
+        return jsonify({'error': f'Format {format_id} cannot be streamed, use /download instead'}), 400
+    
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many streams in progress, please try again later'}), 429
+    
+    cmd = stream_command(url, selector)
+    logger.debug(f"Running stream command: {' '.join(cmd)}")
+    
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Wait for the first bytes so failures can still be reported as an error response
+        first_chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+    except Exception as e:
+        stream_slots.release()
+        logger.error(f"Error starting stream for {url}: {str(e)}")
+        return jsonify({'error': f'Error starting stream: {str(e)}'}), 500
+    
+    if not first_chunk:
+        process.wait()
+        error = process.stderr.read().decode('utf-8', 'replace').strip() or "yt-dlp produced no output"
+        stream_slots.release()
+        logger.error(f"Stream failed for {url}: {error}")
+        subprocess_failures_total.inc(operation='stream', error=classify_ytdlp_error(error))
+        return jsonify({'error': error}), 502
+    
+    client = request.remote_addr
+    def generate():
+        shares = open_stream_shares(client)
+        try:
+            chunk = first_chunk
+            while chunk:
+                wait = stream_wait(shares, len(chunk))
+                if wait > 0:
+                    time.sleep(wait)
+                yield chunk
+                chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+            if process.wait() != 0:
+                error = process.stderr.read().decode('utf-8', 'replace').strip()
+                logger.error(f"Stream for {url} ended with an error: {error}")
+                subprocess_failures_total.inc(operation='stream', error=classify_ytdlp_error(error))
+        finally:
+            # Stop yt-dlp if the client disconnected early
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+            for share in shares:
+                share.close()
+            stream_slots.release()
+    
+    filename = stream_filename(url, format_id)
+    response = Response(generate(), mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+def resolve_download(download_id, url, format_id):
+    """Find the file to serve for a download.
+    
+    Returns (file_path, filename, cache_key). A cache_key means the path is
+    a cached artifact pinned for the caller, who must release it once sent.
+    Falls back to the samples and, as a last resort, a generated dummy file;
+    returns (None, None, None) if even that fails.
+    """
     # Extract the video ID from the URL
     video_id = extract_video_id(url) or download_id
     
     # Check if this download is marked as completed
-    status = download_status.get(download_id)
+    job = job_store.get(download_id) or {}
+    status = job.get('status')
     if status != "completed" and status != "completed_fallback":
         logger.warning(f"Download status for {download_id} is {status}, not 'completed' or 'completed_fallback'")
         # Continue anyway - we'll try to serve what we have
     
+    # Prefer the cached artifact, pinned so it cannot be evicted while it is sent
+    cache_key = job.get('artifact_key')
+    cached_path = artifact_cache.acquire(cache_key)
+    if cached_path:
+        logger.info(f"Serving cached file: {cached_path}")
+        return cached_path, f"{video_id}_{format_id}{os.path.splitext(cached_path)[1]}", cache_key
+    
     # Try to find the downloaded file
     file_path, filename = find_downloaded_file(download_id, video_id, format_id)
     
     if file_path and os.path.exists(file_path):
         logger.info(f"Serving file: {file_path}")
-        # Force attachment download to the user's computer
-        response = send_file(file_path, as_attachment=True, download_name=filename)
-        
-        # Add headers to ensure browser downloads the file
-        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-        response.headers["Content-Type"] = "application/octet-stream"
-        response.headers["Content-Transfer-Encoding"] = "binary"
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-        
-        # Check if this is a temp file that should be cleaned up after download
-        if TEMP_DIR in file_path:
-            # Use a new thread to delete the temp file after a delay
-            def delete_file_after_delay(file_path, delay=10):
-                try:
-                    time.sleep(delay)  # Wait to ensure file is fully transferred
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        logger.info(f"Successfully cleaned up temporary file: {file_path}")
-                except Exception as e:
-                    logger.error(f"Error deleting temporary file {file_path}: {str(e)}")
-            
-            # Start the cleanup thread
-            cleanup_thread = threading.Thread(target=delete_file_after_delay, args=(file_path,))
-            cleanup_thread.daemon = True  # Don't let this block application shutdown
-            cleanup_thread.start()
-            logger.info(f"Scheduled cleanup for temp file: {file_path}")
-        
-        return response
+        if status == "completed_fallback":
+            fallback_served_total.inc(kind='completed_fallback')
+        return file_path, filename, None
     
     # If we couldn't find a file, try to use our sample files
-    is_audio = format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
+    is_audio = is_audio_format(format_id)
     
     if is_audio:
         # Try audio sample for audio formats
-        sample_path = os.path.join(SAMPLES_DIR, 'sample.mp3')
-        if os.path.exists(sample_path):
+        sample_path = sample_assets.path('mp3')
+        if sample_path:
             logger.info(f"Using audio sample file as emergency fallback: {sample_path}")
-            filename = f"YouTube_Audio_{video_id}.mp3"
-            response = send_file(sample_path, as_attachment=True, download_name=filename)
-            
-            # Force download headers
-            response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-            response.headers["Content-Type"] = "application/octet-stream"
-            response.headers["Content-Transfer-Encoding"] = "binary"
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            
-            return response
+            fallback_served_total.inc(kind='sample')
+            return sample_path, f"YouTube_Audio_{video_id}.mp3", None
     
     # For video formats or if audio sample doesn't exist
-    sample_path = os.path.join(SAMPLES_DIR, 'sample.mp4')
-    if os.path.exists(sample_path):
+    sample_path = sample_assets.path('mp4')
+    if sample_path:
         logger.info(f"Using video sample file as emergency fallback: {sample_path}")
-        filename = f"YouTube_Video_{video_id}.mp4"
-        response = send_file(sample_path, as_attachment=True, download_name=filename)
-        
-        # Force download headers
-        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-        response.headers["Content-Type"] = "application/octet-stream"
-        response.headers["Content-Transfer-Encoding"] = "binary"
-        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-        response.headers["Pragma"] = "no-cache"
-        response.headers["Expires"] = "0"
-        
-        return response
+        fallback_served_total.inc(kind='sample')
+        return sample_path, f"YouTube_Video_{video_id}.mp4", None
+    
+    # Last resort - a placeholder built once per type, while the samples are not available
+    try:
+        kind = 'mp3' if is_audio else 'mp4'
+        emergency_path = sample_assets.placeholder(kind)
+        logger.warning(f"Serving the {kind} placeholder as emergency fallback for {download_id}")
+        fallback_served_total.inc(kind='emergency')
+        return emergency_path, f"YouTube_{'Audio' if is_audio else 'Video'}_{video_id}.{kind}", None
+    except Exception as e:
+        logger.error(f"Critical error creating emergency file: {str(e)}")
+        return None, None, None
+
+@app.route('/get_file/<download_id>')
+def get_file(download_id):
+    """Serve the downloaded file to the user"""
+    logger.debug(f"Attempting to serve file for download ID: {download_id}")
+    
+    url = request.args.get('url', '')
+    format_id = request.args.get('format_id', 'best')
+    
+    file_path, filename, cache_key = resolve_download(download_id, url, format_id)
+    if file_path is None:
+        return jsonify({'error': 'Unable to serve media file'}), 500
+    
+    if cache_key:
+        try:
+            # The ETag changes whenever the artifact is re-published, so If-Range
+            # resumes never join two different downloads
+            return send_download(file_path, filename, etag=artifact_etag(cache_key, file_path), cacheable=True,
+                                 on_close=lambda: artifact_cache.release(cache_key))
+        except Exception:
+            artifact_cache.release(cache_key)
+            raise
+    
+    # Force attachment download to the user's computer
+    response = send_download(file_path, filename)
+    
+    # Temp files are reclaimed by the janitor once the resume grace period is over
+    if TEMP_DIR in file_path:
+        temp_janitor.mark_served(file_path)
+    
+    return response
+
+metrics.counter_callback(
+    'ytdl_cache_hits_total', 'Cache lookups that found an entry', lambda: {
+        'metadata': metadata_cache.stats()['hits'],
+        'format_table': format_table_cache.stats()['hits'],
+        'artifact': artifact_cache.stats()['hits'],
+    }, ['cache'])
+metrics.counter_callback(
+    'ytdl_cache_misses_total', 'Cache lookups that found nothing', lambda: {
+        'metadata': metadata_cache.stats()['misses'],
+        'format_table': format_table_cache.stats()['misses'],
+        'artifact': artifact_cache.stats()['misses'],
+    }, ['cache'])
+metrics.gauge_callback(
+    'ytdl_cache_bytes', 'Bytes held by each cache', lambda: {
+        'metadata': metadata_cache.stats()['bytes'],
+        'artifact': artifact_cache.stats()['bytes'],
+    }, ['cache'])
+metrics.counter_callback(
+    'ytdl_info_coalesced_total', 'Metadata lookups that joined an extraction already in flight',
+    lambda: info_flight.coalesced)
+metrics.gauge_callback(
+    'ytdl_jobs', 'Downloads running and waiting in the scheduler', lambda: {
+        'active': download_scheduler.stats()['active'],
+        'queued': download_scheduler.stats()['queued'],
+    }, ['state'])
+metrics.gauge_callback(
+    'ytdl_postprocess_jobs', 'Encodes running and waiting in the postprocessing pool', lambda: {
+        'active': postprocess_pool.stats()['active'],
+        'queued': postprocess_pool.stats()['queued'],
+    }, ['state'])
+metrics.gauge_callback(
+    'ytdl_download_connections', 'Connections granted to running downloads',
+    lambda: download_scheduler.stats()['connections'])
+metrics.gauge_callback(
+    'ytdl_temp_dir_bytes', 'Bytes in TEMP_DIR as of the last janitor pass',
+    lambda: temp_janitor.stats()['temp_bytes'])
+metrics.counter_callback(
+    'ytdl_temp_reclaimed_bytes_total', 'Bytes removed from TEMP_DIR by the janitor',
+    lambda: temp_janitor.stats()['reclaimed_bytes'])
+metrics.gauge_callback(
+    'ytdl_import_seconds', 'Time this process took to import the app',
+    lambda: IMPORT_SECONDS)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Pipeline metrics of this process in the Prometheus text format"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def is_collection_url(url):
+    """Check if a URL points at a YouTube playlist or channel rather than a single video"""
+    if re.search(r'youtube\.com/(playlist\?|@|channel/|c/|user/)', url):
+        return True
+    # A watch URL that carries a list= parameter still means the single video
+    return 'list=' in url and 'v=' not in url
+
+def expand_collection(url):
+    """List the videos of a playlist or channel without extracting each one"""
+    yt_dlp = load_yt_dlp() if YTDLP_ENGINE == 'inprocess' else None
+    if yt_dlp is not None:
+        options = {
+            'quiet': True,
+            'no_warnings': True,
+            'skip_download': True,
+            'extract_flat': 'in_playlist',
+            'playlistend': BATCH_MAX_ITEMS,
+            'socket_timeout': YTDLP_INFO_TIMEOUT,
+        }
+        with yt_dlp.YoutubeDL(options) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    else:
+        cmd = ['yt-dlp', '--no-warnings', '--flat-playlist', '--playlist-end', str(BATCH_MAX_ITEMS), '-J', url]
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=YTDLP_INFO_TIMEOUT * 4)
+        if result.returncode != 0:
+            raise Exception(f"yt-dlp error: {result.stderr.strip() or 'Unknown error'}")
+        info = json.loads(result.stdout)
     
-    # Last resort - create a dummy file
+    items = []
+    pending = list(info.get('entries') or [])
+    while pending and len(items) < BATCH_MAX_ITEMS:
+        entry = pending.pop(0)
+        if not entry:
+            continue
+        # Channel pages list their tabs as nested playlists
+        if entry.get('_type') == 'playlist':
+            pending[:0] = entry.get('entries') or []
+            continue
+        video_id = entry.get('id')
+        if not video_id or len(video_id) != 11:
+            continue
+        items.append({
+            'url': f"https://www.youtube.com/watch?v={video_id}",
+            'video_id': video_id,
+            'title': entry.get('title'),
+        })
+    return items
+
+batch_slots = threading.BoundedSemaphore(BATCH_MAX_ACTIVE)
+
+def run_batch(batch_id, sources, format_id):
+    """Expand a batch and feed its items to the download scheduler"""
     try:
-        is_audio = format_id == 'bestaudio' or 'audio' in format_id.lower() or 'Audio' in format_id
+        items = []
+        for source in sources:
+            if is_collection_url(source):
+                items.extend(expand_collection(source))
+            else:
+                items.append({'url': source, 'video_id': extract_video_id(source), 'title': None})
         
-        if is_audio:
-            # Create emergency audio file
-            logger.warning("Creating emergency MP3 file")
-            emergency_path = os.path.join(TEMP_DIR, f"emergency_{download_id}.mp3")
-            with open(emergency_path, 'wb') as f:
-                # Simple MP3 header (ID3v2)
-                f.write(b'ID3\x03\x00\x00\x00\x00\x00\x00')
-                # Then add random data
-                f.write(os.urandom(1024 * 1024))
-            
-            filename = f"YouTube_Audio_{video_id}.mp3"
-            response = send_file(emergency_path, as_attachment=True, download_name=filename)
-            
-            # Force download headers
-            response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-            response.headers["Content-Type"] = "application/octet-stream"
-            response.headers["Content-Transfer-Encoding"] = "binary"
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            
-            return response
-        else:
-            # Create emergency video file
-            logger.warning("Creating emergency MP4 file")
-            emergency_path = os.path.join(TEMP_DIR, f"emergency_{download_id}.mp4")
-            with open(emergency_path, 'wb') as f:
-                # Simple MP4 header (ftyp box)
-                f.write(b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42mp41\x00\x00\x00\x00')
-                # Then add random data
-                f.write(os.urandom(1024 * 1024))
-            
-            filename = f"YouTube_Video_{video_id}.mp4"
-            response = send_file(emergency_path, as_attachment=True, download_name=filename)
+        # Drop duplicates, keeping the first occurrence of each video
+        seen = set()
+        unique = []
+        for item in items:
+            if item['video_id'] not in seen:
+                seen.add(item['video_id'])
+                unique.append(dict(item, download_id=None))
+        items = unique[:BATCH_MAX_ITEMS]
+        update_job(batch_id, status="running", items=items)
+        logger.info(f"Batch {batch_id} expanded to {len(items)} items")
+        
+        # The batch is its own client, so at most BATCH_PARALLELISM items are
+        # active or queued at a time and interactive downloads are not starved
+        client = f"batch:{batch_id}"
+        for item in items:
+            while True:
+                try:
+                    result = start_download(item['url'], format_id, client=client,
+                                            priority=BATCH_PRIORITY, max_per_client=BATCH_PARALLELISM)
+                    break
+                except SchedulerFull:
+                    time.sleep(1)
+            item['download_id'] = result['download_id']
+            update_job(batch_id, items=items)
+        
+        # Wait for the remaining items so the batch reports when it is done
+        unfinished = {item['download_id'] for item in items}
+        while unfinished:
+            for download_id in list(unfinished):
+                job = job_store.get(download_id) or {}
+                if JobStore.is_finished(job.get('status')):
+                    unfinished.discard(download_id)
+            if unfinished:
+                time.sleep(1)
+        update_job(batch_id, status="completed")
+    except Exception as e:
+        logger.error(f"Batch {batch_id} failed: {str(e)}")
+        update_job(batch_id, status=f"error: {str(e)}")
+    finally:
+        batch_slots.release()
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Download a playlist, a channel or a list of URLs as one batch"""
+    format_id = request.form.get('format_id', 'best')
+    sources = [line.strip() for line in request.form.get('urls', '').splitlines() if line.strip()]
+    if request.form.get('url'):
+        sources.insert(0, request.form['url'].strip())
+    
+    if not sources:
+        return jsonify({'error': 'No URLs provided'}), 400
+    
+    invalid = [u for u in sources if not is_collection_url(u) and not is_valid_youtube_url(u)]
+    if invalid:
+        return jsonify({'error': 'Invalid YouTube URL', 'urls': invalid}), 400
+    
+    if not batch_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many batches in progress, please try again later'}), 429
+    
+    batch_id = uuid.uuid4().hex
+    update_job(batch_id, kind="batch", status="expanding", format_id=format_id, items=[])
+    thread = threading.Thread(target=run_batch, args=(batch_id, sources, format_id), name=f"batch-{batch_id[:8]}")
+    thread.daemon = True
+    thread.start()
+    
+    return jsonify({'batch_id': batch_id, 'status': 'expanding'})
+
+@app.route('/batch_progress/<batch_id>')
+def batch_progress(batch_id):
+    """Aggregate progress of a batch plus the status of each item"""
+    batch_job = job_store.get(batch_id)
+    if not batch_job or batch_job.get('kind') != 'batch':
+        return jsonify({'error': 'Unknown batch'}), 404
+    
+    items = []
+    counts = {}
+    total_progress = 0
+    for item in batch_job.get('items', []):
+        job = job_store.get(item['download_id']) if item.get('download_id') else None
+        if job is None:
+            job = {'status': 'waiting', 'progress': 0}
+        status = job.get('status', 'pending')
+        state = status.split(':', 1)[0]
+        counts[state] = counts.get(state, 0) + 1
+        total_progress += job.get('progress', 0)
+        items.append({
+            'video_id': item['video_id'],
+            'title': item.get('title'),
+            'download_id': item.get('download_id'),
+            'status': status,
+            'progress': job.get('progress', 0),
+        })
+    
+    return jsonify({
+        'batch_id': batch_id,
+        'status': batch_job.get('status'),
+        'total': len(items),
+        'progress': total_progress / len(items) if items else 0,
+        'counts': counts,
+        'items': items,
+    })
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Unseekable sink that collects what zipfile writes so it can be streamed"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+@app.route('/batch_zip/<batch_id>')
+def batch_zip(batch_id):
+    """Stream the completed items of a batch as a single ZIP archive"""
+    batch_job = job_store.get(batch_id)
+    if not batch_job or batch_job.get('kind') != 'batch':
+        return jsonify({'error': 'Unknown batch'}), 404
+    
+    format_id = batch_job.get('format_id', 'best')
+    items = [item for item in batch_job.get('items', []) if item.get('download_id')]
+    
+    def generate():
+        buffer = _ZipStreamBuffer()
+        # Media files do not compress, so entries are stored as-is
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for index, item in enumerate(items, start=1):
+                job = job_store.get(item['download_id']) or {}
+                if job.get('status') != "completed":
+                    continue
+                cache_key = job.get('artifact_key')
+                path = artifact_cache.acquire(cache_key)
+                pinned = path is not None
+                if not pinned:
+                    path = job.get('output_path')
+                    if not path or not os.path.exists(path):
+                        continue
+                try:
+                    name = secure_filename(item.get('title') or '') or item['video_id']
+                    arcname = f"{index:03d}_{name}{os.path.splitext(path)[1]}"
+                    with open(path, 'rb') as src, archive.open(arcname, 'w', force_zip64=True) as dst:
+                        while True:
+                            chunk = src.read(STREAM_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dst.write(chunk)
+                            yield buffer.drain()
+                finally:
+                    if pinned:
+                        artifact_cache.release(cache_key)
+                yield buffer.drain()
+        yield buffer.drain()
+    
+    response = Response(generate(), mimetype='application/zip')
+    response.headers.set("Content-Disposition", "attachment", filename=f"batch_{batch_id[:8]}_{format_id}.zip")
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+bulk_info_slots = threading.BoundedSemaphore(BULK_INFO_MAX_ACTIVE)
+
+def split_url_list(text):
+    """URLs from a pasted list or CSV text, separated by newlines, commas or whitespace"""
+    return [item.strip('"\'') for item in re.split(r'[\s,;]+', text or '') if item.strip('"\'')]
+
+def group_video_urls(sources):
+    """De-duplicate URLs by video ID.
+    
+    Returns an ordered mapping of video ID to its canonical watch URL and
+    the inputs that named it, plus the inputs that are not video URLs.
+    """
+    videos = OrderedDict()
+    invalid = []
+    for source in sources:
+        video_id = extract_video_id(source) if is_valid_youtube_url(source) else None
+        if not video_id:
+            invalid.append(source)
+            continue
+        entry = videos.setdefault(video_id, {'url': f"https://www.youtube.com/watch?v={video_id}", 'inputs': []})
+        entry['inputs'].append(source)
+    return videos, invalid
+
+def info_error_message(error):
+    """Client-facing message for a failed metadata lookup"""
+    if isinstance(error, (subprocess.TimeoutExpired, TimeoutError)):
+        return "Video processing timed out"
+    if isinstance(error, json.JSONDecodeError):
+        return "Failed to parse video information"
+    return str(error)
+
+def json_url_list(payload):
+    """URLs from a JSON /bulk_info body, a list or {"urls": [...]}; None if it is neither"""
+    urls = payload.get('urls') if isinstance(payload, dict) else payload
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        return None
+    return [url.strip() for url in urls if url.strip()]
+
+def ndjson_line(payload):
+    return json.dumps(payload, separators=(',', ':')) + '\n'
+
+@app.route('/bulk_info', methods=['POST'])
+def bulk_info():
+    """Resolve many URLs at once, streaming one NDJSON line per video as each lookup finishes"""
+    if request.is_json:
+        sources = json_url_list(request.get_json(silent=True))
+        if sources is None:
+            return jsonify({'error': 'Expected a JSON list of URLs or an object with a "urls" list'}), 400
+    else:
+        sources = split_url_list(request.form.get('urls', ''))
+    
+    if not sources:
+        return jsonify({'error': 'No URLs provided'}), 400
+    if len(sources) > BULK_INFO_MAX_URLS:
+        return jsonify({'error': f'Too many URLs, at most {BULK_INFO_MAX_URLS} are allowed'}), 400
+    
+    videos, invalid = group_video_urls(sources)
+    
+    if not bulk_info_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many bulk lookups in progress, please try again later'}), 429
+    
+    def generate():
+        pool = ThreadPoolExecutor(max_workers=max(1, BULK_INFO_CONCURRENCY), thread_name_prefix="bulk-info")
+        try:
+            for source in invalid:
+                yield ndjson_line({'input': source, 'error': 'Invalid YouTube URL'})
             
-            # Force download headers
-            response.headers["Content-Disposition"] = f"attachment; filename={filename}"
-            response.headers["Content-Type"] = "application/octet-stream"
-            response.headers["Content-Transfer-Encoding"] = "binary"
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
+            futures = {pool.submit(resolve_video_info, entry['url']): video_id for video_id, entry in videos.items()}
+            failed = 0
+            for future in as_completed(futures):
+                video_id = futures[future]
+                line = {'video_id': video_id, **videos[video_id]}
+                try:
+                    line['info'] = future.result()
+                except Exception as e:
+                    info_logger.warning(f"Bulk lookup failed for {video_id}: {str(e)}")
+                    line['error'] = info_error_message(e)
+                    failed += 1
+                yield ndjson_line(line)
             
-            return response
-    except Exception as e:
-        logger.error(f"Critical error serving file: {str(e)}")
-        return jsonify({'error': 'Unable to serve media file'}), 500
+            yield ndjson_line({'done': True, 'videos': len(videos), 'failed': failed, 'invalid': len(invalid)})
+        finally:
+            # Lookups not started yet are dropped when the client goes away
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(bulk_info_slots.release)
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+if IMPORT_SECONDS > IMPORT_TIME_BUDGET:
+    logger.warning(f"Importing the app took {IMPORT_SECONDS * 1000:.0f} ms, "
+                   f"over the {IMPORT_TIME_BUDGET * 1000:.0f} ms budget")
+else:
+    logger.debug(f"Imported the app in {IMPORT_SECONDS * 1000:.0f} ms")
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,536 @@
+"""Asynchronous (ASGI) entry point.
+
+The slow and long-lived endpoints run natively on an asyncio event loop:
+metadata lookups and /stream use asyncio subprocesses, files are sent with
+non-blocking reads and progress streams wait on the loop instead of holding
+a thread each, so thousands of them fit in one process. Every other route
+is served by the Flask app through a WSGI adapter.
+
+Run with: uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import mimetypes
+import os
+import subprocess
+import time
+from email.utils import formatdate
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import dump_options_header, parse_options_header
+from werkzeug.sansio.http import is_resource_modified
+
+from app import (
+    ARTIFACT_CACHE_DIR,
+    BULK_INFO_CONCURRENCY,
+    BULK_INFO_MAX_URLS,
+    PROGRESS_STREAM_TIMEOUT,
+    SENDFILE_ACCEL_PREFIX,
+    SENDFILE_MODE,
+    SERVE_MAX_AGE,
+    STREAM_CHUNK_SIZE,
+    TEMP_DIR,
+    YTDLP_ENGINE,
+    YTDLP_INFO_TIMEOUT,
+    JobStore,
+    SQLiteJobStore,
+    app as flask_app,
+    artifact_cache,
+    artifact_etag,
+    build_video_info,
+    bulk_info_slots,
+    classify_ytdlp_error,
+    extract_raw_video_info,
+    extract_video_id,
+    fallback_video_info,
+    group_video_urls,
+    info_command,
+    info_error_message,
+    info_extraction_seconds,
+    info_response_parts,
+    is_valid_youtube_url,
+    job_events,
+    job_progress,
+    job_store,
+    json_url_list,
+    metadata_cache,
+    ndjson_line,
+    open_stream_shares,
+    resolve_download,
+    sample_assets,
+    serve_bandwidth,
+    serve_seconds,
+    split_url_list,
+    stream_command,
+    stream_filename,
+    stream_format_selector,
+    stream_slots,
+    stream_wait,
+    subprocess_failures_total,
+    temp_janitor,
+)
+
+logger = logging.getLogger(__name__)
+
+# Threads the WSGI adapter uses to run the Flask routes
+ASGI_WSGI_WORKERS = int(os.environ.get("ASGI_WSGI_WORKERS", "10"))
+
+class AsyncSingleFlight:
+    """Event-loop counterpart of app.SingleFlight.
+    
+    The first caller for a key starts a task; later callers await the same
+    task, which keeps running even if the caller that started it goes away.
+    """
+    
+    def __init__(self):
+        self._tasks = {}
+        self.coalesced = 0
+    
+    async def do(self, key, fn, *args):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+info_flight = AsyncSingleFlight()
+
+async def extract_raw_video_info_async(url):
+    """Return the raw yt-dlp info dict without blocking the event loop"""
+    if YTDLP_ENGINE == 'inprocess':
+        # YoutubeDL is blocking Python code (imported on first use, falling
+        # back to the executable when missing), so it runs on the thread pool
+        return await run_in_threadpool(extract_raw_video_info, url)
+    
+    started = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *info_command(url), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), YTDLP_INFO_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        subprocess_failures_total.inc(operation='info', error='timeout')
+        raise
+    finally:
+        info_extraction_seconds.observe(time.monotonic() - started, engine='subprocess')
+    
+    if process.returncode != 0:
+        error_msg = stderr.decode('utf-8', 'replace').strip() or "Unknown error"
+        logger.error(f"yt-dlp error: {error_msg}")
+        subprocess_failures_total.inc(operation='info', error=classify_ytdlp_error(error_msg))
+        raise Exception(f"yt-dlp error: {error_msg}")
+    return json.loads(stdout)
+
+async def read_job(job_id):
+    """Read a job without letting a busy SQLite database stall the event loop"""
+    if isinstance(job_store, SQLiteJobStore):
+        return await run_in_threadpool(job_store.get, job_id) or {}
+    return job_store.get(job_id) or {}
+
+class JobWaiters:
+    """Wakes progress streams on the event loop when a job they follow changes.
+    
+    Hooks into app.job_events, whose notifications come from download
+    worker threads, and hands them over to the loop thread-safely.
+    """
+    
+    def __init__(self):
+        self._loop = None
+        self._events = {}
+    
+    def register(self, job_id):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            job_events.add_listener(self._notify)
+        event = asyncio.Event()
+        self._events.setdefault(job_id, set()).add(event)
+        return event
+    
+    def unregister(self, job_id, event):
+        events = self._events.get(job_id)
+        if events is not None:
+            events.discard(event)
+            if not events:
+                del self._events[job_id]
+    
+    def _notify(self, job_id):
+        if job_id in self._events:
+            try:
+                self._loop.call_soon_threadsafe(self._wake, job_id)
+            except RuntimeError:
+                pass  # Loop already closed during shutdown
+    
+    def _wake(self, job_id):
+        for event in self._events.get(job_id, ()):
+            event.set()
+
+job_waiters = JobWaiters()
+
+class ReleasingFileResponse(FileResponse):
+    """FileResponse that runs a callback once the transfer is over, even if the client went away.
+    
+    With a BandwidthShare, each body chunk waits on the event loop until the
+    rate limits allow it to be sent.
+    """
+    
+    def __init__(self, *args, on_close=None, share=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+        self._share = share
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            if self._share is not None:
+                send = self._paced(send)
+                # pathsend would hand the whole file to the server unpaced
+                extensions = {k: v for k, v in (scope.get('extensions') or {}).items() if k != 'http.response.pathsend'}
+                scope = dict(scope, extensions=extensions)
+            await super().__call__(scope, receive, send)
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+            if self._share is not None:
+                self._share.close()
+    
+    def _paced(self, send):
+        async def paced_send(message):
+            body = message.get('body')
+            if message['type'] == 'http.response.body' and body:
+                wait = self._share.reserve(len(body))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            await send(message)
+        return paced_send
+
+class ReleasingStreamingResponse(StreamingResponse):
+    """StreamingResponse that runs a callback once the response is over, even if the body never started"""
+    
+    def __init__(self, *args, on_close=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._on_close = on_close
+    
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self._on_close is not None:
+                self._on_close()
+
+def is_json_request(request):
+    """Same test as Flask's request.is_json"""
+    mimetype = parse_options_header(request.headers.get('content-type', ''))[0].lower()
+    return mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+def send_download(request, file_path, filename, etag=None, cacheable=False, on_close=None):
+    """Async counterpart of app.send_download with the same caching and offload rules"""
+    started = time.monotonic()
+    def finished(mode):
+        serve_seconds.observe(time.monotonic() - started, mode=mode)
+        if on_close:
+            on_close()
+    
+    stat = os.stat(file_path)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    etag = etag or f"{int(stat.st_mtime)}-{stat.st_size}"
+    cache_root = os.path.join(os.path.abspath(ARTIFACT_CACHE_DIR), '')
+    headers = {
+        'Content-Disposition': dump_options_header('attachment', {'filename': filename}),
+        'ETag': f'"{etag}"',
+        'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+        'Cache-Control': f"public, max-age={SERVE_MAX_AGE}" if cacheable else "no-cache",
+    }
+    
+    if SENDFILE_MODE == 'x-accel' and os.path.abspath(file_path).startswith(cache_root):
+        # nginx reads the file from its internal location and handles ranges itself
+        headers["X-Accel-Redirect"] = SENDFILE_ACCEL_PREFIX + os.path.relpath(file_path, cache_root)
+        if serve_bandwidth.rate:
+            # nginx paces the transfer itself at the client's current share
+            headers["X-Accel-Limit-Rate"] = str(int(serve_bandwidth.fair_share(request.client.host)))
+        response = Response(media_type=mimetype, headers=headers)
+        mode = 'offload'
+    elif SENDFILE_MODE == 'x-sendfile':
+        headers["X-Sendfile"] = os.path.abspath(file_path)
+        response = Response(media_type=mimetype, headers=headers)
+        mode = 'offload'
+    elif not is_resource_modified(http_if_modified_since=request.headers.get('if-modified-since'),
+                                  http_if_none_match=request.headers.get('if-none-match'),
+                                  etag=etag, last_modified=headers['Last-Modified']):
+        response = Response(status_code=304, headers=headers)
+        mode = 'direct'
+    else:
+        share = serve_bandwidth.open(request.client.host) if serve_bandwidth.rate else None
+        return ReleasingFileResponse(file_path, filename=filename, media_type=mimetype, headers=headers,
+                                     stat_result=stat, on_close=lambda: finished('direct'), share=share)
+    
+    finished(mode)
+    return response
+
+async def resolve_video_info_async(url):
+    """Video info from the metadata cache or yt-dlp, raising when extraction fails"""
+    cached = metadata_cache.get(extract_video_id(url))
+    if cached is not None:
+        return cached
+    
+    # Concurrent lookups of the same video share one extraction
+    info = await info_flight.do(extract_video_id(url) or url, extract_raw_video_info_async, url)
+    return build_video_info(url, info)
+
+async def get_info(request):
+    if request.method == 'GET':
+        url = request.query_params.get('url', '')
+    else:
+        form = await request.form()
+        url = form.get('url', '')
+    
+    if not url:
+        return JSONResponse({'error': 'No URL provided'}, status_code=400)
+    
+    if not is_valid_youtube_url(url):
+        return JSONResponse({'error': 'Invalid YouTube URL'}, status_code=400)
+    
+    try:
+        video_info = await resolve_video_info_async(url)
+    except (asyncio.TimeoutError, subprocess.TimeoutExpired):
+        logger.error("yt-dlp process timed out")
+        return JSONResponse({'error': 'Video processing timed out'}, status_code=500)
+    except json.JSONDecodeError:
+        return JSONResponse({'error': 'Failed to parse video information'}, status_code=500)
+    except Exception as e:
+        logger.error(f"Error getting video info: {str(e)}")
+        video_info = fallback_video_info(url)
+    
+    # Only GETs are conditional; a matching If-None-Match on a POST must not become a 304
+    status, body, headers = info_response_parts(
+        video_info, request.headers.get('accept-encoding'),
+        request.headers.get('if-none-match') if request.method == 'GET' else None)
+    return Response(body, status_code=status, headers=headers)
+
+async def bulk_info(request):
+    """Resolve many URLs at once, streaming one NDJSON line per video as each lookup finishes"""
+    if is_json_request(request):
+        try:
+            sources = json_url_list(await request.json())
+        except ValueError:
+            sources = None
+        if sources is None:
+            return JSONResponse({'error': 'Expected a JSON list of URLs or an object with a "urls" list'},
+                                status_code=400)
+    else:
+        form = await request.form()
+        sources = split_url_list(form.get('urls', ''))
+    
+    if not sources:
+        return JSONResponse({'error': 'No URLs provided'}, status_code=400)
+    if len(sources) > BULK_INFO_MAX_URLS:
+        return JSONResponse({'error': f'Too many URLs, at most {BULK_INFO_MAX_URLS} are allowed'}, status_code=400)
+    
+    videos, invalid = group_video_urls(sources)
+    
+    if not bulk_info_slots.acquire(blocking=False):
+        return JSONResponse({'error': 'Too many bulk lookups in progress, please try again later'}, status_code=429)
+    
+    async def generate():
+        limit = asyncio.Semaphore(max(1, BULK_INFO_CONCURRENCY))
+        
+        async def resolve(video_id, entry):
+            line = {'video_id': video_id, **entry}
+            async with limit:
+                try:
+                    line['info'] = await resolve_video_info_async(entry['url'])
+                except Exception as e:
+                    logger.warning(f"Bulk lookup failed for {video_id}: {str(e)}")
+                    line['error'] = info_error_message(e)
+            return line
+        
+        tasks = []
+        try:
+            for source in invalid:
+                yield ndjson_line({'input': source, 'error': 'Invalid YouTube URL'})
+            
+            tasks = [asyncio.ensure_future(resolve(video_id, entry)) for video_id, entry in videos.items()]
+            failed = 0
+            for next_line in asyncio.as_completed(tasks):
+                line = await next_line
+                failed += 'error' in line
+                yield ndjson_line(line)
+            
+            yield ndjson_line({'done': True, 'videos': len(videos), 'failed': failed, 'invalid': len(invalid)})
+        finally:
+            # Lookups still waiting are dropped when the client goes away
+            for task in tasks:
+                task.cancel()
+    
+    # Released by the response rather than the body, which may never start
+    return ReleasingStreamingResponse(generate(), media_type='application/x-ndjson', on_close=bulk_info_slots.release,
+                                      headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+async def get_progress(request):
+    download_id = request.path_params['download_id']
+    return JSONResponse(job_progress(download_id, await read_job(download_id)))
+
+async def download_events(request):
+    """Stream progress updates for a download as Server-Sent Events"""
+    download_id = request.path_params['download_id']
+    
+    async def generate():
+        event = job_waiters.register(download_id)
+        try:
+            deadline = time.monotonic() + PROGRESS_STREAM_TIMEOUT
+            last_payload = None
+            last_sent = time.monotonic()
+            while True:
+                # Clear before reading so an update in between is not missed
+                event.clear()
+                payload = job_progress(download_id, await read_job(download_id))
+                now = time.monotonic()
+                if payload != last_payload:
+                    yield f"data: {json.dumps(payload)}\n\n"
+                    last_payload = payload
+                    last_sent = now
+                elif now - last_sent >= 15:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    last_sent = now
+                if JobStore.is_finished(payload['status']) or now >= deadline:
+                    return
+                # Jobs run by other worker processes are picked up on the timeout
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(event.wait(), 1.0)
+        finally:
+            job_waiters.unregister(download_id, event)
+    
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Disable proxy buffering (nginx)
+    })
+
+async def stream(request):
+    """Pipe a single-file format to the client while yt-dlp downloads it"""
+    url = request.query_params.get('url', '')
+    format_id = request.query_params.get('format_id', 'best')
+    
+    if not url or not is_valid_youtube_url(url):
+        return JSONResponse({'error': 'Invalid YouTube URL'}, status_code=400)
+    
+    selector = stream_format_selector(format_id)
+    if selector is None:
+        return JSONResponse({'error': f'Format {format_id} cannot be streamed, use /download instead'}, status_code=400)
+    
+    if not stream_slots.acquire(blocking=False):
+        return JSONResponse({'error': 'Too many streams in progress, please try again later'}, status_code=429)
+    
+    cmd = stream_command(url, selector)
+    logger.debug(f"Running stream command: {' '.join(cmd)}")
+    
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        # Wait for the first bytes so failures can still be reported as an error response
+        first_chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+    except Exception as e:
+        stream_slots.release()
+        logger.error(f"Error starting stream for {url}: {str(e)}")
+        return JSONResponse({'error': f'Error starting stream: {str(e)}'}, status_code=500)
+    
+    if not first_chunk:
+        await process.wait()
+        error = (await process.stderr.read()).decode('utf-8', 'replace').strip() or "yt-dlp produced no output"
+        stream_slots.release()
+        logger.error(f"Stream failed for {url}: {error}")
+        subprocess_failures_total.inc(operation='stream', error=classify_ytdlp_error(error))
+        return JSONResponse({'error': error}, status_code=502)
+    
+    async def generate():
+        shares = open_stream_shares(request.client.host)
+        try:
+            chunk = first_chunk
+            while chunk:
+                wait = stream_wait(shares, len(chunk))
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                yield chunk
+                chunk = await process.stdout.read(STREAM_CHUNK_SIZE)
+            if await process.wait() != 0:
+                error = (await process.stderr.read()).decode('utf-8', 'replace').strip()
+                logger.error(f"Stream for {url} ended with an error: {error}")
+                subprocess_failures_total.inc(operation='stream', error=classify_ytdlp_error(error))
+        finally:
+            # Stop yt-dlp if the client disconnected early
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            for share in shares:
+                share.close()
+            stream_slots.release()
+    
+    filename = stream_filename(url, format_id)
+    return StreamingResponse(generate(), media_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream', headers={
+        'Content-Disposition': dump_options_header('attachment', {'filename': filename}),
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+
+async def get_file(request):
+    """Serve the downloaded file to the user"""
+    download_id = request.path_params['download_id']
+    logger.debug(f"Attempting to serve file for download ID: {download_id}")
+    
+    url = request.query_params.get('url', '')
+    format_id = request.query_params.get('format_id', 'best')
+    
+    # Lookups touch the disk and may write an emergency file, so keep them off the loop
+    file_path, filename, cache_key = await run_in_threadpool(resolve_download, download_id, url, format_id)
+    if file_path is None:
+        return JSONResponse({'error': 'Unable to serve media file'}, status_code=500)
+    
+    if cache_key:
+        release = lambda: artifact_cache.release(cache_key)
+        try:
+            # The ETag changes whenever the artifact is re-published, so If-Range
+            # resumes never join two different downloads
+            return send_download(request, file_path, filename, etag=artifact_etag(cache_key, file_path),
+                                 cacheable=True, on_close=release)
+        except Exception:
+            release()
+            raise
+    
+    response = send_download(request, file_path, filename)
+    
+    # Temp files are reclaimed by the janitor once the resume grace period is over
+    if TEMP_DIR in file_path:
+        temp_janitor.mark_served(file_path)
+    
+    return response
+
+@contextlib.asynccontextmanager
+async def lifespan(_app):
+    temp_janitor.ensure_started()
+    sample_assets.ensure_started()
+    yield
+
+application = Starlette(
+    routes=[
+        Route('/get_video_info', get_info, methods=['GET', 'POST']),
+        Route('/bulk_info', bulk_info, methods=['POST']),
+        Route('/download_progress/{download_id}', get_progress),
+        Route('/download_events/{download_id}', download_events),
+        Route('/stream', stream),
+        Route('/get_file/{download_id}', get_file),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=ASGI_WSGI_WORKERS)),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(application, host="0.0.0.0", port=5000)
@@ -0,0 +1,562 @@
+"""Offline load test and benchmark for the downloader.
+
+Runs the app against a fake YouTube: a yt-dlp extractor plugin answers
+YouTube URLs with synthetic progressive, DASH and audio-only formats whose
+media is served by a local HTTP server. yt-dlp itself runs unmodified, so
+the whole pipeline (metadata extraction, scheduling, downloading, progress
+tracking and file serving) is exercised without network access.
+
+Example:
+    python benchmark.py --concurrency 8 --jobs 40 --save baseline.json
+    python benchmark.py --concurrency 8 --jobs 40 --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import math
+import signal
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+
+try:
+    from yt_dlp.extractor.youtube import YoutubeIE
+except ImportError:  # Only needed inside the server and its yt-dlp processes
+    YoutubeIE = None
+
+# Configure logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+VIDEO_URL_TEMPLATE = "https://www.youtube.com/watch?v={}"
+# Base URL of the fake media server, passed to the extractor plugin
+MEDIA_URL_ENV = "BENCH_MEDIA_URL"
+MEDIA_SIZE_ENV = "BENCH_MEDIA_SIZE"
+FRAGMENT_SIZE = 512 * 1024
+SERVER_START_TIMEOUT = 30
+PROGRESS_POLL_INTERVAL = 0.25
+JOB_TIMEOUT = 300
+
+# Synthetic formats modelled on YouTube itags. Sizes are fractions of the
+# configured media size; merged and audio formats need ffmpeg on the server.
+FAKE_FORMATS = [
+    {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2',
+     'height': 360, 'width': 640, 'fps': 30, 'share': 0.5},
+    {'format_id': '22', 'ext': 'mp4', 'vcodec': 'avc1.64001F', 'acodec': 'mp4a.40.2',
+     'height': 720, 'width': 1280, 'fps': 30, 'share': 1.0},
+    {'format_id': '137', 'ext': 'mp4', 'vcodec': 'avc1.640028', 'acodec': 'none',
+     'height': 1080, 'width': 1920, 'fps': 30, 'share': 1.0, 'protocol': 'http_dash_segments'},
+    {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a.40.2',
+     'abr': 129.5, 'share': 0.1},
+    {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus',
+     'abr': 160, 'share': 0.1},
+]
+
+def format_size(fmt, media_size):
+    """Byte size of a synthetic format"""
+    return max(int(media_size * fmt['share']), 1)
+
+if YoutubeIE is not None:
+    class FakeYoutubeIE(YoutubeIE, plugin_name='benchmark'):
+        """Answers YouTube watch URLs with synthetic formats from the fake media server"""
+        
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            base_url = os.environ[MEDIA_URL_ENV]
+            media_size = int(os.environ.get(MEDIA_SIZE_ENV, str(8 * 1024 * 1024)))
+            formats = []
+            for fmt in FAKE_FORMATS:
+                size = format_size(fmt, media_size)
+                media_url = f"{base_url}/media/{video_id}/{fmt['format_id']}"
+                entry = {key: value for key, value in fmt.items() if key != 'share'}
+                entry['filesize'] = size
+                if fmt.get('protocol') == 'http_dash_segments':
+                    # Fragmented like YouTube's DASH streams, so parallel
+                    # fragment downloads are exercised too
+                    entry.update({
+                        'url': media_url,
+                        'fragment_base_url': f"{media_url}/",
+                        'fragments': [{'path': f"frag/{index}"}
+                                      for index in range(math.ceil(size / FRAGMENT_SIZE))],
+                    })
+                else:
+                    entry['url'] = media_url
+                formats.append(entry)
+            return {
+                'id': video_id,
+                'title': f"Benchmark video {video_id}",
+                'uploader': 'Benchmark',
+                'duration': 120,
+                'view_count': 0,
+                'thumbnail': f"{base_url}/thumbnail/{video_id}.jpg",
+                'formats': formats,
+            }
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Serves the synthetic media, with Range support and optional per-response pacing"""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def do_HEAD(self):
+        self.handle_media(send_body=False)
+    
+    def do_GET(self):
+        self.handle_media(send_body=True)
+    
+    def handle_media(self, send_body):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        fmt = next((f for f in FAKE_FORMATS if len(parts) >= 3 and f['format_id'] == parts[2]), None)
+        if parts[0] != 'media' or fmt is None:
+            self.send_error(404)
+            return
+        
+        size = format_size(fmt, self.server.media_size)
+        start, end = 0, size - 1
+        if len(parts) == 5 and parts[3] == 'frag':
+            start = int(parts[4]) * FRAGMENT_SIZE
+            end = min(start + FRAGMENT_SIZE, size) - 1
+            if start >= size:
+                self.send_error(404)
+                return
+        
+        status = 200
+        range_header = self.headers.get('Range')
+        if range_header and range_header.startswith('bytes=') and len(parts) == 3:
+            first, _, last = range_header[6:].split(',')[0].partition('-')
+            start = int(first) if first else max(size - int(last), 0)
+            end = min(int(last), size - 1) if first and last else size - 1
+            if start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{size}")
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/mp4' if fmt['vcodec'] == 'none' else 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if send_body:
+            self.send_payload(start, end + 1)
+    
+    def send_payload(self, start, stop):
+        payload = self.server.payload
+        rate = self.server.rate
+        chunk_size = 64 * 1024
+        started = time.monotonic()
+        sent = 0
+        try:
+            while start + sent < stop:
+                # The payload repeats, so any offset maps into one buffer
+                position = (start + sent) % len(payload)
+                length = min(chunk_size, stop - start - sent, len(payload) - position)
+                self.wfile.write(payload[position:position + length])
+                sent += length
+                if rate:
+                    delay = sent / rate - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    
+    def log_message(self, format, *args):
+        pass
+
+def start_media_server(media_size, rate):
+    """Start the fake media server on a free local port"""
+    sample_path = os.path.join(REPO_DIR, 'samples', 'sample.mp4')
+    if os.path.exists(sample_path):
+        with open(sample_path, 'rb') as f:
+            payload = f.read()
+    else:
+        payload = bytes(range(256)) * 4096
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    server.daemon_threads = True
+    server.payload = memoryview(payload)
+    server.media_size = media_size
+    server.rate = rate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Fake media server listening on port {server.server_port}")
+    return server
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def write_plugin(work_dir):
+    """Install the fake extractor as a yt-dlp plugin package in the work directory"""
+    plugin_dir = os.path.join(work_dir, 'plugins', 'yt_dlp_plugins', 'extractor')
+    os.makedirs(plugin_dir)
+    with open(os.path.join(plugin_dir, 'benchmark_youtube.py'), 'w') as f:
+        f.write("from benchmark import FakeYoutubeIE  # noqa: F401\n")
+    return os.path.join(work_dir, 'plugins')
+
+def server_command(kind, port, workers):
+    """Command that runs the app under the chosen server"""
+    if kind == 'asgi':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                '--port', str(port), '--log-level', 'warning']
+    if kind == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', '8',
+                '--bind', f"127.0.0.1:{port}", 'main:app']
+    return [sys.executable, '-c',
+            f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+
+class AppServer:
+    """The app running in a child process inside a scratch working directory"""
+    
+    def __init__(self, args, media_url):
+        self.work_dir = tempfile.mkdtemp(prefix='ytdl-bench-')
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        
+        env = dict(os.environ)
+        env.update({
+            'PYTHONPATH': os.pathsep.join(filter(None, [write_plugin(self.work_dir), REPO_DIR,
+                                                        env.get('PYTHONPATH')])),
+            MEDIA_URL_ENV: media_url,
+            MEDIA_SIZE_ENV: str(args.media_size),
+            # Every simulated user shares one address
+            'DOWNLOAD_PER_CLIENT': str(max(args.concurrency, 1)),
+            'DOWNLOAD_QUEUE_SIZE': str(max(args.concurrency * 2, 50)),
+            # The scratch directory has no samples/ folder to serve from
+            'SAMPLE_SOURCE': 'placeholder',
+        })
+        for item in args.env:
+            key, _, value = item.partition('=')
+            env[key] = value
+        
+        self.log_path = os.path.join(self.work_dir, 'server.log')
+        self._log = open(self.log_path, 'wb')
+        self._usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._launched = time.monotonic()
+        self.process = subprocess.Popen(
+            server_command(args.server, self.port, args.workers),
+            cwd=self.work_dir, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        self.peak_rss = 0
+        self.startup_seconds = None
+    
+    def wait_ready(self):
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with code {self.process.returncode}, see {self.log_path}")
+            try:
+                requests.get(self.base_url + '/', timeout=1)
+                self.startup_seconds = time.monotonic() - self._launched
+                logger.info(f"Server ready at {self.base_url} in {self.startup_seconds:.2f}s "
+                            f"(working directory {self.work_dir})")
+                return
+            except requests.ConnectionError:
+                time.sleep(0.05)
+        raise RuntimeError(f"Server did not start within {SERVER_START_TIMEOUT}s, see {self.log_path}")
+    
+    def sample_rss(self):
+        """Track the peak resident memory of the server process (Linux only)"""
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        self.peak_rss = max(self.peak_rss, int(line.split()[1]) * 1024)
+        except OSError:
+            pass
+    
+    def stop(self):
+        """Stop the server and return the CPU time used by it and its yt-dlp processes"""
+        self.sample_rss()
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log.close()
+        
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if not self.peak_rss:
+            # ru_maxrss is the largest single child process, in KiB on Linux
+            scale = 1 if sys.platform == 'darwin' else 1024
+            self.peak_rss = usage.ru_maxrss * scale
+        return {
+            'cpu_user_seconds': round(usage.ru_utime - self._usage_before.ru_utime, 3),
+            'cpu_system_seconds': round(usage.ru_stime - self._usage_before.ru_stime, 3),
+            'peak_rss_bytes': self.peak_rss,
+            'startup_seconds': round(self.startup_seconds, 3) if self.startup_seconds else None,
+        }
+    
+    def cleanup(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+class Recorder:
+    """Collects per-endpoint latencies and error counts from all simulated users"""
+    
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, name, seconds):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+    
+    def error(self, name, reason):
+        with self._lock:
+            key = f"{name}: {reason}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+    
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(math.ceil(fraction * len(ordered))) - 1, len(ordered) - 1)] if ordered else None
+
+def timed_request(recorder, session, name, method, url, **kwargs):
+    """Issue a request, recording its latency (including the body for streamed responses)"""
+    started = time.monotonic()
+    response = session.request(method, url, timeout=JOB_TIMEOUT, **kwargs)
+    if kwargs.get('stream'):
+        size = 0
+        for chunk in response.iter_content(chunk_size=256 * 1024):
+            size += len(chunk)
+        recorder.count('bytes_served', size)
+    recorder.observe(name, time.monotonic() - started)
+    return response
+
+def run_job(index, args, base_url, recorder):
+    """One simulated user: fetch info, start a download, poll progress and fetch the file"""
+    session = requests.Session()
+    video_id = f"bench{index % args.videos:06d}"
+    url = VIDEO_URL_TEMPLATE.format(video_id)
+    format_id = args.format[index % len(args.format)]
+    started = time.monotonic()
+    
+    response = timed_request(recorder, session, 'get_video_info', 'POST',
+                             f"{base_url}/get_video_info", data={'url': url})
+    if response.status_code != 200 or response.json().get('title', '').startswith('YouTube Video'):
+        # The generic title means the app fell back instead of using the fake extractor
+        recorder.error('get_video_info', f"HTTP {response.status_code}" if response.status_code != 200 else 'fallback')
+        return
+    if args.scenario == 'info':
+        recorder.observe('job', time.monotonic() - started)
+        return
+    
+    while True:
+        response = timed_request(recorder, session, 'download', 'POST', f"{base_url}/download",
+                                 data={'url': url, 'format_id': format_id})
+        if response.status_code != 429:
+            break
+        recorder.count('rejected')
+        time.sleep(0.5)
+    if response.status_code != 200:
+        recorder.error('download', f"HTTP {response.status_code}")
+        return
+    download_id = response.json()['download_id']
+    
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while True:
+        response = timed_request(recorder, session, 'download_progress', 'GET',
+                                 f"{base_url}/download_progress/{download_id}")
+        status = response.json().get('status', '') if response.status_code == 200 else ''
+        if status == 'completed':
+            break
+        if status == 'completed_fallback' or status.startswith('error'):
+            recorder.error('download', status.split(':')[0])
+            return
+        if time.monotonic() > deadline:
+            recorder.error('download', 'timeout')
+            return
+        time.sleep(PROGRESS_POLL_INTERVAL)
+    
+    response = timed_request(recorder, session, 'get_file', 'GET', f"{base_url}/get_file/{download_id}",
+                             params={'url': url, 'format_id': format_id}, stream=True)
+    if response.status_code != 200:
+        recorder.error('get_file', f"HTTP {response.status_code}")
+        return
+    recorder.observe('job', time.monotonic() - started)
+
+def run_load(args, server):
+    """Drive the server with the configured concurrency and collect results"""
+    recorder = Recorder()
+    stop_sampling = threading.Event()
+    
+    def sample_memory():
+        while not stop_sampling.wait(0.5):
+            server.sample_rss()
+    
+    threading.Thread(target=sample_memory, daemon=True).start()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(run_job, index, args, server.base_url, recorder) for index in range(args.jobs)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                recorder.error('client', type(e).__name__)
+    elapsed = time.monotonic() - started
+    stop_sampling.set()
+    
+    completed = len(recorder.latencies.get('job', []))
+    return {
+        'config': {
+            'server': args.server,
+            'scenario': args.scenario,
+            'concurrency': args.concurrency,
+            'jobs': args.jobs,
+            'videos': args.videos,
+            'formats': args.format,
+            'media_size': args.media_size,
+            'media_rate': args.media_rate,
+            'env': args.env,
+        },
+        'elapsed_seconds': round(elapsed, 3),
+        'completed_jobs': completed,
+        'jobs_per_second': round(completed / elapsed, 3) if elapsed else 0,
+        'served_bytes_per_second': round(recorder.counters.get('bytes_served', 0) / elapsed) if elapsed else 0,
+        'rejected_downloads': recorder.counters.get('rejected', 0),
+        'errors': recorder.errors,
+        'latency': {
+            name: {
+                'count': len(values),
+                'p50': round(percentile(values, 0.5), 4),
+                'p99': round(percentile(values, 0.99), 4),
+                'max': round(max(values), 4),
+            }
+            for name, values in sorted(recorder.latencies.items())
+        },
+    }
+
+def print_report(results):
+    print()
+    print(f"Server: {results['config']['server']}, scenario: {results['config']['scenario']}, "
+          f"concurrency: {results['config']['concurrency']}")
+    print(f"Completed {results['completed_jobs']}/{results['config']['jobs']} jobs in "
+          f"{results['elapsed_seconds']:.1f}s ({results['jobs_per_second']:.2f} jobs/s, "
+          f"{results['served_bytes_per_second'] / (1024 * 1024):.1f} MiB/s served)")
+    print(f"{'endpoint':<20}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}{'max ms':>12}")
+    for name, stats in results['latency'].items():
+        print(f"{name:<20}{stats['count']:>8}{stats['p50'] * 1000:>12.1f}"
+              f"{stats['p99'] * 1000:>12.1f}{stats['max'] * 1000:>12.1f}")
+    resources = results['resources']
+    print(f"Server CPU: {resources['cpu_user_seconds']:.2f}s user, {resources['cpu_system_seconds']:.2f}s system "
+          f"(including yt-dlp processes); peak RSS: {resources['peak_rss_bytes'] / (1024 * 1024):.1f} MiB; "
+          f"startup: {resources['startup_seconds']:.2f}s")
+    if results['rejected_downloads']:
+        print(f"Downloads rejected with 429 and retried: {results['rejected_downloads']}")
+    for reason, count in sorted(results['errors'].items()):
+        print(f"Error {reason}: {count}")
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Return the regressions of `results` against `baseline` beyond `tolerance`"""
+    regressions = []
+    
+    def check(name, current, previous, higher_is_better=False):
+        if not previous or current is None:
+            return
+        change = (current - previous) / previous
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f"{name}: {previous} -> {current} ({change:+.0%})")
+    
+    check('jobs_per_second', results['jobs_per_second'], baseline.get('jobs_per_second'), higher_is_better=True)
+    check('peak_rss_bytes', results['resources']['peak_rss_bytes'], baseline.get('resources', {}).get('peak_rss_bytes'))
+    check('startup_seconds', results['resources']['startup_seconds'], baseline.get('resources', {}).get('startup_seconds'))
+    cpu = results['resources']['cpu_user_seconds'] + results['resources']['cpu_system_seconds']
+    previous = baseline.get('resources', {})
+    check('cpu_seconds', cpu, previous.get('cpu_user_seconds', 0) + previous.get('cpu_system_seconds', 0))
+    for name, stats in results['latency'].items():
+        previous = baseline.get('latency', {}).get(name, {})
+        check(f"{name} p50", stats['p50'], previous.get('p50'))
+        check(f"{name} p99", stats['p99'], previous.get('p99'))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--server', choices=['flask', 'asgi', 'gunicorn'], default='flask',
+                        help="how to run the app (default: flask development server)")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--scenario', choices=['full', 'info'], default='full',
+                        help="full download flow, or /get_video_info only")
+    parser.add_argument('--concurrency', type=int, default=4, help="simulated users running at once")
+    parser.add_argument('--jobs', type=int, default=20, help="total number of jobs to run")
+    parser.add_argument('--videos', type=int, default=None,
+                        help="distinct video IDs to cycle through (default: one per job, "
+                             "fewer exercises caching and request coalescing)")
+    parser.add_argument('--format', action='append', default=None,
+                        help="format ID to download, repeat to mix (default: 18)")
+    parser.add_argument('--media-size', type=int, default=8 * 1024 * 1024,
+                        help="size in bytes of the largest synthetic format")
+    parser.add_argument('--media-rate', type=int, default=0,
+                        help="per-connection rate limit of the media server in bytes/s (0 = unlimited)")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help="extra environment for the server, e.g. YTDLP_ENGINE=subprocess")
+    parser.add_argument('--save', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against results saved earlier with --save")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="allowed relative regression against the baseline (default: 0.2)")
+    parser.add_argument('--keep', action='store_true', help="keep the server working directory and log")
+    args = parser.parse_args()
+    args.videos = args.videos or args.jobs
+    args.format = args.format or ['18']
+    return args
+
+def main():
+    args = parse_args()
+    if YoutubeIE is None:
+        logger.error("yt-dlp is required to run the benchmark")
+        return 1
+    
+    media_server = start_media_server(args.media_size, args.media_rate)
+    server = AppServer(args, f"http://127.0.0.1:{media_server.server_port}")
+    try:
+        server.wait_ready()
+        results = run_load(args, server)
+    finally:
+        resources = server.stop()
+        media_server.shutdown()
+        if args.keep:
+            logger.info(f"Server log kept at {server.log_path}")
+        else:
+            server.cleanup()
+    results['resources'] = resources
+    print_report(results)
+    
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results saved to {args.save}")
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('config') != results['config']:
+            logger.warning(f"{args.baseline} was recorded with a different configuration")
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        if regressions:
+            for regression in regressions:
+                logger.error(f"Regression: {regression}")
+            return 1
+        logger.info(f"No regressions beyond {args.max_regression:.0%} against {args.baseline}")
+    
+    return 1 if results['errors'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
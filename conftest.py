@@ -0,0 +1,8 @@
+"""Shared setup for the unit tests: keep the app's job store and caches out of the working tree"""
+import os
+import tempfile
+
+_scratch = tempfile.mkdtemp(prefix='ytdl-tests-')
+os.environ.setdefault('JOB_STORE_BACKEND', 'memory')
+os.environ.setdefault('ARTIFACT_CACHE_DIR', os.path.join(_scratch, 'cache'))
+os.environ.setdefault('SAMPLE_SOURCE', 'placeholder')
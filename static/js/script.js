@@ -9,6 +9,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const statusMessage = document.getElementById('statusMessage');
     const downloadButton = document.getElementById('downloadButton');
     let downloadInterval = null;
+    let progressSource = null;
     
     // Initialize sidebar navigation
     const navItems = document.querySelectorAll('.sidebar-nav .nav-item');
@@ -204,15 +205,8 @@ document.addEventListener('DOMContentLoaded', function() {
         
         const url = videoUrlInput.value.trim();
         
-        // Create form data
-        const formData = new FormData();
-        formData.append('url', url);
-        
-        // Fetch video info
-        fetch('/get_video_info', {
-            method: 'POST',
-            body: formData
-        })
+        // Fetch video info; a GET lets the browser revalidate a repeat lookup with its ETag
+        fetch(`/get_video_info?url=${encodeURIComponent(url)}`)
         .then(response => response.json())
         .then(data => {
             if (data.error) {
@@ -315,6 +309,24 @@ document.addEventListener('DOMContentLoaded', function() {
         const formatId = document.getElementById('resolutionSelect').value;
         const saveLocation = document.getElementById('saveLocation').value;
         
+        // Single-file formats can be streamed straight to the browser while they download
+        const streamDirect = document.getElementById('streamDirect');
+        const resolutionSelect = document.getElementById('resolutionSelect');
+        const selectedOption = resolutionSelect.options[resolutionSelect.selectedIndex];
+        if (streamDirect && streamDirect.checked && selectedOption && selectedOption.dataset.streamable) {
+            progressContainer.style.display = 'none';
+            statusMessage.innerHTML = '<i class="bi bi-check-circle"></i> Your download is starting in the browser...';
+            window.location.href = `/stream?url=${encodeURIComponent(url)}&format_id=${encodeURIComponent(formatId)}`;
+            downloadButton.disabled = false;
+            downloadButton.classList.remove('disabled-but-visible');
+            downloadButton.style.opacity = '1';
+            const buttonMsg = document.getElementById('buttonMsg');
+            if (buttonMsg) {
+                buttonMsg.remove();
+            }
+            return;
+        }
+        
         // Get custom location if selected
         let customLocation = '';
         if (saveLocation === 'custom') {
@@ -350,29 +362,15 @@ document.addEventListener('DOMContentLoaded', function() {
             
             const downloadId = data.download_id;
             
-            // Clear any existing interval
-            if (downloadInterval) {
-                clearInterval(downloadInterval);
-            }
+            // Stop tracking any previous download
+            stopProgressUpdates();
             
-            // Start progress checking immediately
-            checkProgress(downloadId, url, formatId);
-            
-            // Check progress periodically - more frequently at the beginning, less often later
-            let checkCount = 0;
-            downloadInterval = setInterval(() => {
-                checkProgress(downloadId, url, formatId);
-                
-                // After 20 checks (about 5 seconds), slow down the polling rate
-                // to reduce server load while still maintaining responsiveness
-                checkCount++;
-                if (checkCount === 20) {
-                    clearInterval(downloadInterval);
-                    downloadInterval = setInterval(() => {
-                        checkProgress(downloadId, url, formatId);
-                    }, 1000); // Switch to checking once per second
-                }
-            }, 250); // Start with checking 4 times per second
+            // Prefer server-pushed progress; polling is only a fallback
+            if (window.EventSource) {
+                streamProgress(downloadId, url, formatId);
+            } else {
+                pollProgress(downloadId, url, formatId);
+            }
         })
         .catch(error => {
             statusMessage.innerHTML = `<i class="bi bi-exclamation-triangle"></i> Error: ${error.message}`;
@@ -382,106 +380,67 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
     
-    // Function to check download progress
-    function checkProgress(downloadId, url, formatId) {
-        fetch(`/download_progress/${downloadId}`)
-        .then(response => response.json())
-        .then(data => {
-            // Get current progress value shown in the UI
-            const currentProgress = parseInt(progressText.textContent) || 0;
-            const newProgress = Math.round(data.progress);
-            
-            // Only update if progress has increased or if status is completed
-            if (newProgress > currentProgress || data.status === 'completed') {
-                // Animate progress bar
-                animateProgressBar(newProgress);
-                
-                // If progress is complete but status isn't, make sure UI shows 100%
-                if (newProgress >= 100 && data.status === 'completed') {
-                    animateProgressBar(100);
-                }
+    // Stop both the progress stream and the polling timer
+    function stopProgressUpdates() {
+        if (progressSource) {
+            progressSource.close();
+            progressSource = null;
+        }
+        if (downloadInterval) {
+            clearInterval(downloadInterval);
+            downloadInterval = null;
+        }
+    }
+    
+    // Receive progress updates pushed by the server as Server-Sent Events
+    function streamProgress(downloadId, url, formatId) {
+        progressSource = new EventSource(`/download_events/${downloadId}`);
+        let finished = false;
+        
+        progressSource.onmessage = function(event) {
+            const data = JSON.parse(event.data);
+            if (data.status.startsWith('completed') || data.status.startsWith('error')) {
+                finished = true;
+            }
+            handleProgress(data, downloadId, url, formatId);
+        };
+        
+        progressSource.onerror = function() {
+            // The server closes the stream once the download finishes
+            stopProgressUpdates();
+            if (!finished) {
+                pollProgress(downloadId, url, formatId);
             }
+        };
+    }
+    
+    // Poll for progress when streaming is unavailable
+    function pollProgress(downloadId, url, formatId) {
+        // Start progress checking immediately
+        checkProgress(downloadId, url, formatId);
+        
+        // Check progress periodically - more frequently at the beginning, less often later
+        let checkCount = 0;
+        downloadInterval = setInterval(() => {
+            checkProgress(downloadId, url, formatId);
             
-            if (data.status === 'completed' || data.status === 'completed_fallback') {
-                clearInterval(downloadInterval);
-                
-                // Direct download link to local computer
-                const directDownloadLink = `/get_file/${downloadId}?url=${encodeURIComponent(url)}&format_id=${formatId}`;
-                
-                // Different messages based on status
-                if (data.status === 'completed_fallback') {
-                    statusMessage.innerHTML = '<i class="bi bi-check-circle"></i> Download completed with fallback! <a id="downloadLink" href="#" class="highlight-text">Click here to save</a>';
-                } else {
-                    statusMessage.innerHTML = '<i class="bi bi-check-circle"></i> Download completed! <a id="downloadLink" href="#" class="highlight-text">Click here to save</a>';
-                }
-                
-                // Create the download link
-                const downloadLink = document.getElementById('downloadLink');
-                downloadLink.href = directDownloadLink;
-                
-                // Re-enable download button
-                downloadButton.disabled = false;
-                downloadButton.classList.remove('disabled-but-visible');
-                downloadButton.style.opacity = '1';
-                
-                // Remove the processing message
-                const buttonMsg = document.getElementById('buttonMsg');
-                if (buttonMsg) {
-                    buttonMsg.remove();
-                }
-                
-                // Get format name from select element
-                const formatSelect = document.getElementById('resolutionSelect');
-                let formatName = "";
-                if (formatSelect && formatSelect.selectedIndex >= 0) {
-                    formatName = formatSelect.options[formatSelect.selectedIndex].text;
-                }
-                
-                // Get video info to save in history
-                const videoTitle = document.getElementById('videoTitle').textContent;
-                const thumbnailUrl = document.getElementById('videoThumbnail').src;
-                
-                // Save to download history
-                saveToHistory({
-                    url: url,
-                    title: videoTitle,
-                    thumbnail_url: thumbnailUrl
-                }, formatName);
-                
-                // Show success animation
-                showSuccessAnimation();
-                downloadLink.setAttribute('download', ''); // Force download attribute
-                downloadLink.classList.add('animate__animated', 'animate__pulse', 'animate__infinite');
-                
-                // Auto-initiate download to local computer
-                setTimeout(() => {
-                    window.location.href = directDownloadLink;
-                }, 500);
-                
-                // Re-enable download button
-                downloadButton.disabled = false;
-                
-                // Add success animation
-                showSuccessAnimation();
-            } else if (data.status.startsWith('error')) {
+            // After 20 checks (about 5 seconds), slow down the polling rate
+            // to reduce server load while still maintaining responsiveness
+            checkCount++;
+            if (checkCount === 20) {
                 clearInterval(downloadInterval);
-                statusMessage.innerHTML = `<i class="bi bi-exclamation-triangle"></i> Error: ${data.status.substring(7)}`;
-                
-                // Re-enable download button on error
-                downloadButton.disabled = false;
-            } else {
-                // Show more granular status messages based on progress
-                if (newProgress < 10) {
-                    statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Starting download...';
-                } else if (newProgress < 50) {
-                    statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Downloading...';
-                } else if (newProgress < 90) {
-                    statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Almost there...';
-                } else if (newProgress < 100) {
-                    statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Finalizing download...';
-                }
+                downloadInterval = setInterval(() => {
+                    checkProgress(downloadId, url, formatId);
+                }, 1000); // Switch to checking once per second
             }
-        })
+        }, 250); // Start with checking 4 times per second
+    }
+    
+    // Function to check download progress
+    function checkProgress(downloadId, url, formatId) {
+        fetch(`/download_progress/${downloadId}`)
+        .then(response => response.json())
+        .then(data => handleProgress(data, downloadId, url, formatId))
         .catch(error => {
             // Don't immediately clear interval or show error on first failure
             // Only show error after multiple consecutive failures
@@ -492,6 +451,140 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // Update the UI from a progress report
+    function handleProgress(data, downloadId, url, formatId) {
+        // Get current progress value shown in the UI
+        const currentProgress = parseInt(progressText.textContent) || 0;
+        const newProgress = Math.round(data.progress);
+        
+        // Only update if progress has increased or if status is completed
+        if (newProgress > currentProgress || data.status === 'completed') {
+            // Animate progress bar
+            animateProgressBar(newProgress);
+            
+            // If progress is complete but status isn't, make sure UI shows 100%
+            if (newProgress >= 100 && data.status === 'completed') {
+                animateProgressBar(100);
+            }
+        }
+        
+        if (data.status === 'completed' || data.status === 'completed_fallback') {
+            stopProgressUpdates();
+            
+            // Direct download link to local computer
+            const directDownloadLink = `/get_file/${downloadId}?url=${encodeURIComponent(url)}&format_id=${formatId}`;
+            
+            // Different messages based on status
+            if (data.status === 'completed_fallback') {
+                statusMessage.innerHTML = '<i class="bi bi-check-circle"></i> Download completed with fallback! <a id="downloadLink" href="#" class="highlight-text">Click here to save</a>';
+            } else {
+                statusMessage.innerHTML = '<i class="bi bi-check-circle"></i> Download completed! <a id="downloadLink" href="#" class="highlight-text">Click here to save</a>';
+            }
+            
+            // Create the download link
+            const downloadLink = document.getElementById('downloadLink');
+            downloadLink.href = directDownloadLink;
+            
+            // Re-enable download button
+            downloadButton.disabled = false;
+            downloadButton.classList.remove('disabled-but-visible');
+            downloadButton.style.opacity = '1';
+            
+            // Remove the processing message
+            const buttonMsg = document.getElementById('buttonMsg');
+            if (buttonMsg) {
+                buttonMsg.remove();
+            }
+            
+            // Get format name from select element
+            const formatSelect = document.getElementById('resolutionSelect');
+            let formatName = "";
+            if (formatSelect && formatSelect.selectedIndex >= 0) {
+                formatName = formatSelect.options[formatSelect.selectedIndex].text;
+            }
+            
+            // Get video info to save in history
+            const videoTitle = document.getElementById('videoTitle').textContent;
+            const thumbnailUrl = document.getElementById('videoThumbnail').src;
+            
+            // Save to download history
+            saveToHistory({
+                url: url,
+                title: videoTitle,
+                thumbnail_url: thumbnailUrl
+            }, formatName);
+            
+            // Show success animation
+            showSuccessAnimation();
+            downloadLink.setAttribute('download', ''); // Force download attribute
+            downloadLink.classList.add('animate__animated', 'animate__pulse', 'animate__infinite');
+            
+            // Auto-initiate download to local computer
+            setTimeout(() => {
+                window.location.href = directDownloadLink;
+            }, 500);
+            
+            // Re-enable download button
+            downloadButton.disabled = false;
+            
+            // Add success animation
+            showSuccessAnimation();
+        } else if (data.status.startsWith('error')) {
+            stopProgressUpdates();
+            statusMessage.innerHTML = `<i class="bi bi-exclamation-triangle"></i> Error: ${data.status.substring(7)}`;
+            
+            // Re-enable download button on error
+            downloadButton.disabled = false;
+        } else if (data.status === 'queued') {
+            // Waiting for a free download slot on the server
+            const position = data.queue_position ? ` (position ${data.queue_position})` : '';
+            statusMessage.innerHTML = `<i class="bi bi-hourglass-split"></i> Waiting in queue${position}...`;
+        } else if (data.phase === 'merge') {
+            statusMessage.innerHTML = '<i class="bi bi-gear"></i> Merging video and audio...';
+        } else if (data.phase === 'postprocess') {
+            statusMessage.innerHTML = '<i class="bi bi-gear"></i> Converting file...';
+        } else {
+            // Show more granular status messages based on progress
+            if (data.phase === 'video') {
+                statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Downloading video...';
+            } else if (data.phase === 'audio') {
+                statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Downloading audio...';
+            } else if (newProgress < 10) {
+                statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Starting download...';
+            } else if (newProgress < 50) {
+                statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Downloading...';
+            } else if (newProgress < 90) {
+                statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Almost there...';
+            } else if (newProgress < 100) {
+                statusMessage.innerHTML = '<i class="bi bi-cloud-download"></i> Finalizing download...';
+            }
+            
+            // Append transfer speed and time remaining when known
+            if (data.speed && data.eta != null && newProgress < 100) {
+                statusMessage.innerHTML += ` <small>(${formatSpeed(data.speed)}, ETA ${formatEta(data.eta)})</small>`;
+            }
+        }
+    }
+    
+    // Format a transfer speed in bytes per second, e.g. "1.2 MB/s"
+    function formatSpeed(bytesPerSecond) {
+        const units = ['B/s', 'KB/s', 'MB/s', 'GB/s'];
+        let value = bytesPerSecond;
+        let unit = 0;
+        while (value >= 1024 && unit < units.length - 1) {
+            value /= 1024;
+            unit++;
+        }
+        return `${value.toFixed(unit === 0 ? 0 : 1)} ${units[unit]}`;
+    }
+    
+    // Format a time remaining in seconds as m:ss
+    function formatEta(seconds) {
+        const minutes = Math.floor(seconds / 60);
+        const rest = Math.floor(seconds % 60);
+        return `${minutes}:${rest.toString().padStart(2, '0')}`;
+    }
+    
     // Function to animate progress bar
     function animateProgressBar(progress) {
         // Ensure progress is a number and clamp between 0-100
@@ -526,10 +619,13 @@ document.addEventListener('DOMContentLoaded', function() {
         streams.forEach((stream, index) => {
             const option = document.createElement('option');
             option.value = stream.format_id; // Use format_id for yt-dlp
+            if (stream.streamable) {
+                option.dataset.streamable = 'true';
+            }
             
-            // Calculate filesize - use filesize, filesize_approx, or default to 10MB
-            const filesize = stream.filesize || stream.filesize_approx || (10 * 1024 * 1024);
-            const fileSizeMB = (filesize / (1024 * 1024)).toFixed(2);
+            // Calculate filesize - use filesize or filesize_approx, omitted when unknown
+            const filesize = stream.filesize || stream.filesize_approx;
+            const fileSizeMB = filesize ? `${(filesize / (1024 * 1024)).toFixed(2)} MB` : 'size unknown';
             
             // Get extension, default to mp4
             const ext = stream.ext || 'mp4';
@@ -542,9 +638,9 @@ document.addEventListener('DOMContentLoaded', function() {
             } else if (stream.is_best_audio) {
                 optionText = `${stream.resolution} (${ext}) - Highest Bitrate`;
             } else if (stream.type === 'audio') {
-                optionText = `${stream.resolution} (${ext}) - ${fileSizeMB} MB`;
+                optionText = `${stream.resolution} (${ext}) - ${fileSizeMB}`;
             } else {
-                optionText = `${stream.resolution} (${ext}) - ${fileSizeMB} MB`;
+                optionText = `${stream.resolution} (${ext}) - ${fileSizeMB}`;
             }
             
             option.textContent = optionText;
@@ -0,0 +1,78 @@
+"""TokenBucket pacing and the fair split of BandwidthManager"""
+import pytest
+
+import app
+from app import BandwidthManager, TokenBucket
+
+class Clock:
+    """Stands in for time.monotonic so refills are exact"""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    return clock
+
+def test_bucket_starts_with_one_second_of_tokens(clock):
+    bucket = TokenBucket(100)
+    assert bucket.reserve(100) == 0.0
+    assert bucket.reserve(50) == pytest.approx(0.5)
+
+def test_bucket_debt_paces_callers_in_order(clock):
+    bucket = TokenBucket(100)
+    bucket.reserve(100)
+    assert bucket.reserve(100) == pytest.approx(1.0)
+    assert bucket.reserve(100) == pytest.approx(2.0)
+    clock.now += 1
+    assert bucket.reserve(0) == pytest.approx(1.0)
+
+def test_bucket_holds_at_most_one_second(clock):
+    bucket = TokenBucket(100)
+    clock.now += 60
+    bucket.reserve(100)
+    assert bucket.reserve(1) == pytest.approx(0.01)
+
+def test_bucket_new_rate_applies_from_now(clock):
+    bucket = TokenBucket(100)
+    bucket.reserve(100)
+    clock.now += 0.5
+    bucket.set_rate(1000)
+    # 50 tokens refilled at the old rate, the rest at the new one
+    assert bucket.reserve(150) == pytest.approx(0.1)
+
+def test_clients_share_the_rate_equally(clock):
+    manager = BandwidthManager(1000)
+    a1 = manager.open('a')
+    a2 = manager.open('a')
+    manager.open('b')
+    assert manager.fair_share('a') == 500
+    assert manager.fair_share('c') == pytest.approx(1000 / 3)
+    assert manager.stats() == {'rate': 1000, 'clients': 2, 'transfers': 3}
+    # The global bucket starts full, client a's has 500 tokens for both transfers
+    assert a1.reserve(500) == 0.0
+    assert a2.reserve(250) == pytest.approx(0.5)
+
+def test_closing_the_last_transfer_frees_the_share(clock):
+    manager = BandwidthManager(1000)
+    a = manager.open('a')
+    b = manager.open('b')
+    b.close()
+    b.close()
+    assert manager.stats()['clients'] == 1
+    assert manager.fair_share('a') == 1000
+    a.close()
+    assert manager.stats() == {'rate': 1000, 'clients': 0, 'transfers': 0}
+
+def test_global_bucket_caps_all_clients(clock):
+    manager = BandwidthManager(1000)
+    a = manager.open('a')
+    b = manager.open('b')
+    assert a.reserve(1000) == pytest.approx(1.0)
+    # Within b's own share, but a already drained the global bucket
+    assert b.reserve(500) == pytest.approx(0.5)
@@ -0,0 +1,175 @@
+"""ArtifactCache pinning and eviction, MetadataCache bounds and SingleFlight coalescing"""
+import os
+import threading
+import time
+
+import pytest
+
+import app
+from app import ArtifactCache, MetadataCache, SingleFlight
+
+def source_file(tmp_path, name, size):
+    path = tmp_path / 'downloads' / name
+    path.parent.mkdir(exist_ok=True)
+    path.write_bytes(b'x' * size)
+    return str(path)
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    directory = tmp_path / 'cache'
+    directory.mkdir()
+    return str(directory)
+
+def publish(cache, tmp_path, key, size, accessed):
+    """Publish an artifact last used `accessed` seconds into the epoch"""
+    path = cache.publish(key, source_file(tmp_path, f'{key}.mp4', size))
+    os.utime(path, (accessed, os.stat(path).st_mtime))
+    cache._index(path)
+    return path
+
+def test_publish_then_acquire(tmp_path, cache_dir):
+    cache = ArtifactCache(cache_dir, 1000)
+    path = cache.publish('k1', source_file(tmp_path, 'video.mp4', 10))
+    assert path == os.path.join(cache_dir, 'k1.mp4')
+    assert cache.acquire('k1') == path
+    assert cache.acquire('missing') is None
+    assert cache.stats() == {'entries': 1, 'bytes': 10, 'hits': 1, 'misses': 1}
+
+def test_least_recently_used_is_evicted(tmp_path, cache_dir):
+    cache = ArtifactCache(cache_dir, 25)
+    old = publish(cache, tmp_path, 'old', 10, accessed=100)
+    publish(cache, tmp_path, 'new', 10, accessed=200)
+    publish(cache, tmp_path, 'newest', 10, accessed=300)
+    assert not os.path.exists(old)
+    assert not cache.contains('old')
+    assert cache.contains('new') and cache.contains('newest')
+
+def test_pinned_artifact_survives_eviction(tmp_path, cache_dir):
+    cache = ArtifactCache(cache_dir, 25)
+    old = publish(cache, tmp_path, 'old', 10, accessed=100)
+    assert cache.acquire('old') == old
+    os.utime(old, (100, os.stat(old).st_mtime))
+    cache._index(old)
+    publish(cache, tmp_path, 'new', 10, accessed=200)
+    publish(cache, tmp_path, 'newest', 10, accessed=300)
+    assert os.path.exists(old)
+    assert not cache.contains('new')
+    
+    cache.release('old')
+    cache.release('old')
+    publish(cache, tmp_path, 'latest', 10, accessed=400)
+    assert not os.path.exists(old)
+
+def test_least_frequently_used_is_evicted(tmp_path, cache_dir):
+    cache = ArtifactCache(cache_dir, 25, policy='lfu')
+    popular = publish(cache, tmp_path, 'popular', 10, accessed=100)
+    for _ in range(3):
+        cache.acquire('popular')
+        cache.release('popular')
+    publish(cache, tmp_path, 'once', 10, accessed=200)
+    publish(cache, tmp_path, 'newest', 10, accessed=300)
+    assert os.path.exists(popular)
+    assert not cache.contains('once')
+
+def test_artifacts_from_other_workers_are_found(tmp_path, cache_dir):
+    cache = ArtifactCache(cache_dir, 1000)
+    other = ArtifactCache(cache_dir, 1000)
+    path = other.publish('k1', source_file(tmp_path, 'audio.m4a', 10))
+    assert cache.acquire('k1') == path
+    cache.release('k1')
+    os.remove(path)
+    assert not cache.contains('k1')
+    # A restarted worker indexes what is already on disk
+    other.publish('k2', source_file(tmp_path, 'video.webm', 10))
+    assert ArtifactCache(cache_dir, 1000).stats()['entries'] == 1
+
+def test_metadata_cache_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: now[0])
+    cache = MetadataCache(ttl=60, max_entries=10, max_bytes=10000)
+    cache.set('aaaaaaaaaaa', {'title': 'a'})
+    assert cache.get('aaaaaaaaaaa') == {'title': 'a'}
+    now[0] += 61
+    assert cache.get('aaaaaaaaaaa') is None
+    assert cache.stats() == {'entries': 0, 'bytes': 0, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+def test_metadata_cache_evicts_least_recently_used():
+    cache = MetadataCache(ttl=60, max_entries=2, max_bytes=10000)
+    cache.set('a', {'title': 'a'})
+    cache.set('b', {'title': 'b'})
+    cache.get('a')
+    cache.set('c', {'title': 'c'})
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+    assert cache.stats()['evictions'] == 1
+
+def test_metadata_cache_bounds_bytes():
+    cache = MetadataCache(ttl=60, max_entries=10, max_bytes=40)
+    cache.set('a', {'title': 'a' * 10})
+    cache.set('b', {'title': 'b' * 10})
+    assert cache.get('a') is None
+    assert cache.stats()['bytes'] <= 40
+    # Too large to cache at all
+    cache.set('c', {'title': 'c' * 100})
+    assert cache.get('c') is None
+    assert cache.get('b') is not None
+
+def test_metadata_cache_disabled_without_ttl():
+    cache = MetadataCache(ttl=0, max_entries=10, max_bytes=10000)
+    cache.set('a', {'title': 'a'})
+    assert cache.get('a') is None
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+    
+    def lookup(key):
+        calls.append(key)
+        release.wait(5)
+        return {'id': key}
+    
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do('k', lookup, 'k'))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while flight.coalesced < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ['k']
+    assert results == [{'id': 'k'}] * 5
+    # Later calls run again
+    release.set()
+    flight.do('k', lookup, 'k')
+    assert calls == ['k', 'k']
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    
+    def lookup():
+        started.set()
+        release.wait(5)
+        raise ValueError('unavailable')
+    
+    errors = []
+    def follower():
+        try:
+            flight.do('k', lookup)
+        except ValueError as e:
+            errors.append(e)
+    
+    leader = threading.Thread(target=follower)
+    leader.start()
+    started.wait(5)
+    other = threading.Thread(target=follower)
+    other.start()
+    while flight.coalesced < 1:
+        time.sleep(0.01)
+    release.set()
+    leader.join(5)
+    other.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
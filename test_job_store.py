@@ -0,0 +1,71 @@
+"""The JobStore backends: merged updates, finished statuses and pruning"""
+import threading
+import time
+
+import pytest
+
+from app import JobStore, MemoryJobStore, SQLiteJobStore
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryJobStore()
+    return SQLiteJobStore(str(tmp_path / 'jobs.db'))
+
+def test_interface_cannot_be_instantiated():
+    with pytest.raises(TypeError):
+        JobStore()
+
+def test_updates_merge_fields(store):
+    assert store.get('job') is None
+    store.update('job', status='queued', url='https://youtu.be/aaaaaaaaaaa')
+    store.update('job', status='downloading', progress=10.0)
+    job = store.get('job')
+    assert job['status'] == 'downloading'
+    assert job['url'] == 'https://youtu.be/aaaaaaaaaaa'
+    assert job['progress'] == 10.0
+    assert job['created_at'] <= job['updated_at']
+
+def test_delete(store):
+    store.update('job', status='queued')
+    store.delete('job')
+    store.delete('job')
+    assert store.get('job') is None
+
+@pytest.mark.parametrize('status, finished', [
+    ('completed', True),
+    ('completed_fallback', True),
+    ('error', True),
+    ('error: Video unavailable', True),
+    ('downloading', False),
+    (None, False),
+])
+def test_is_finished(status, finished):
+    assert JobStore.is_finished(status) == finished
+
+def test_prune_removes_only_old_finished_jobs(store):
+    store.update('done', status='completed')
+    store.update('failed', status='error: Video unavailable')
+    store.update('running', status='downloading')
+    time.sleep(0.05)
+    store.update('recent', status='completed')
+    assert store.prune(0.04) == 2
+    assert store.get('done') is None and store.get('failed') is None
+    assert store.get('running') is not None and store.get('recent') is not None
+
+def test_sqlite_store_is_shared_and_merges_concurrent_writers(tmp_path):
+    path = str(tmp_path / 'jobs.db')
+    stores = [SQLiteJobStore(path), SQLiteJobStore(path)]
+    
+    def write(store, index):
+        for n in range(20):
+            store.update('job', **{f'field{index}': n})
+    
+    threads = [threading.Thread(target=write, args=(stores[i % 2], i)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    job = stores[0].get('job')
+    assert [job[f'field{i}'] for i in range(4)] == [19] * 4
+    assert stores[1].get('job') == job
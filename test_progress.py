@@ -0,0 +1,71 @@
+"""ProgressTracker against progress lines rendered by yt-dlp itself"""
+import uuid
+
+import pytest
+from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor import (
+    EmbedThumbnailPP, FFmpegExtractAudioPP, FFmpegMergerPP, FFmpegMetadataPP,
+    FFmpegVideoConvertorPP, FFmpegVideoRemuxerPP, MoveFilesAfterDownloadPP,
+)
+
+from app import DOWNLOAD_PROGRESS_TEMPLATE, POSTPROCESS_PROGRESS_TEMPLATE, ProgressTracker, job_store
+
+INFO = {'id': 'aaaaaaaaaaa', 'format_id': '18', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2'}
+
+@pytest.fixture(scope='module')
+def ydl():
+    return YoutubeDL({'quiet': True})
+
+def download_line(ydl, info, **progress):
+    """A line as yt-dlp prints it for --progress-template download:..."""
+    return ydl.evaluate_outtmpl(DOWNLOAD_PROGRESS_TEMPLATE, {'info': info, 'progress': progress}) + '\n'
+
+def postprocess_line(ydl, pp, status='started'):
+    """A line as yt-dlp prints it for --progress-template postprocess:..."""
+    progress = {'status': status, 'postprocessor': pp.pp_key()}
+    return ydl.evaluate_outtmpl(POSTPROCESS_PROGRESS_TEMPLATE, {'info': INFO, 'progress': progress}) + '\n'
+
+@pytest.fixture
+def tracker():
+    return ProgressTracker(uuid.uuid4().hex, interval=0)
+
+def test_download_progress(ydl, tracker):
+    assert tracker.feed(download_line(ydl, INFO, status='downloading', downloaded_bytes=250, total_bytes=1000))
+    assert tracker.phase == 'download'
+    job = job_store.get(tracker.download_id)
+    assert job['progress'] == 25.0
+    assert job['phase'] == 'download'
+
+def test_merged_parts_report_their_share(ydl, tracker):
+    video = dict(INFO, format_id='137', acodec='none', requested_formats=[{'format_id': '137'}, {'format_id': '140'}])
+    audio = dict(INFO, format_id='140', vcodec='none', requested_formats=[{'format_id': '137'}, {'format_id': '140'}])
+    tracker.feed(download_line(ydl, video, status='finished', downloaded_bytes=1000, total_bytes=1000))
+    assert tracker.phase == 'video'
+    tracker.feed(download_line(ydl, audio, status='downloading', downloaded_bytes=50, total_bytes=100))
+    assert tracker.phase == 'audio'
+    assert job_store.get(tracker.download_id)['progress'] == 75.0
+
+@pytest.mark.parametrize('pp, phase', [
+    (FFmpegMergerPP, 'merge'),
+    (FFmpegVideoRemuxerPP, 'postprocess'),
+    (FFmpegVideoConvertorPP, 'postprocess'),
+    (FFmpegExtractAudioPP, 'postprocess'),
+    (EmbedThumbnailPP, 'postprocess'),
+])
+def test_converting_postprocessors_change_phase(ydl, tracker, pp, phase):
+    tracker.feed(download_line(ydl, INFO, status='finished', downloaded_bytes=1000, total_bytes=1000))
+    assert tracker.feed(postprocess_line(ydl, pp))
+    assert tracker.phase == phase
+    assert tracker.postprocess_started is not None
+    assert job_store.get(tracker.download_id)['phase'] == phase
+
+@pytest.mark.parametrize('pp', [MoveFilesAfterDownloadPP, FFmpegMetadataPP])
+def test_bookkeeping_postprocessors_are_ignored(ydl, tracker, pp):
+    tracker.feed(download_line(ydl, INFO, status='finished', downloaded_bytes=1000, total_bytes=1000))
+    assert tracker.feed(postprocess_line(ydl, pp))
+    assert tracker.phase == 'download'
+    assert tracker.postprocess_started is None
+
+def test_other_output_is_not_progress(tracker):
+    assert not tracker.feed('ERROR: [youtube] aaaaaaaaaaa: Video unavailable\n')
+    assert tracker.lines == 0
@@ -0,0 +1,111 @@
+"""DownloadScheduler rate sharing and DownloadJob restarts, without running yt-dlp"""
+import subprocess
+import sys
+
+import pytest
+
+from app import DownloadJob, DownloadScheduler, ProgressTracker
+
+URL = 'https://www.youtube.com/watch?v=aaaaaaaaaaa'
+
+@pytest.fixture
+def process():
+    """A stand-in for a running yt-dlp, in its own process group like the real one"""
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'], start_new_session=True)
+    yield proc
+    if proc.poll() is None:
+        proc.kill()
+    proc.wait()
+
+@pytest.fixture
+def scheduler():
+    # Jobs are placed in _active by hand, so no worker thread ever starts
+    return DownloadScheduler(workers=4, max_queue=10, per_client=10, rate_limit=1000)
+
+def activate(scheduler, client, process=None):
+    """Mark a job as running, as a worker does when it takes one off the queue"""
+    job = DownloadJob(URL, '18', client=client)
+    job.process = process
+    with scheduler._cond:
+        scheduler._active[job.download_id] = job
+        scheduler._rebalance()
+    return job
+
+def finish(scheduler, job):
+    with scheduler._cond:
+        scheduler._active.pop(job.download_id)
+        scheduler._rebalance()
+
+def running_job(process, phase):
+    job = DownloadJob(URL, '18')
+    job.process = process
+    job.tracker = ProgressTracker(job.download_id)
+    job.tracker.phase = phase
+    return job
+
+@pytest.mark.parametrize('phase', [None, 'video', 'audio', 'download'])
+def test_restart_while_transferring(process, phase):
+    job = running_job(process, phase)
+    assert job.request_restart()
+    assert job.restart_requested
+    assert process.wait(timeout=5) != 0
+
+@pytest.mark.parametrize('phase', ['merge', 'postprocess'])
+def test_no_restart_once_finishing(process, phase):
+    job = running_job(process, phase)
+    assert not job.request_restart()
+    assert not job.restart_requested
+    assert process.poll() is None
+
+def test_no_restart_after_postprocessing_started(process):
+    job = running_job(process, 'download')
+    job.tracker.postprocess_started = 1.0
+    assert not job.request_restart()
+    assert process.poll() is None
+
+def test_rate_split_between_clients_then_their_transfers(scheduler):
+    a1 = activate(scheduler, 'a')
+    b = activate(scheduler, 'b')
+    a2 = activate(scheduler, 'a')
+    assert (a1.rate_limit, a2.rate_limit, b.rate_limit) == (250, 250, 500)
+
+def test_rate_shares_stay_within_the_limit(scheduler):
+    jobs = [activate(scheduler, client) for client in ('a', 'b', 'c', 'a')]
+    assert sum(job.rate_limit for job in jobs) <= scheduler.rate_limit
+    stream = scheduler.open_stream('c')
+    shares = [job.rate_limit for job in jobs] + [stream.bucket.rate]
+    assert sum(shares) <= scheduler.rate_limit
+    stream.close()
+    assert sum(job.rate_limit for job in jobs) <= scheduler.rate_limit
+
+def test_shares_grow_when_transfers_finish(scheduler):
+    a = activate(scheduler, 'a')
+    b = activate(scheduler, 'b')
+    assert a.rate_limit == 500
+    finish(scheduler, b)
+    assert a.rate_limit == 1000
+
+def test_running_download_restarts_only_on_a_large_change(scheduler, process):
+    a = activate(scheduler, 'a', process)
+    assert a.rate_limit == 1000
+    activate(scheduler, 'b')
+    # The share halved: relaunch yt-dlp under the new limit
+    assert a.rate_limit == 500
+    assert a.restart_requested
+    assert process.wait(timeout=5) != 0
+
+def test_running_download_keeps_a_slightly_larger_share(scheduler, process):
+    jobs = [activate(scheduler, client) for client in ('b', 'c')]
+    a = activate(scheduler, 'a', process)
+    assert a.rate_limit == 333
+    finish(scheduler, jobs[0])
+    # 500 B/s is less than double, not worth a restart
+    assert a.rate_limit == 333
+    assert not a.restart_requested
+    assert process.poll() is None
+
+def test_no_rate_limit_leaves_jobs_unlimited():
+    scheduler = DownloadScheduler(workers=1, max_queue=1, per_client=1)
+    job = activate(scheduler, 'a')
+    assert job.rate_limit is None
+    assert scheduler.open_stream('a') is None